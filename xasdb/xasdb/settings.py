@@ -33,6 +33,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'xasdb1.instrumentation.InstrumentationMiddleware', # first, so it sees the queries of the other middleware too
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -46,7 +47,9 @@ ROOT_URLCONF = 'xasdb.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the regular Django templates, timed for InstrumentationMiddleware
+        'BACKEND': 'xasdb1.instrumentation.DjangoTemplates',
+        'NAME': 'django',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -113,6 +116,27 @@ MEDIA_ROOT = ABSOLUTE_PATH('media/')
 FILE_UPLOAD_PERMISSIONS = 0o600
 FILE_UPLOAD_DIRECTORY_PERMISSIONS = 0o700
 
+# caches: the file based ones are shared by all worker processes
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'plots': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': ABSOLUTE_PATH('cache/plots/'),
+        'TIMEOUT': 30 * 24 * 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+    # the per-element spectrum counts of the periodic table: shared by the web workers and the ingest_worker,
+    # which all clear it when they save a file. use memcached or the database cache when they run on several hosts
+    'counts': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': ABSOLUTE_PATH('cache/counts/'),
+    },
+}
+
 # email stuff
 ADMINS = [('Tom Schoonjans', 'Tom.Schoonjans@diamond.ac.uk')]
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
@@ -121,3 +145,103 @@ SERVER_EMAIL = "donotreply@xasdb.diamond.ac.uk"
 DEFAULT_FROM_EMAIL = SERVER_EMAIL
 
 
+
+# logging: the xasdb1 logger reports ingest timings etc. at INFO level
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'xasdb1': {
+            'handlers': ['console'],
+            'level': os.environ.get('XASDB_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}
+
+# XASArray storage: zlib compress the binary arrays
+# (smaller rows, but decoding is no longer zero-copy)
+XASDB_ARRAY_COMPRESSION = False
+
+# Crossref DOI metadata cache
+XASDB_CROSSREF_CLIENT = 'habanero.Crossref' # swap for a local stub in tests and benchmarks
+XASDB_CROSSREF_MAILTO = 'Tom.Schoonjans@diamond.ac.uk' # necessary to end up in the polite pool
+XASDB_CROSSREF_TTL = 7 * 24 * 3600 # seconds
+XASDB_CROSSREF_STALE_TTL = 30 * 24 * 3600 # seconds after expiry during which metadata is still served while being refreshed
+XASDB_CROSSREF_NEGATIVE_TTL = 3600 # seconds an invalid DOI is remembered
+XASDB_CROSSREF_BACKGROUND_REFRESH = True
+
+# number of spectra per page of an element listing
+XASDB_ELEMENT_PAGE_SIZE = 50
+
+# how long browsers may cache aux image thumbnails and previews: their URLs change with their content
+XASDB_AUX_IMAGE_MAX_AGE = 365 * 24 * 3600
+
+# ingest uploads, archives included, in the background with the ingest_worker management command instead of in the upload request
+XASDB_ASYNC_INGEST = False
+XASDB_INGEST_MAX_ATTEMPTS = 5
+XASDB_INGEST_RETRY_DELAY = 60 # seconds, doubled after every failed attempt
+XASDB_INGEST_STALE_TIMEOUT = 3600 # seconds after which a running job is considered abandoned
+XASDB_INGEST_POLL_INTERVAL = 5 # seconds
+
+# number of points of the downsampled copies of the plotted spectrum stored at ingest.
+# the file page starts with the coarsest one and fetches finer ones when zooming in
+XASDB_PLOT_LEVELS = (1000, 5000, 20000)
+
+# archive uploads: the members are parsed by a pool of this many processes, 0 parses them in the process that ingests the archive
+XASDB_ARCHIVE_WORKERS = os.cpu_count()
+XASDB_ARCHIVE_MAX_SIZE = 500 * 1024 * 1024 # bytes
+XASDB_ARCHIVE_MAX_MEMBERS = 1000
+
+# how downloads are served once Django has checked permissions and logged them:
+# 'django' streams them itself (with Range support), 'x-accel-redirect' (nginx) and 'x-sendfile' (apache, lighttpd)
+# leave the transfer to the front-end web server
+XASDB_DOWNLOAD_BACKEND = 'django'
+XASDB_DOWNLOAD_INTERNAL_PREFIX = '/protected-media/' # internal nginx location that aliases MEDIA_ROOT
+
+# download events are spooled to files in this directory and stored in batches of this many events,
+# or once the oldest has waited this many seconds. run the flush_download_log command from cron to pick up
+# the leftovers of processes that died and of quiet periods
+XASDB_DOWNLOAD_LOG_DIR = ABSOLUTE_PATH('spool/downloads/')
+XASDB_DOWNLOAD_LOG_BATCH_SIZE = 100
+XASDB_DOWNLOAD_LOG_FLUSH_INTERVAL = 10 # seconds
+
+# fraction of the requests for which SQL queries and the time spent in Crossref, plotting and rendering are recorded,
+# and logged by the xasdb1.instrumentation logger at INFO level. 0 switches it off
+XASDB_INSTRUMENTATION_SAMPLE_RATE = 0.0
+XASDB_INSTRUMENTATION_SERVER_TIMING = True # add a Server-Timing header to the sampled responses
+
+# seconds the per-element spectrum counts of the periodic table are cached. saving or deleting a file clears them,
+# this is only a safety net for changes that bypass the signals, such as bulk updates
+XASDB_ELEMENT_COUNTS_TIMEOUT = 3600
+
+# search over the sample, beamline, facility and mono metadata
+XASDB_SEARCH_PAGE_SIZE = 50
+XASDB_SEARCH_MAX_QUERY_LENGTH = 200 # characters
+XASDB_SEARCH_FULLTEXT_MIN_LENGTH = 3 # innodb_ft_min_token_size: shorter words are searched without the FULLTEXT index
+
+# similarity search: spectra are compared on this grid of energies relative to the tabulated edge energy,
+# (start, stop, number of points) in eV. after changing it, run the rebuild_arrays command
+XASDB_SIMILARITY_GRID = (-30.0, 150.0, 256)
+XASDB_SIMILARITY_RESULTS = 10 # number of similar spectra shown, unless asked for another number with ?n=
+XASDB_SIMILARITY_MAX_RESULTS = 100
+
+# normalization of mu(E) at ingest: E0 is looked for within this many eV of the tabulated edge energy,
+# the pre-edge line and the post-edge polynomial are fitted over these ranges in eV relative to E0 (None: up to the end)
+XASDB_NORMALIZATION_E0_WINDOW = 30.0
+XASDB_NORMALIZATION_PRE_EDGE = (-150.0, -30.0)
+XASDB_NORMALIZATION_POST_EDGE = (50.0, None)
+XASDB_NORMALIZATION_POST_EDGE_DEGREE = 2
+
+# the compare view resamples the spectra onto a shared grid of this many energies,
+# and downsamples each of them to this many points for the plot
+XASDB_COMPARE_MAX_SPECTRA = 50
+XASDB_COMPARE_GRID_POINTS = 4000
+XASDB_COMPARE_PLOT_POINTS = 500
+
+# number of spectra that can be exported as one zip, with their aux files
+XASDB_EXPORT_MAX_FILES = 1000
@@ -36,4 +36,5 @@ DATABASES = {
     }
 }
 
-
+# keep track of ingest timings on the production server
+LOGGING['loggers']['xasdb1']['level'] = os.environ.get('XASDB_LOG_LEVEL', 'INFO')
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import XASFile, XASArray, XASMode, XASUploadAuxData
+from .models import XASFile, XASArray, XASMode, XASUploadAuxData, XASDOIMetadata, XASIngestJob
 
 @admin.register(XASFile)
 class XASFileAdmin(admin.ModelAdmin):
@@ -20,3 +20,16 @@ class XASModeAdmin(admin.ModelAdmin):
 class XASUploadAuxDataAdmin(admin.ModelAdmin):
     fields = ('aux_description', 'aux_file')
     readonly_fields = fields
+
+@admin.register(XASDOIMetadata)
+class XASDOIMetadataAdmin(admin.ModelAdmin):
+    list_display = ('doi', 'valid', 'fetched_timestamp', 'expires_timestamp')
+    fields = ('doi', 'work', 'error', 'fetched_timestamp', 'expires_timestamp')
+    readonly_fields = fields
+
+@admin.register(XASIngestJob)
+class XASIngestJobAdmin(admin.ModelAdmin):
+    list_display = ('upload_name', 'uploader', 'is_archive', 'status', 'attempts', 'created_timestamp', 'finished_timestamp')
+    list_filter = ('status', 'is_archive')
+    fields = ('upload_name', 'upload_file', 'upload_file_doi', 'uploader', 'is_archive', 'status', 'attempts', 'run_after', 'created_timestamp', 'claimed_timestamp', 'finished_timestamp', 'error', 'file')
+    readonly_fields = fields
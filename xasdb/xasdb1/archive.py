@@ -0,0 +1,188 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail import mail_admins
+from django.urls import reverse
+
+from .models import file_size_valid, mendeljev_valid, parse_xdi_upload
+from .utils import StageTimer, extract_xdi_data, store_xdi_data
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+import logging
+import os.path
+import tarfile
+import time
+import types
+import zipfile
+
+import django
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidArchive(Exception):
+    pass
+
+
+def _skip_member(name):
+    # macOS resource forks and hidden files are not spectra
+    parts = name.split('/')
+    return parts[0] == '__MACOSX' or any(part.startswith('.') for part in parts if part)
+
+
+def _read_tar_member(tar_file, member):
+    return tar_file.extractfile(member).read()
+
+
+@contextmanager
+def open_archive(archive):
+    # yields a list of (name, size, read) for every regular file in a zip or tar archive, read() returns its contents
+    archive.seek(0)
+    if zipfile.is_zipfile(archive):
+        archive.seek(0)
+        try:
+            zip_file = zipfile.ZipFile(archive)
+        except zipfile.BadZipFile as e:
+            raise InvalidArchive(f'Invalid zip archive: {e}')
+        with zip_file:
+            yield [(info.filename, info.file_size, partial(zip_file.read, info)) for info in zip_file.infolist() if not info.is_dir() and not _skip_member(info.filename)]
+        return
+
+    archive.seek(0)
+    try:
+        tar_file = tarfile.open(fileobj=archive, mode='r:*')
+        members = tar_file.getmembers()
+    except tarfile.TarError:
+        raise InvalidArchive('Not a zip or tar archive')
+    with tar_file:
+        yield [(member.name, member.size, partial(_read_tar_member, tar_file, member)) for member in members if member.isfile() and not _skip_member(member.name)]
+
+
+def check_archive(archive):
+    with open_archive(archive) as members:
+        if not members:
+            raise InvalidArchive('The archive does not contain any files')
+        if len(members) > settings.XASDB_ARCHIVE_MAX_MEMBERS:
+            raise InvalidArchive('Archives are limited to {} files'.format(settings.XASDB_ARCHIVE_MAX_MEMBERS))
+
+
+def init_worker():
+    # with the spawn start method the worker starts from scratch
+    if not apps.ready:
+        django.setup()
+
+
+def parse_member(name, content):
+    # runs in a worker process: validates and parses one XDI file, without touching the database
+    timer = StageTimer()
+    upload = SimpleUploadedFile(os.path.basename(name), content)
+    with timer.stage('parse'):
+        xdi_file = parse_xdi_upload(upload)
+    # same checks as the validators of XASFile
+    element = xdi_file.element.decode('utf-8')
+    if element == '':
+        raise ValidationError('Invalid XDI file: no element found')
+    mendeljev_valid(element)
+    return extract_xdi_data(xdi_file, name, timer), timer.timings
+
+
+def error_message(e):
+    if isinstance(e, ValidationError):
+        return ' '.join(e.messages)
+    return str(e) or e.__class__.__name__
+
+
+def ingest_archive(archive, upload_file_doi, uploader, skip=(), on_entry=None):
+    # parses the members in a process pool and stores them one by one.
+    # returns a report with one entry per member: its index in the archive, its name, the new XASFile (or None) and the error (or None).
+    # members named in skip are left out, and on_entry is called with every entry as soon as it is finished
+    check_archive(archive)
+    workers = settings.XASDB_ARCHIVE_WORKERS
+    start = time.perf_counter()
+    report = []
+
+    def finish(entry):
+        if on_entry is not None:
+            on_entry(entry)
+
+    def read(index, name, size, read):
+        entry = dict(index=index, name=name, file=None, error=None)
+        report.append(entry)
+        try:
+            file_size_valid(types.SimpleNamespace(size=size))
+            return entry, read()
+        except Exception as e:
+            entry['error'] = error_message(e)
+            finish(entry)
+            return entry, None
+
+    def store(entry, content, result):
+        data, timings = result
+        timer = StageTimer()
+        timer.timings.update(timings)
+        try:
+            # every member is committed on its own: one bad file does not take the others down with it
+            entry['file'] = store_xdi_data(data, ContentFile(content, name=os.path.basename(entry['name'])), upload_file_doi, uploader, timer)
+        except Exception as e:
+            entry['error'] = error_message(e)
+        finish(entry)
+
+    with open_archive(archive) as members:
+        members = [(index,) + member for index, member in enumerate(members) if member[0] not in skip]
+        if not workers:
+            for member in members:
+                entry, content = read(*member)
+                if content is None:
+                    continue
+                try:
+                    result = parse_member(entry['name'], content)
+                except Exception as e:
+                    entry['error'] = error_message(e)
+                    finish(entry)
+                else:
+                    store(entry, content, result)
+        else:
+            # members are parsed in parallel but stored in order by this process, which owns the database connection.
+            # only a few members per worker are kept in memory at any time
+            pending = deque()
+
+            def drain(limit):
+                while len(pending) > limit:
+                    entry, content, future = pending.popleft()
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        entry['error'] = error_message(e)
+                        finish(entry)
+                    else:
+                        store(entry, content, result)
+
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+                for member in members:
+                    entry, content = read(*member)
+                    if content is None:
+                        continue
+                    pending.append((entry, content, executor.submit(parse_member, entry['name'], content)))
+                    drain(2 * workers)
+                drain(0)
+
+    failed = len([entry for entry in report if entry['file'] is None])
+    logger.info('ingested archive {} ({} members, {} failed) in {:.1f}s'.format(archive.name, len(report), failed, time.perf_counter() - start))
+    return report
+
+
+def notify_admins_of_archive(report, archive_name, uploader):
+    from .views import HOST # avoid circular import
+    ingested = [entry['file'] for entry in report if entry['file'] is not None]
+    if not ingested:
+        return
+    urls = '\n'.join(HOST + reverse('xasdb1:file', args=[xas_file.id]) for xas_file in ingested)
+    # a single mail for the whole archive
+    mail_admins( \
+        '{} new datasets have been uploaded'.format(len(ingested)), \
+        'An archive ({}) with {} new datasets has been uploaded by {} ({}).\nPlease process these submissions by visiting:\n{}'.format(archive_name, len(ingested), uploader.get_full_name(), uploader.email, urls))
@@ -0,0 +1,243 @@
+import struct
+import zlib
+
+import numpy as np
+
+
+# XASArray.array binary layout:
+# a small little-endian header, followed by the raw (optionally zlib compressed) array buffer
+#
+# magic   4 bytes  b'XASA'
+# version uint8
+# flags   uint8    bit 0 set -> buffer is zlib compressed
+# ndim    uint8
+# dtype   8 bytes  numpy dtype string, always little-endian, NUL padded (e.g. b'<f8')
+# shape   ndim x uint64
+ARRAY_MAGIC = b'XASA'
+ARRAY_VERSION = 1
+ARRAY_FLAG_COMPRESSED = 0x01
+
+_HEADER = struct.Struct('<4sBBB8s')
+
+
+def encode_array(array, compress=False):
+    array = np.asarray(array)
+    dtype = array.dtype.newbyteorder('<')
+    if dtype.hasobject or dtype.fields is not None:
+        raise ValueError(f'Unsupported array dtype {array.dtype}')
+    dtype_str = dtype.str.encode('ascii')
+    if len(dtype_str) > 8:
+        raise ValueError(f'Unsupported array dtype {array.dtype}')
+    buffer = np.ascontiguousarray(array, dtype=dtype).tobytes()
+    flags = 0
+    if compress:
+        buffer = zlib.compress(buffer)
+        flags |= ARRAY_FLAG_COMPRESSED
+    header = _HEADER.pack(ARRAY_MAGIC, ARRAY_VERSION, flags, array.ndim, dtype_str)
+    shape = struct.pack(f'<{array.ndim}Q', *array.shape)
+    return header + shape + buffer
+
+
+def decode_array(value):
+    # BinaryField values come back as bytes or memoryview depending on the database backend
+    buffer = memoryview(value)
+    magic, version, flags, ndim, dtype_str = _HEADER.unpack_from(buffer)
+    if magic != ARRAY_MAGIC or version != ARRAY_VERSION:
+        raise ValueError('Not an encoded XAS array')
+    shape = struct.unpack_from(f'<{ndim}Q', buffer, _HEADER.size)
+    offset = _HEADER.size + 8 * ndim
+    dtype = np.dtype(dtype_str.rstrip(b'\0').decode('ascii'))
+    if flags & ARRAY_FLAG_COMPRESSED:
+        buffer = zlib.decompress(buffer[offset:])
+        offset = 0
+    # no copy here: the returned array is a read-only view on the buffer
+    count = int(np.prod(shape, dtype=np.int64))
+    return np.frombuffer(buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+
+# absorption channels derived from the raw ones at ingest time, see derive_channels
+DERIVED_ARRAYS = ('mu_trans', 'mu_fluor', 'mu_refer')
+
+
+def _finite(array):
+    # zero or negative intensities lead to inf and nan: store all of them as nan so plots just leave a gap
+    return np.where(np.isfinite(array), array, np.nan)
+
+
+def derive_channels(arrays):
+    # arrays maps raw channel names (i0, itrans, ifluor, irefer) to numpy arrays,
+    # returns the derived channels that can be computed from them
+    derived = dict()
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if 'i0' in arrays and 'itrans' in arrays:
+            derived['mu_trans'] = _finite(-np.log(np.asarray(arrays['itrans'], dtype=np.float64) / np.asarray(arrays['i0'], dtype=np.float64)))
+        if 'i0' in arrays and 'ifluor' in arrays:
+            derived['mu_fluor'] = _finite(np.asarray(arrays['ifluor'], dtype=np.float64) / np.asarray(arrays['i0'], dtype=np.float64))
+        if 'itrans' in arrays and 'irefer' in arrays:
+            derived['mu_refer'] = _finite(-np.log(np.asarray(arrays['irefer'], dtype=np.float64) / np.asarray(arrays['itrans'], dtype=np.float64)))
+    return derived
+
+
+def array_to_json(array):
+    # JSON has no nan or inf: those become null
+    array = np.asarray(array)
+    if array.dtype.kind != 'f':
+        return array.tolist()
+    values = array.astype(object)
+    values[~np.isfinite(array)] = None
+    return values.tolist()
+
+
+def lttb(x, y, threshold):
+    # largest-triangle-three-buckets downsampling (Steinarsson 2013): returns the indices of the points to keep,
+    # which always include the first and the last one
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=np.float64)
+    # non-finite values must not win the area contest
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64), nan=0.0, posinf=0.0, neginf=0.0)
+
+    # threshold - 2 buckets between the first and the last point
+    edges = (np.arange(threshold - 1) * ((n - 2) / (threshold - 2))).astype(np.int64) + 1
+    edges[-1] = n - 1
+    x_sums = np.concatenate(([0.0], np.cumsum(x)))
+    y_sums = np.concatenate(([0.0], np.cumsum(y)))
+
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+        # the third point of the triangle is the average of the next bucket
+        next_start, next_end = (edges[i + 1], edges[i + 2]) if i + 2 < len(edges) else (n - 1, n)
+        avg_x = (x_sums[next_end] - x_sums[next_start]) / (next_end - next_start)
+        avg_y = (y_sums[next_end] - y_sums[next_start]) / (next_end - next_start)
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        indices[i + 1] = a
+    return indices
+
+
+def plot_level_name(name, level):
+    return f'{name}@{level}'
+
+
+def plot_levels(name, x, y, levels):
+    # downsampled copies of (x, y) for plotting, stored as 2 x level arrays.
+    # the coarsest level is always there, even if it holds all points, so the plot never needs the full arrays
+    x = np.asarray(x)
+    y = np.asarray(y)
+    levels = sorted(levels)
+    result = dict()
+    for level in levels:
+        if level >= len(x) and level != levels[0]:
+            break
+        indices = lttb(x, y, level)
+        result[plot_level_name(name, level)] = np.vstack((x[indices], y[indices]))
+    return result
+
+
+# fixed-length feature vector of a spectrum for the similarity search, see xasdb1.similarity
+SIMILARITY_ARRAY = 'features'
+
+
+def similarity_features(energy, mu, grid, min_coverage=0.5):
+    # mu interpolated onto grid (absolute energies), centred and scaled to unit length: the dot product of two of these
+    # is their correlation, which does not care about the offset and scale of the absorption.
+    # None if the spectrum covers less than min_coverage of the grid, or is flat
+    energy = np.asarray(energy, dtype=np.float64)
+    mu = np.asarray(mu, dtype=np.float64)
+    finite = np.isfinite(energy) & np.isfinite(mu)
+    energy = energy[finite]
+    mu = mu[finite]
+    if len(energy) < 2:
+        return None
+    order = np.argsort(energy, kind='stable')
+    energy = energy[order]
+    mu = mu[order]
+    # beyond the measured range np.interp repeats the first and last points
+    if np.mean((grid >= energy[0]) & (grid <= energy[-1])) < min_coverage:
+        return None
+    features = np.interp(grid, energy, mu)
+    features -= features.mean()
+    norm = np.linalg.norm(features)
+    if not norm:
+        return None
+    return (features / norm).astype(np.float32)
+
+
+# mu(E) normalized to a unit edge step, see normalize
+NORMALIZED_ARRAY = 'mu_norm'
+
+
+def normalize(energy, mu, e0_guess, e0_window, pre_edge, post_edge, post_edge_degree):
+    # pre-edge/post-edge normalization in the manner of Athena: E0 is the steepest point of the edge within e0_window eV
+    # of e0_guess, a line is fitted to the pre-edge region and a polynomial to the post-edge region, both given in eV
+    # relative to E0 (None for the end of the spectrum). the edge step is their difference at E0.
+    # returns (e0, edge_step, normalized mu for every point of energy), or None if there is not enough of the spectrum
+    energy = np.asarray(energy, dtype=np.float64)
+    mu = np.asarray(mu, dtype=np.float64)
+    finite = np.isfinite(energy) & np.isfinite(mu)
+    x = energy[finite]
+    y = mu[finite]
+    order = np.argsort(x, kind='stable')
+    x = x[order]
+    y = y[order]
+    # repeated energies have no slope
+    distinct = np.concatenate(([True], np.diff(x) > 0))
+    x = x[distinct]
+    y = y[distinct]
+    if len(x) < 5:
+        return None
+
+    window = np.abs(x - e0_guess) <= e0_window
+    if not window.any():
+        return None
+    slope = np.gradient(y, x)
+    # a little smoothing, so a single noisy point does not make the edge
+    slope = np.convolve(slope, np.ones(3) / 3, mode='same')
+    e0 = float(x[window][np.argmax(slope[window])])
+
+    def fit(region, degree):
+        start, stop = region
+        mask = (x >= e0 + start) & (x <= (e0 + stop if stop is not None else np.inf))
+        if mask.sum() <= degree:
+            return None
+        return np.polyfit(x[mask], y[mask], degree)
+
+    pre = fit(pre_edge, 1)
+    # short post-edge regions cannot carry a curved fit
+    span = (post_edge[1] if post_edge[1] is not None else x[-1] - e0) - post_edge[0]
+    degree = post_edge_degree if span >= 300 else min(post_edge_degree, 1 if span >= 30 else 0)
+    post = fit(post_edge, degree)
+    if pre is None or post is None:
+        return None
+    edge_step = float(np.polyval(post, e0) - np.polyval(pre, e0))
+    if not np.isfinite(edge_step) or edge_step <= 0:
+        return None
+    with np.errstate(invalid='ignore'):
+        mu_norm = _finite((mu - np.polyval(pre, energy)) / edge_step)
+    return e0, edge_step, mu_norm
+
+
+def common_grid(series, points):
+    # resamples a list of (x, y) onto points evenly spaced values of x spanning all of them.
+    # returns the grid and a len(series) x points matrix, with nan where a series does not reach
+    cleaned = []
+    for x, y in series:
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        finite = np.isfinite(x) & np.isfinite(y)
+        order = np.argsort(x[finite], kind='stable')
+        cleaned.append((x[finite][order], y[finite][order]))
+    starts = [x[0] for x, _ in cleaned if len(x)]
+    if not starts:
+        return np.empty(0), np.empty((len(series), 0))
+    grid = np.linspace(min(starts), max(x[-1] for x, _ in cleaned if len(x)), points)
+    values = np.full((len(series), points), np.nan)
+    for i, (x, y) in enumerate(cleaned):
+        if len(x):
+            values[i] = np.interp(grid, x, y, left=np.nan, right=np.nan)
+    return grid, values
@@ -0,0 +1,244 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+
+from .models import XASFile, parse_xdi_upload
+from .utils import StageTimer, extract_xdi_data, store_xdi_data
+
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import os.path
+import random
+import threading
+import time
+
+import numpy as np
+
+# benchmarks and their results, see the benchmark management command
+
+BENCHMARK_DOI = '10.1016/j.sab.2011.09.011'
+BENCHMARK_USERNAME = 'benchmark'
+BENCHMARK_PASSWORD = 'benchmark'
+
+TESTDATA_GOOD = os.path.join(os.path.dirname(__file__), 'testdata', 'good')
+
+
+class CrossrefStub:
+    # stands in for habanero.Crossref, so the numbers do not depend on the network.
+    # latency is in seconds, to see what a slow Crossref does to the views
+    latency = 0.0
+
+    def __init__(self, mailto=None):
+        pass
+
+    def works(self, ids):
+        if CrossrefStub.latency:
+            time.sleep(CrossrefStub.latency)
+        return {'message': {
+            'title': ['The xraylib library for X-ray-matter interactions. Recent developments'],
+            'URL': 'http://dx.doi.org/' + ids,
+            'published-print': {'date-parts': [[2011, 12]]},
+            'short-container-title': ['Spectrochim. Acta Part B At. Spectrosc.'],
+            'is-referenced-by-count': 314,
+            'author': [{'given': 'Tom', 'family': 'Schoonjans'}, {'given': 'Antonio', 'family': 'Brunetti'}],
+        }}
+
+
+def testdata_files():
+    return sorted(glob.glob(os.path.join(TESTDATA_GOOD, '*')))
+
+
+def seed_spectra(nspectra):
+    # stores nspectra approved spectra, cycling through the good test files, each of which is only parsed once
+    user, _ = User.objects.get_or_create(username=BENCHMARK_USERNAME)
+    user.set_password(BENCHMARK_PASSWORD)
+    user.save()
+    parsed = []
+    for path in testdata_files():
+        with open(path, 'rb') as f:
+            content = f.read()
+        name = os.path.basename(path)
+        xdi_file = parse_xdi_upload(SimpleUploadedFile(name, content))
+        parsed.append((name, content, extract_xdi_data(xdi_file, name, StageTimer())))
+    for i in range(nspectra):
+        name, content, data = parsed[i % len(parsed)]
+        xas_file = store_xdi_data(data, ContentFile(content, name=name), BENCHMARK_DOI, user, StageTimer())
+        xas_file.review_status = XASFile.APPROVED
+        xas_file.save(update_fields=['review_status'])
+    return user
+
+
+class Context:
+    # what the views are benchmarked against, shared by all clients
+    def __init__(self):
+        files = list(XASFile.objects.values_list('id', 'element', 'upload_file'))
+        self.file_ids = [file_id for file_id, _, _ in files]
+        self.elements = sorted(set(element for _, element, _ in files))
+        self.upload_files = [upload_file for _, _, upload_file in files]
+        self.testdata_files = testdata_files()
+        # one or two words that are actually in the metadata
+        words = set()
+        for sample_name, beamline_name in XASFile.objects.values_list('sample_name', 'beamline_name').distinct():
+            words.update(word for word in f'{sample_name} {beamline_name}'.split() if len(word) > 1)
+        self.search_words = sorted(words)
+
+
+def _element(client, context, rng):
+    return client.get(reverse('xasdb1:element', args=[rng.choice(context.elements)]))
+
+def _element_popular(client, context, rng):
+    return client.get(reverse('xasdb1:element', args=[rng.choice(context.elements)]), {'sort': 'popular'})
+
+def _file(client, context, rng):
+    return client.get(reverse('xasdb1:file', args=[rng.choice(context.file_ids)]))
+
+def _download(client, context, rng):
+    response = client.get(reverse('xasdb1:download', args=[rng.choice(context.upload_files)]))
+    # the time to stream the file is part of the download
+    if response.streaming:
+        b''.join(response.streaming_content)
+    return response
+
+def _upload(client, context, rng):
+    with open(rng.choice(context.testdata_files), 'rb') as fp:
+        return client.post(reverse('xasdb1:upload'), {
+            'upload_file': fp,
+            'upload_file_doi': BENCHMARK_DOI,
+            'form-TOTAL_FORMS': '0',
+            'form-INITIAL_FORMS': '0',
+            'form-MAX_NUM_FORMS': '10',
+            'form-MIN_NUM_FORMS': '0',
+        })
+
+def _search(client, context, rng):
+    return client.get(reverse('xasdb1:search'), {'q': ' '.join(rng.sample(context.search_words, min(rng.randint(1, 2), len(context.search_words))))})
+
+def _arrays(client, context, rng):
+    return client.get(reverse('xasdb1:api_file_arrays', args=[rng.choice(context.file_ids)]))
+
+def _similar(client, context, rng):
+    return client.get(reverse('xasdb1:similar', args=[rng.choice(context.file_ids)]))
+
+def _compare(client, context, rng):
+    return client.get(reverse('xasdb1:compare'), {'id': rng.sample(context.file_ids, min(5, len(context.file_ids)))})
+
+def _export(client, context, rng):
+    response = client.get(reverse('xasdb1:export'), {'id': rng.sample(context.file_ids, min(20, len(context.file_ids)))})
+    # as for the download, streaming the zip is part of the export
+    if response.streaming:
+        b''.join(response.streaming_content)
+    return response
+
+# name -> (request, expected status codes)
+BENCHMARK_VIEWS = {
+    'element': (_element, (200,)),
+    'element_popular': (_element_popular, (200,)),
+    'file': (_file, (200,)),
+    'download': (_download, (200,)),
+    'upload': (_upload, (302,)),
+    'search': (_search, (200,)),
+    'arrays': (_arrays, (200,)),
+    'similar': (_similar, (200,)),
+    'compare': (_compare, (200,)),
+    'export': (_export, (200,)),
+}
+DEFAULT_BENCHMARK_VIEWS = ('element', 'file', 'download', 'upload', 'search')
+
+
+def percentiles(values, ps=(50, 95, 99)):
+    if not values:
+        return dict((f'p{p}', None) for p in ps)
+    return dict((f'p{p}', float(np.percentile(values, p))) for p in ps)
+
+
+def _client_run(view, context, nrequests, warmup, seed, barrier):
+    request, expected = BENCHMARK_VIEWS[view]
+    rng = random.Random(seed)
+    latencies = []
+    queries = []
+    errors = 0
+    count = [0]
+
+    def counter(execute, sql, params, many, execute_context):
+        count[0] += 1
+        return execute(sql, params, many, execute_context)
+
+    try:
+        try:
+            client = Client()
+            client.login(username=BENCHMARK_USERNAME, password=BENCHMARK_PASSWORD)
+            for i in range(warmup):
+                request(client, context, rng)
+        finally:
+            barrier.wait()
+        for i in range(nrequests):
+            count[0] = 0
+            start = time.perf_counter()
+            with connection.execute_wrapper(counter):
+                response = request(client, context, rng)
+            latencies.append(time.perf_counter() - start)
+            queries.append(count[0])
+            if response.status_code not in expected:
+                errors += 1
+    finally:
+        # every client thread has its own connection
+        connection.close()
+    return latencies, queries, errors
+
+
+def benchmark_view(view, context, clients, nrequests, warmup=0, seed=0):
+    # nrequests requests shared by clients concurrent clients, after warmup requests by each of them. latencies are in ms
+    share = [nrequests // clients + (1 if i < nrequests % clients else 0) for i in range(clients)]
+    barrier = threading.Barrier(clients + 1)
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        futures = [executor.submit(_client_run, view, context, n, warmup, seed + i, barrier) for i, n in enumerate(share)]
+        # the clock starts once all clients are warmed up
+        barrier.wait()
+        start = time.perf_counter()
+        results = [future.result() for future in futures]
+    duration = time.perf_counter() - start
+    latencies = [latency * 1000 for result in results for latency in result[0]]
+    queries = [n for result in results for n in result[1]]
+    return dict(
+        requests=len(latencies),
+        errors=sum(result[2] for result in results),
+        duration=duration,
+        throughput=len(latencies) / duration if duration else None,
+        latency=dict(mean=float(np.mean(latencies)) if latencies else None, max=max(latencies, default=None), **percentiles(latencies)),
+        queries=dict(mean=float(np.mean(queries)) if queries else None, max=max(queries, default=None)),
+    )
+
+
+def run_benchmark(nspectra, clients, nrequests, views=DEFAULT_BENCHMARK_VIEWS, warmup=0, seed=0):
+    # expects an empty database: see the benchmark management command
+    start = time.perf_counter()
+    seed_spectra(nspectra)
+    seed_duration = time.perf_counter() - start
+    context = Context()
+    results = dict()
+    for view in views:
+        results[view] = benchmark_view(view, context, clients, nrequests, warmup=warmup, seed=seed)
+    return dict(
+        parameters=dict(spectra=nspectra, clients=clients, requests=nrequests, warmup=warmup, seed=seed, crossref_latency=CrossrefStub.latency),
+        environment=dict(database=connection.vendor, debug=settings.DEBUG),
+        seed_duration=seed_duration,
+        views=results,
+    )
+
+
+def compare(results, baseline):
+    # relative change of the p95 latency and the mean number of queries per view, for the views in both runs
+    changes = dict()
+    for view, result in results['views'].items():
+        if view not in baseline.get('views', {}):
+            continue
+        base = baseline['views'][view]
+        change = dict()
+        for key, current, previous in (('p95', result['latency']['p95'], base['latency']['p95']), ('queries', result['queries']['mean'], base['queries']['mean'])):
+            change[key] = (current - previous) / previous if current is not None and previous else None
+        changes[view] = change
+    return changes
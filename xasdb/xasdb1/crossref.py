@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.db import connection, IntegrityError
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import XASDOIMetadata
+from .instrumentation import timed
+
+from datetime import timedelta
+import json
+import logging
+import threading
+import requests
+
+logger = logging.getLogger(__name__)
+
+# DOIs currently being refreshed in the background by this process
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+class InvalidDOI(Exception):
+    pass
+
+
+def _is_transient(e):
+    # network trouble and server side errors say nothing about the DOI itself
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code >= 500:
+        return True
+    return False
+
+
+def _fetch(doi):
+    cr = import_string(settings.XASDB_CROSSREF_CLIENT)(mailto=settings.XASDB_CROSSREF_MAILTO)
+    try:
+        with timed('crossref'):
+            work = cr.works(ids=doi)
+        work['message']['title']
+        return work['message'], ''
+    except Exception as e:
+        if _is_transient(e):
+            raise
+        return None, str(e)
+
+
+def refresh_work(doi):
+    work, error = _fetch(doi)
+    now = timezone.now()
+    ttl = settings.XASDB_CROSSREF_NEGATIVE_TTL if error else settings.XASDB_CROSSREF_TTL
+    defaults = dict(work=json.dumps(work) if work else '', error=error, fetched_timestamp=now, expires_timestamp=now + timedelta(seconds=ttl))
+    try:
+        entry, _ = XASDOIMetadata.objects.update_or_create(doi=doi, defaults=defaults)
+    except IntegrityError:
+        # another process stored it first: ours is just as fresh
+        entry = XASDOIMetadata(doi=doi, **defaults)
+    return entry
+
+
+def _refresh_in_background(doi):
+    try:
+        refresh_work(doi)
+    except Exception as e:
+        logger.warning(f'Could not refresh Crossref metadata for {doi}: {e}')
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(doi)
+        connection.close()
+
+
+def _revalidate(doi):
+    if not settings.XASDB_CROSSREF_BACKGROUND_REFRESH:
+        try:
+            refresh_work(doi)
+        except Exception as e:
+            logger.warning(f'Could not refresh Crossref metadata for {doi}: {e}')
+        return
+
+    with _refreshing_lock:
+        if doi in _refreshing:
+            return
+        _refreshing.add(doi)
+    threading.Thread(target=_refresh_in_background, args=(doi,), daemon=True).start()
+
+
+def _unpack(entry):
+    if not entry.valid:
+        raise InvalidDOI(entry.error)
+    return json.loads(entry.work)
+
+
+def get_work(doi):
+    # returns the Crossref message for the DOI, raises InvalidDOI if Crossref does not know about it.
+    # fresh entries are served from the database, stale ones are served while being refreshed,
+    # and anything else is fetched right away.
+    now = timezone.now()
+    entry = XASDOIMetadata.objects.filter(doi=doi).first()
+
+    if entry is not None and now < entry.expires_timestamp:
+        return _unpack(entry)
+
+    if entry is not None and entry.valid and now < entry.expires_timestamp + timedelta(seconds=settings.XASDB_CROSSREF_STALE_TTL):
+        _revalidate(doi)
+        return _unpack(entry)
+
+    try:
+        entry = refresh_work(doi)
+    except Exception:
+        # Crossref is unreachable: old metadata beats no metadata
+        if entry is not None and entry.valid:
+            return _unpack(entry)
+        raise
+    return _unpack(entry)
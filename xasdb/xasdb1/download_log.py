@@ -0,0 +1,173 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import XASFile, XASUploadAuxData, XASDownloadFile, XASDownloadAuxData
+from .download_stats import record_downloads
+
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# download events are appended to a spool file per process, and turned into XASDownloadFile and XASDownloadAuxData rows
+# with bulk inserts once XASDB_DOWNLOAD_LOG_BATCH_SIZE events are waiting or the oldest one is XASDB_DOWNLOAD_LOG_FLUSH_INTERVAL
+# seconds old. whatever is left behind by processes that died is picked up by the flush_download_log management command.
+# events may be recorded twice if a process dies between a bulk insert and removing its spool file, but they are never lost.
+
+DOWNLOAD_MODELS = {
+    'file': (XASDownloadFile, XASFile),
+    'aux': (XASDownloadAuxData, XASUploadAuxData),
+}
+
+_pending_lock = threading.Lock()
+_pending = dict(count=0, oldest=None)
+
+
+def _spool_path():
+    # the pid changes after a fork, and so does the spool file
+    return os.path.join(settings.XASDB_DOWNLOAD_LOG_DIR, f'downloads.{os.getpid()}.log')
+
+
+def _append(line):
+    path = _spool_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    while True:
+        with open(path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # the file may have been claimed by a flush between opening and locking it: start over with a new one
+                if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+                    continue
+            except FileNotFoundError:
+                continue
+            f.write(line)
+            f.flush()
+            return
+
+
+def log_download(kind, file_id, downloader_id):
+    # kind is 'file' or 'aux'
+    log_downloads([(kind, file_id)], downloader_id)
+
+
+def log_downloads(downloads, downloader_id):
+    # [(kind, file id)] downloaded together, such as the contents of an export: a single append to the spool
+    for kind, _ in downloads:
+        if kind not in DOWNLOAD_MODELS:
+            raise ValueError(f'Unknown download kind {kind}')
+    if not downloads:
+        return
+    timestamp = timezone.now().isoformat()
+    _append(''.join(json.dumps(dict(kind=kind, file=file_id, downloader=downloader_id, timestamp=timestamp)) + '\n' for kind, file_id in downloads))
+    with _pending_lock:
+        _pending['count'] += len(downloads)
+        if _pending['oldest'] is None:
+            _pending['oldest'] = time.monotonic()
+        due = _pending['count'] >= settings.XASDB_DOWNLOAD_LOG_BATCH_SIZE or time.monotonic() - _pending['oldest'] >= settings.XASDB_DOWNLOAD_LOG_FLUSH_INTERVAL
+        if due:
+            _pending['count'] = 0
+            _pending['oldest'] = None
+    if due:
+        try:
+            flush()
+        except Exception as e:
+            # the events are still in the spool, the next flush will have another go
+            logger.warning(f'Could not flush the download log: {e}')
+
+
+def _claim(path):
+    # renaming the spool file keeps new events out of it, the lock waits for writers that got in before that
+    claimed = f'{path}.{uuid.uuid4().hex}.flushing'
+    try:
+        os.rename(path, claimed)
+    except FileNotFoundError:
+        return None
+    return claimed
+
+
+def _store(lines):
+    events = dict((kind, []) for kind in DOWNLOAD_MODELS)
+    for line in lines:
+        try:
+            event = json.loads(line)
+            events[event['kind']].append(event)
+        except (ValueError, KeyError) as e:
+            # a half written line of a process that died mid-write
+            logger.warning(f'Skipping invalid download log entry {line!r}: {e}')
+
+    count = 0
+    with transaction.atomic():
+        downloader_ids = set(User.objects.filter(id__in=set(event['downloader'] for kind_events in events.values() for event in kind_events)).values_list('id', flat=True))
+        for kind, kind_events in events.items():
+            if not kind_events:
+                continue
+            download_model, file_model = DOWNLOAD_MODELS[kind]
+            # files deleted in the meantime take their downloads with them, like the foreign key would have done
+            file_ids = set(file_model.objects.filter(id__in=set(event['file'] for event in kind_events)).values_list('id', flat=True))
+            downloads = [download_model(
+                file_id=event['file'],
+                downloader_id=event['downloader'] if event['downloader'] in downloader_ids else None,
+                download_timestamp=parse_datetime(event['timestamp'])) for event in kind_events if event['file'] in file_ids]
+            record_downloads(kind, downloads)
+            download_model.objects.bulk_create(downloads, batch_size=500)
+            count += len(downloads)
+    return count
+
+
+def _flush_claimed(claimed, blocking=True):
+    with open(claimed, 'r+') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # someone else is flushing it
+            return 0
+        if os.fstat(f.fileno()).st_nlink == 0:
+            # and is already done with it
+            return 0
+        count = _store(f.read().splitlines())
+        os.unlink(claimed)
+    return count
+
+
+def flush():
+    # stores the events of this process, returns their number
+    claimed = _claim(_spool_path())
+    if claimed is None:
+        return 0
+    return _flush_claimed(claimed)
+
+
+def drain():
+    # stores the events of every process, including those that are gone
+    count = 0
+    for path in glob.glob(os.path.join(settings.XASDB_DOWNLOAD_LOG_DIR, 'downloads.*.log')):
+        claimed = _claim(path)
+        if claimed is not None:
+            count += _flush_claimed(claimed)
+    # left behind by flushes that were interrupted
+    for claimed in glob.glob(os.path.join(settings.XASDB_DOWNLOAD_LOG_DIR, 'downloads.*.flushing')):
+        try:
+            count += _flush_claimed(claimed, blocking=False)
+        except FileNotFoundError:
+            pass
+    return count
+
+
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception as e:
+        logger.warning(f'Could not flush the download log at exit, run the flush_download_log command: {e}')
+
+
+atexit.register(_flush_at_exit)
@@ -0,0 +1,112 @@
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import XASDownloadFile, XASDownloadAuxData, XASFileDownloadStats, XASAuxDownloadStats, XASFileDownloadDay, XASAuxDownloadDay
+
+from collections import Counter
+from datetime import datetime, time, timedelta
+import logging
+
+logger = logging.getLogger(__name__)
+
+# kind -> (download events, counters, downloads per day). the kinds are those of download_log
+DOWNLOAD_STATS_MODELS = {
+    'file': (XASDownloadFile, XASFileDownloadStats, XASFileDownloadDay),
+    'aux': (XASDownloadAuxData, XASAuxDownloadStats, XASAuxDownloadDay),
+}
+
+# rolling window counter -> number of days, today included
+DOWNLOAD_WINDOWS = {
+    'downloads_7_days': 7,
+    'downloads_30_days': 30,
+}
+DOWNLOAD_DAYS_KEPT = max(DOWNLOAD_WINDOWS.values())
+
+
+def _windows(day_model, today, file_ids=None):
+    # the rolling window counters, from the downloads per day
+    days = day_model.objects.filter(day__gt=today - timedelta(days=DOWNLOAD_DAYS_KEPT))
+    if file_ids is not None:
+        days = days.filter(file_id__in=file_ids)
+    aggregates = dict((name, Sum('downloads', filter=Q(day__gt=today - timedelta(days=ndays)))) for name, ndays in DOWNLOAD_WINDOWS.items())
+    return dict((row['file_id'], dict((name, row[name] or 0) for name in DOWNLOAD_WINDOWS)) for row in days.values('file_id').annotate(**aggregates))
+
+
+def record_downloads(kind, downloads):
+    # updates the counters with download events that are about to be inserted:
+    # must be called in the same transaction, right before the insert
+    if not downloads:
+        return
+    download_model, stats_model, day_model = DOWNLOAD_STATS_MODELS[kind]
+    today = timezone.localdate()
+    file_ids = set(download.file_id for download in downloads)
+
+    # concurrent flushes of the same files wait for each other here
+    stats_model.objects.bulk_create([stats_model(file_id=file_id) for file_id in file_ids], ignore_conflicts=True)
+    stats = list(stats_model.objects.select_for_update().filter(file_id__in=file_ids).order_by('file_id'))
+
+    pairs = set((download.file_id, download.downloader_id) for download in downloads if download.downloader_id is not None)
+    if pairs:
+        pairs -= set(download_model.objects.filter(file_id__in=file_ids, downloader_id__in=set(downloader_id for _, downloader_id in pairs)).values_list('file_id', 'downloader_id').distinct())
+    totals = Counter(download.file_id for download in downloads)
+    uniques = Counter(file_id for file_id, _ in pairs)
+
+    per_day = Counter((download.file_id, timezone.localdate(download.download_timestamp)) for download in downloads)
+    per_day = dict((key, count) for key, count in per_day.items() if (today - key[1]).days < DOWNLOAD_DAYS_KEPT)
+    if per_day:
+        day_model.objects.bulk_create([day_model(file_id=file_id, day=day) for file_id, day in per_day], ignore_conflicts=True)
+        days = [day for day in day_model.objects.select_for_update().filter(file_id__in=file_ids, day__in=set(day for _, day in per_day)).order_by('file_id', 'day') if (day.file_id, day.day) in per_day]
+        for day in days:
+            day.downloads += per_day[(day.file_id, day.day)]
+        day_model.objects.bulk_update(days, ['downloads'])
+
+    windows = _windows(day_model, today, file_ids)
+    for stat in stats:
+        stat.total_downloads += totals[stat.file_id]
+        stat.unique_downloaders += uniques[stat.file_id]
+        for name, value in windows.get(stat.file_id, dict.fromkeys(DOWNLOAD_WINDOWS, 0)).items():
+            setattr(stat, name, value)
+    stats_model.objects.bulk_update(stats, ['total_downloads', 'unique_downloaders', *DOWNLOAD_WINDOWS])
+
+
+def refresh_download_stats(today=None):
+    # the rolling windows move on even without downloads: run this once a day.
+    # returns the number of counters that changed
+    today = today or timezone.localdate()
+    count = 0
+    for kind, (download_model, stats_model, day_model) in DOWNLOAD_STATS_MODELS.items():
+        with transaction.atomic():
+            day_model.objects.filter(day__lte=today - timedelta(days=DOWNLOAD_DAYS_KEPT)).delete()
+            windows = _windows(day_model, today)
+            # only counters that are not zero can go down
+            nonzero = Q()
+            for name in DOWNLOAD_WINDOWS:
+                nonzero |= Q(**{f'{name}__gt': 0})
+            changed = []
+            for stat in stats_model.objects.select_for_update().filter(nonzero | Q(file_id__in=windows.keys())):
+                values = windows.get(stat.file_id, dict.fromkeys(DOWNLOAD_WINDOWS, 0))
+                if any(getattr(stat, name) != value for name, value in values.items()):
+                    for name, value in values.items():
+                        setattr(stat, name, value)
+                    changed.append(stat)
+            stats_model.objects.bulk_update(changed, list(DOWNLOAD_WINDOWS), batch_size=500)
+            count += len(changed)
+    return count
+
+
+def rebuild_download_stats():
+    # recomputes all counters from the download events, for databases that have download events from before the counters
+    today = timezone.localdate()
+    start = timezone.make_aware(datetime.combine(today - timedelta(days=DOWNLOAD_DAYS_KEPT - 1), time.min))
+    for kind, (download_model, stats_model, day_model) in DOWNLOAD_STATS_MODELS.items():
+        with transaction.atomic():
+            stats_model.objects.all().delete()
+            day_model.objects.all().delete()
+            days = download_model.objects.filter(download_timestamp__gte=start).annotate(day=TruncDate('download_timestamp')).values('file_id', 'day').annotate(downloads=Count('id'))
+            day_model.objects.bulk_create([day_model(**row) for row in days], batch_size=500)
+            windows = _windows(day_model, today)
+            totals = download_model.objects.values('file_id').annotate(total_downloads=Count('id'), unique_downloaders=Count('downloader', distinct=True))
+            stats_model.objects.bulk_create([stats_model(**row, **windows.get(row['file_id'], {})) for row in totals], batch_size=500)
+            logger.info(f'rebuilt {kind} download counters of {len(totals)} files')
@@ -0,0 +1,109 @@
+from django.urls import reverse
+from django.utils import timezone
+
+import csv
+import io
+import logging
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+# bytes read from the storage at a time: together with the compressor state, this is about all an export holds in memory
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+MANIFEST_NAME = 'manifest.csv'
+MANIFEST_FIELDS = ('id', 'path', 'element', 'edge', 'sample_name', 'beamline', 'facility', 'doi', 'url')
+
+
+class _Sink:
+    # where zipfile writes to: whatever it wrote since the last drain is handed out as the next chunk of the response.
+    # it cannot tell or seek, so zipfile puts the sizes and checksums in data descriptors after each member
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _stored(field):
+    if field.storage.exists(field.name):
+        return True
+    logger.warning(f'Could not export {field.name}: not found in the storage')
+    return False
+
+
+def stored_selection(files, aux_files):
+    # the files and aux files that are still in the storage: only those are exported, listed in the manifest and logged.
+    # the aux files of a spectrum that has gone missing are left out with it
+    stored_files = []
+    stored_aux_files = dict()
+    for file in files:
+        if not _stored(file.upload_file):
+            continue
+        stored_files.append(file)
+        stored_aux_files[file.id] = [aux for aux in aux_files.get(file.id, []) if _stored(aux.aux_file)]
+    return stored_files, stored_aux_files
+
+
+def export_members(files, aux_files):
+    # [(arcname, field file)] of the spectra and, under aux/, their aux files. aux_files is file id -> [XASUploadAuxData]
+    members = []
+    for file in files:
+        folder = '{}/{}/'.format(file.element, file.id)
+        members.append((folder + file.name, file.upload_file))
+        for aux in aux_files.get(file.id, []):
+            members.append((folder + 'aux/' + aux.name, aux.aux_file))
+    return members
+
+
+def export_manifest(files):
+    from .views import HOST # avoid circular import
+    manifest = io.StringIO()
+    writer = csv.writer(manifest)
+    writer.writerow(MANIFEST_FIELDS)
+    for file in files:
+        writer.writerow((file.id, '{}/{}/{}'.format(file.element, file.id, file.name), file.element, file.get_edge_display(),
+            file.sample_name, file.beamline_name, file.facility_name, file.upload_file_doi, HOST + reverse('xasdb1:file', args=[file.id])))
+    return manifest.getvalue().encode('utf-8')
+
+
+def stream_zip(members, manifest=None):
+    # yields a zip of members, [(arcname, field file)], read from the storage one chunk at a time, with manifest (bytes) as the last member.
+    # nothing is written to disk. files that disappear from the storage while the zip is streamed are left out
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        for arcname, field in members:
+            try:
+                storage_file = field.storage.open(field.name, 'rb')
+            except OSError as e:
+                logger.warning(f'Could not export {field.name}: {e}')
+                continue
+            with storage_file:
+                info = zipfile.ZipInfo(arcname, date_time=timezone.localtime(field.storage.get_modified_time(field.name)).timetuple()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                # lets zipfile decide up front whether the member needs zip64
+                info.file_size = field.storage.size(field.name)
+                with zip_file.open(info, 'w') as member:
+                    for chunk in iter(lambda: storage_file.read(EXPORT_CHUNK_SIZE), b''):
+                        member.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+            data = sink.drain()
+            if data:
+                yield data
+        if manifest is not None:
+            zip_file.writestr(MANIFEST_NAME, manifest)
+    # the central directory
+    data = sink.drain()
+    if data:
+        yield data
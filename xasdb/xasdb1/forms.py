@@ -4,7 +4,8 @@ from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.hashers import check_password
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
-from .models import XASFile, XASUploadAuxData
+from .models import XASFile, XASUploadAuxData, archive_size_valid, doi_valid, file_size_valid, xdi_valid
+from .archive import check_archive, InvalidArchive
 
 class XASFileSubmissionForm(ModelForm):
     class Meta:
@@ -14,6 +15,22 @@ class XASFileSubmissionForm(ModelForm):
                 "upload_file_doi": TextInput(attrs={'onkeyup': "getDOI(this.value)"})
         }
 
+class XASArchiveSubmissionForm(Form):
+    archive_file = FileField(label='Archive', help_text='zip or tar archive of XDI files', validators=[archive_size_valid])
+    upload_file_doi = CharField(label='Citation DOI', max_length=256, validators=[doi_valid], widget=TextInput(attrs={'onkeyup': "getDOI(this.value)"}))
+
+    def clean_archive_file(self):
+        archive_file = self.cleaned_data['archive_file']
+        try:
+            check_archive(archive_file)
+        except InvalidArchive as e:
+            raise ValidationError(str(e))
+        return archive_file
+
+class XASSimilaritySearchForm(Form):
+    # the spectrum is only parsed, it does not end up in the database
+    upload_file = FileField(label='XDI file', validators=[file_size_valid, xdi_valid])
+
 class XASFileVerificationForm(ModelForm):
     class Meta:
         model = XASFile
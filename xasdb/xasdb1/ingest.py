@@ -0,0 +1,211 @@
+from django.conf import settings
+from django.core.files import File
+from django.core.mail import mail_admins
+from django.db import transaction
+from django.db.models import F
+from django.urls import reverse
+from django.utils import timezone
+
+from .archive import ingest_archive, notify_admins_of_archive
+from .models import XASIngestJob, XASIngestJobAuxData, XASIngestJobMember
+from .utils import process_xdi_file
+
+from datetime import timedelta
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def ingest_upload(upload_file, upload_file_doi, uploader, aux):
+    # aux is a sequence of (description, file) pairs
+    xas_file = process_xdi_file(upload_file, upload_file_doi, uploader)
+    # add auxiliary data, kept on the file in case its files have to be deleted again
+    xas_file.ingested_aux = []
+    for aux_description, aux_file in aux:
+        try:
+            with transaction.atomic():
+                xas_file.ingested_aux.append(xas_file.xasuploadauxdata_set.create(aux_description=aux_description, aux_file=aux_file))
+        except Exception as e:
+            logger.warning(f'Could not add auxiliary data {aux_file.name} to file {xas_file.id}: {e}')
+    return xas_file
+
+
+def notify_admins(xas_file, uploader):
+    from .views import HOST # avoid circular import
+    # send email to maintainers
+    mail_admins( \
+        'a new dataset has been uploaded', \
+        'A new dataset has been uploaded by {} ({}).\nPlease process this submission by visiting {}.'.format(uploader.get_full_name(), uploader.email, HOST + reverse('xasdb1:file', args=[xas_file.id])))
+
+
+def enqueue_upload(upload_file, upload_file_doi, uploader, aux):
+    # store the upload and its aux data where the worker can find them, and leave the rest to it
+    with transaction.atomic():
+        job = XASIngestJob(upload_name=upload_file.name, upload_file_doi=upload_file_doi, uploader=uploader)
+        job.upload_file.save(upload_file.name, upload_file, save=False)
+        job.save()
+        for aux_description, aux_file in aux:
+            job_aux = XASIngestJobAuxData(job=job, aux_description=aux_description, aux_name=aux_file.name)
+            job_aux.aux_file.save(aux_file.name, aux_file, save=False)
+            job_aux.save()
+    logger.info(f'queued ingest job {job.id} ({job.upload_name})')
+    return job
+
+
+def enqueue_archive(archive_file, upload_file_doi, uploader, queued=True):
+    # the members are parsed and stored by the worker, which reports on them in the job's XASIngestJobMember rows.
+    # with queued False there is no worker: the job is created as claimed, for the caller to run it with run_archive_job
+    job = XASIngestJob(upload_name=archive_file.name, upload_file_doi=upload_file_doi, uploader=uploader, is_archive=True)
+    if not queued:
+        job.status = XASIngestJob.RUNNING
+        job.attempts = 1
+        job.claimed_timestamp = timezone.now()
+    job.upload_file.save(archive_file.name, archive_file, save=False)
+    job.save()
+    logger.info(f'queued archive ingest job {job.id} ({job.upload_name})')
+    return job
+
+
+def reclaim_stale_jobs():
+    # jobs whose worker died while running them go back into the queue, unless that was their last attempt:
+    # an upload that takes the worker down with it would otherwise be retried forever
+    stale = timezone.now() - timedelta(seconds=settings.XASDB_INGEST_STALE_TIMEOUT)
+    jobs = XASIngestJob.objects.filter(status=XASIngestJob.RUNNING, claimed_timestamp__lt=stale)
+    for job in jobs.filter(attempts__gte=settings.XASDB_INGEST_MAX_ATTEMPTS):
+        job.error = 'The worker died while processing this upload'
+        job.finished_timestamp = timezone.now()
+        # unless another worker got to it first
+        if XASIngestJob.objects.filter(id=job.id, status=XASIngestJob.RUNNING).update(status=XASIngestJob.FAILED, error=job.error, finished_timestamp=job.finished_timestamp):
+            _notify_failed(job)
+    count = jobs.update(status=XASIngestJob.QUEUED, run_after=timezone.now())
+    if count:
+        logger.warning(f'reclaimed {count} stale ingest jobs')
+    return count
+
+
+def claim_job():
+    # the filtered update makes sure only one worker gets to run a job, without any locking
+    now = timezone.now()
+    candidates = XASIngestJob.objects.filter(status=XASIngestJob.QUEUED, run_after__lte=now).order_by('run_after', 'id').values_list('id', flat=True)[:10]
+    for job_id in candidates:
+        if XASIngestJob.objects.filter(id=job_id, status=XASIngestJob.QUEUED).update(status=XASIngestJob.RUNNING, claimed_timestamp=now, attempts=F('attempts') + 1):
+            return XASIngestJob.objects.get(id=job_id)
+    return None
+
+
+def _delete_staged_files(job):
+    # the job itself is kept around for its status page
+    for job_aux in job.xasingestjobauxdata_set.all():
+        job_aux.aux_file.delete()
+    job.upload_file.delete()
+
+
+def _delete_ingested_files(xas_file):
+    # what ingest_upload wrote to MEDIA_ROOT for a file whose transaction was rolled back
+    for aux in xas_file.ingested_aux:
+        for field in (aux.aux_file, aux.aux_thumbnail, aux.aux_image):
+            if field:
+                field.delete(save=False)
+    xas_file.upload_file.delete(save=False)
+
+
+def _notify_failed(job):
+    logger.error(f'ingest job {job.id} ({job.upload_name}) failed after {job.attempts} attempts: {job.error}')
+    try:
+        mail_admins('an upload could not be processed', f'Ingest job {job.id} ({job.upload_name}) failed after {job.attempts} attempts: {job.error}')
+    except Exception as mail_error:
+        logger.warning(f'Could not notify admins of failed ingest job {job.id}: {mail_error}')
+
+
+def _job_failed(job, e, retry=True):
+    job.error = str(e)
+    if retry and job.attempts < settings.XASDB_INGEST_MAX_ATTEMPTS:
+        # exponential backoff
+        job.status = XASIngestJob.QUEUED
+        job.run_after = timezone.now() + timedelta(seconds=settings.XASDB_INGEST_RETRY_DELAY * 2 ** (job.attempts - 1))
+        logger.warning(f'ingest job {job.id} ({job.upload_name}) failed on attempt {job.attempts}, retrying after {job.run_after}: {e}')
+    else:
+        job.status = XASIngestJob.FAILED
+        job.finished_timestamp = timezone.now()
+        _notify_failed(job)
+    job.save(update_fields=['error', 'status', 'run_after', 'finished_timestamp'])
+    return job
+
+
+def run_archive_job(job, retry=True):
+    # every member is committed on its own: a job that is run again, after its worker died, skips those that were stored already.
+    # without retry, a job that fails is not queued again
+    stored = set(job.xasingestjobmember_set.filter(file__isnull=False).values_list('name', flat=True))
+    job.xasingestjobmember_set.filter(file__isnull=True).delete()
+
+    def record(entry):
+        XASIngestJobMember.objects.create(job=job, index=entry['index'], name=entry['name'], file=entry['file'], error=entry['error'] or '')
+
+    try:
+        with job.upload_file.open('rb') as archive:
+            ingest_archive(archive, job.upload_file_doi, job.uploader, skip=stored, on_entry=record)
+    except Exception as e:
+        return _job_failed(job, e, retry=retry)
+
+    job.status = XASIngestJob.DONE
+    job.finished_timestamp = timezone.now()
+    job.error = ''
+    job.save(update_fields=['status', 'finished_timestamp', 'error'])
+    _delete_staged_files(job)
+    try:
+        notify_admins_of_archive([dict(name=member.name, file=member.file, error=member.error) for member in job.xasingestjobmember_set.select_related('file')], job.upload_name, job.uploader)
+    except Exception as e:
+        logger.warning(f'Could not notify admins of archive job {job.id}: {e}')
+    return job
+
+
+def run_job(job):
+    if job.is_archive:
+        return run_archive_job(job)
+    aux_set = list(job.xasingestjobauxdata_set.all())
+    xas_file = None
+    try:
+        with job.upload_file.open('rb') as upload_file:
+            aux_files = []
+            try:
+                for job_aux in aux_set:
+                    aux_files.append((job_aux.aux_description, File(job_aux.aux_file.open('rb'), name=job_aux.aux_name)))
+                # the job is marked as done in the same transaction that creates the file: a crashing worker cannot ingest it twice
+                with transaction.atomic():
+                    xas_file = ingest_upload(File(upload_file, name=job.upload_name), job.upload_file_doi, job.uploader, aux_files)
+                    job.file = xas_file
+                    job.status = XASIngestJob.DONE
+                    job.finished_timestamp = timezone.now()
+                    job.error = ''
+                    job.save(update_fields=['file', 'status', 'finished_timestamp', 'error'])
+            finally:
+                for _, aux_file in aux_files:
+                    aux_file.close()
+    except Exception as e:
+        if xas_file is not None:
+            # rolled back: every attempt would leave another copy behind
+            try:
+                _delete_ingested_files(xas_file)
+            except Exception as delete_error:
+                logger.warning(f'Could not delete the files of rolled back ingest job {job.id}: {delete_error}')
+        return _job_failed(job, e)
+
+    _delete_staged_files(job)
+    try:
+        notify_admins(xas_file, job.uploader)
+    except Exception as e:
+        logger.warning(f'Could not notify admins of file {xas_file.id}: {e}')
+    return job
+
+
+def run_pending_jobs(limit=None):
+    # runs jobs until the queue is empty, returns the number of jobs run
+    reclaim_stale_jobs()
+    count = 0
+    while limit is None or count < limit:
+        job = claim_job()
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
@@ -0,0 +1,121 @@
+from django.conf import settings
+from django.db import connections
+from django.template.backends import django as django_backend
+
+from collections import Counter, OrderedDict
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+import json
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# per-request metrics, see InstrumentationMiddleware. None when the request is not sampled
+_metrics = ContextVar('xasdb1_request_metrics', default=None)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = Counter()
+        # time per external call or phase, see timed
+        self.timings = OrderedDict()
+
+    def __call__(self, execute, sql, params, many, context):
+        # execute_wrapper: this has to stay cheap, it runs for every query
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            self.statements[hash((sql, repr(params)))] += 1
+
+    @property
+    def duplicates(self):
+        # the same query with the same parameters: a sign of a missing select_related or cache
+        return sum(count - 1 for count in self.statements.values())
+
+
+@contextmanager
+def timed(name):
+    # adds the time spent in the block to the metrics of the current request, if it is sampled
+    metrics = _metrics.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timings[name] = metrics.timings.get(name, 0.0) + time.perf_counter() - start
+
+
+class _Template(django_backend.Template):
+    def render(self, context=None, request=None):
+        with timed('render'):
+            return super().render(context, request)
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    # the regular template backend, with the rendering time going into the request metrics
+    def from_string(self, template_code):
+        return _Template(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return _Template(super().get_template(template_name).template, self)
+
+
+def _server_timing(name, seconds, description=None):
+    entry = '{};dur={:.1f}'.format(name, seconds * 1000)
+    if description:
+        entry += ';desc="{}"'.format(description)
+    return entry
+
+
+class InstrumentationMiddleware:
+    # records SQL queries and time spent per phase for a sample of the requests (XASDB_INSTRUMENTATION_SAMPLE_RATE),
+    # and reports them in a Server-Timing header and a log line. requests that are not sampled only pay for a random number
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        rate = settings.XASDB_INSTRUMENTATION_SAMPLE_RATE
+        if not rate or random.random() >= rate:
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = _metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _metrics.reset(token)
+        total = time.perf_counter() - start
+
+        if settings.XASDB_INSTRUMENTATION_SERVER_TIMING:
+            entries = [_server_timing('db', metrics.db_time, f'{metrics.queries} queries ({metrics.duplicates} duplicated)')]
+            entries.extend(_server_timing(name, duration) for name, duration in metrics.timings.items())
+            entries.append(_server_timing('total', total))
+            response['Server-Timing'] = ', '.join(entries)
+
+        match = request.resolver_match
+        record = OrderedDict(
+            method=request.method,
+            path=request.path,
+            view=match.view_name if match else None,
+            status=response.status_code,
+            total_ms=round(total * 1000, 1),
+            queries=metrics.queries,
+            duplicate_queries=metrics.duplicates,
+            db_ms=round(metrics.db_time * 1000, 1),
+        )
+        record.update((f'{name}_ms', round(duration * 1000, 1)) for name, duration in metrics.timings.items())
+        logger.info('request ' + json.dumps(record), extra={'metrics': record})
+        return response
@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+
+from xasdb1.benchmark import BENCHMARK_VIEWS, DEFAULT_BENCHMARK_VIEWS, CrossrefStub, run_benchmark, compare
+
+import json
+import os.path
+import tempfile
+
+
+class Command(BaseCommand):
+    help = 'Seeds a throwaway database with spectra and measures the latency of the main views under concurrent clients.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--spectra', type=int, default=100, help='number of spectra to seed the database with')
+        parser.add_argument('--clients', type=int, default=4, help='number of concurrent clients')
+        parser.add_argument('--requests', type=int, default=200, help='number of requests per view')
+        parser.add_argument('--warmup', type=int, default=5, help='number of requests per client before measuring')
+        parser.add_argument('--views', nargs='+', choices=BENCHMARK_VIEWS.keys(), default=DEFAULT_BENCHMARK_VIEWS)
+        parser.add_argument('--seed', type=int, default=0, help='seed of the random choice of spectra')
+        parser.add_argument('--crossref-latency', type=float, default=0.0, help='seconds the Crossref stub takes to answer')
+        parser.add_argument('--output', help='write the results to this JSON file')
+        parser.add_argument('--baseline', help='compare with the results of an earlier run')
+        parser.add_argument('--max-regression', type=float, help='fail if the p95 latency of a view grew by more than this fraction of the baseline')
+
+    def handle(self, *args, **options):
+        if options['clients'] < 1 or options['requests'] < 1:
+            raise CommandError('--clients and --requests must be positive')
+        if options['max_regression'] is not None and not options['baseline']:
+            raise CommandError('--max-regression needs a --baseline')
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        CrossrefStub.latency = options['crossref_latency']
+        started = timezone.now()
+        with tempfile.TemporaryDirectory() as tempdir:
+            if connection.vendor == 'sqlite':
+                # the clients run in threads with a connection each: they cannot share an in-memory database
+                connection.settings_dict['TEST']['NAME'] = os.path.join(tempdir, 'benchmark.sqlite3')
+            setup_test_environment()
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+            try:
+                with override_settings(
+                        MEDIA_ROOT=os.path.join(tempdir, 'media'),
+                        CACHES={
+                            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                            'plots': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'plots'},
+                            'counts': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'counts'},
+                        },
+                        EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                        XASDB_CROSSREF_CLIENT='xasdb1.benchmark.CrossrefStub',
+                        XASDB_CROSSREF_BACKGROUND_REFRESH=False,
+                        XASDB_DOWNLOAD_LOG_DIR=os.path.join(tempdir, 'spool'),
+                        XASDB_ASYNC_INGEST=False):
+                    results = run_benchmark(options['spectra'], options['clients'], options['requests'], views=options['views'], warmup=options['warmup'], seed=options['seed'])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+        results['started'] = started.isoformat()
+
+        self.stdout.write('{:<16} {:>8} {:>6} {:>8} {:>9} {:>9} {:>9} {:>8}'.format('view', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        for view, result in results['views'].items():
+            latency = result['latency']
+            self.stdout.write('{:<16} {:>8} {:>6} {:>8.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>8.1f}'.format(view, result['requests'], result['errors'], result['throughput'], latency['p50'], latency['p95'], latency['p99'], result['queries']['mean']))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if baseline is not None:
+            regressions = []
+            for view, change in compare(results, baseline).items():
+                self.stdout.write('{:<16} p95 {} queries {}'.format(view, *('{:+.1%}'.format(change[key]) if change[key] is not None else 'n/a' for key in ('p95', 'queries'))))
+                if options['max_regression'] is not None and change['p95'] is not None and change['p95'] > options['max_regression']:
+                    regressions.append(view)
+            if regressions:
+                raise CommandError('p95 latency regressed for {}'.format(', '.join(regressions)))
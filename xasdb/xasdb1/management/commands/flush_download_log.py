@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from xasdb1.download_log import drain
+
+
+class Command(BaseCommand):
+    help = 'Stores the download events that are still waiting in the spool files of all processes.'
+
+    def handle(self, *args, **options):
+        count = drain()
+        self.stdout.write(f'stored {count} download events')
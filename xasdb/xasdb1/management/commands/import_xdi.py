@@ -0,0 +1,186 @@
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from xasdb1.archive import init_worker, error_message, parse_member
+from xasdb1.models import file_size_valid
+from xasdb1.utils import StageTimer, store_xdi_data
+
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+import types
+
+
+def walk(path, extensions):
+    # depth first, in a stable order, skipping hidden files and directories
+    with os.scandir(path) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk(entry.path, extensions)
+        elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+            yield entry.path, entry.stat().st_size
+
+
+def parse_path(path):
+    # runs in a worker process
+    with open(path, 'rb') as f:
+        return parse_member(path, f.read())
+
+
+class Checkpoint:
+    # one line per file already taken care of: "ok<TAB>path" or "failed<TAB>path"
+    def __init__(self, path):
+        self.path = path
+        self.done = dict()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    status, _, file_path = line.rstrip('\n').partition('\t')
+                    self.done[file_path] = status
+
+    def skip(self, path, retry_failed):
+        status = self.done.get(path)
+        return status == 'ok' or (status == 'failed' and not retry_failed)
+
+    def write(self, entries):
+        if not self.path:
+            return
+        with open(self.path, 'a') as f:
+            for path, status in entries:
+                f.write(f'{status}\t{path}\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class Command(BaseCommand):
+    help = 'Imports all XDI files found in a directory tree. Can be interrupted and resumed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='directory to import')
+        parser.add_argument('--doi', default='', help='citation DOI of the imported files')
+        parser.add_argument('--uploader', help='username of the uploader of the imported files')
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of parser processes, 0 parses in this process')
+        parser.add_argument('--batch-size', type=int, default=100, help='number of files inserted per transaction')
+        parser.add_argument('--checkpoint', default='import_xdi.checkpoint', help='file recording what has been imported already, empty to disable')
+        parser.add_argument('--retry-failed', action='store_true', help='retry files that failed in a previous run')
+        parser.add_argument('--extensions', nargs='+', default=['.xdi', '.xmu'], help='extensions of the files to import')
+
+    def handle(self, *args, **options):
+        root = os.path.abspath(options['path'])
+        if not os.path.isdir(root):
+            raise CommandError(f'{root} is not a directory')
+        uploader = None
+        if options['uploader']:
+            try:
+                uploader = User.objects.get(username=options['uploader'])
+            except User.DoesNotExist:
+                raise CommandError('Unknown user {}'.format(options['uploader']))
+        workers = options['workers']
+        batch_size = max(options['batch_size'], 1)
+        extensions = set(extension.lower() for extension in options['extensions'])
+        checkpoint = Checkpoint(options['checkpoint'])
+
+        self.verbosity = options['verbosity']
+        self.timings = OrderedDict()
+        self.counts = dict(ok=0, failed=0, skipped=0, bytes=0)
+        self.start = time.perf_counter()
+        batch = []
+
+        def candidates():
+            for path, size in walk(root, extensions):
+                if checkpoint.skip(path, options['retry_failed']):
+                    self.counts['skipped'] += 1
+                    continue
+                try:
+                    file_size_valid(types.SimpleNamespace(size=size))
+                except Exception as e:
+                    self.fail(path, e)
+                    checkpoint.write([(path, 'failed')])
+                    continue
+                self.counts['bytes'] += size
+                yield path
+
+        def collect(path, result, error):
+            batch.append((path, result, error))
+            if len(batch) >= batch_size:
+                self.insert(batch, options['doi'], uploader, checkpoint)
+                batch.clear()
+
+        if not workers:
+            for path in candidates():
+                try:
+                    collect(path, parse_path(path), None)
+                except Exception as e:
+                    collect(path, None, e)
+        else:
+            # parse ahead in the pool, but never keep more than a couple of batches in memory
+            pending = deque()
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+                def drain(limit):
+                    while len(pending) > limit:
+                        path, future = pending.popleft()
+                        try:
+                            collect(path, future.result(), None)
+                        except Exception as e:
+                            collect(path, None, e)
+
+                for path in candidates():
+                    pending.append((path, executor.submit(parse_path, path)))
+                    drain(max(batch_size, 2 * workers))
+                drain(0)
+        if batch:
+            self.insert(batch, options['doi'], uploader, checkpoint)
+
+        elapsed = time.perf_counter() - self.start
+        self.stdout.write('imported {} files ({} failed, {} skipped) in {:.1f}s: {:.1f} files/s, {:.2f} MB/s'.format(
+            self.counts['ok'], self.counts['failed'], self.counts['skipped'], elapsed,
+            self.counts['ok'] / elapsed if elapsed else 0.0, self.counts['bytes'] / (1024 * 1024) / elapsed if elapsed else 0.0))
+        if self.counts['ok']:
+            # parse, derive and downsample are summed over all workers
+            self.stdout.write('per file: ' + ' '.join('{}={:.1f}ms'.format(name, duration * 1000 / self.counts['ok']) for name, duration in self.timings.items()))
+
+    def fail(self, path, e):
+        self.counts['failed'] += 1
+        self.stderr.write(f'{path}: {error_message(e)}')
+
+    def insert(self, batch, upload_file_doi, uploader, checkpoint):
+        done = []
+        stored = []
+        # one transaction per batch, one savepoint per file
+        try:
+            with transaction.atomic():
+                for path, result, error in batch:
+                    if error is None:
+                        data, timings = result
+                        timer = StageTimer()
+                        timer.timings.update(timings)
+                        try:
+                            with open(path, 'rb') as f:
+                                stored.append(store_xdi_data(data, File(f, name=os.path.basename(path)), upload_file_doi, uploader, timer))
+                        except Exception as e:
+                            error = e
+                        else:
+                            for name, duration in timer.timings.items():
+                                self.timings[name] = self.timings.get(name, 0.0) + duration
+                    if error is None:
+                        done.append((path, 'ok'))
+                    else:
+                        done.append((path, 'failed'))
+                        self.fail(path, error)
+        except BaseException:
+            # the batch was rolled back, including interruptions: the files it stored are orphans now
+            for xas_file in stored:
+                xas_file.upload_file.delete(save=False)
+            raise
+        self.counts['ok'] += len(stored)
+        # only recorded once committed
+        checkpoint.write(done)
+        elapsed = time.perf_counter() - self.start
+        if self.verbosity > 0:
+            self.stdout.write('{} files imported, {} failed, {:.1f} files/s'.format(self.counts['ok'], self.counts['failed'], self.counts['ok'] / elapsed if elapsed else 0.0))
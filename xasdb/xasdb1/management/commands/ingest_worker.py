@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from xasdb1.ingest import run_pending_jobs
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Ingests queued uploads. Several workers may run at the same time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='exit once the queue is empty')
+        parser.add_argument('--poll-interval', type=float, default=settings.XASDB_INGEST_POLL_INTERVAL, help='seconds to wait between polls of an empty queue')
+
+    def handle(self, *args, **options):
+        while True:
+            count = run_pending_jobs()
+            if count:
+                self.stdout.write(f'ran {count} ingest jobs')
+            if options['once']:
+                break
+            close_old_connections()
+            time.sleep(options['poll_interval'])
@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from xasdb1.arrays import NORMALIZED_ARRAY, SIMILARITY_ARRAY, decode_array
+from xasdb1.models import XASFile, XASMode, XASArray
+from xasdb1.normalization import normalize_spectrum
+from xasdb1.similarity import spectrum_features
+
+from collections import defaultdict
+import time
+
+# the arrays the normalization starts from
+INPUT_ARRAYS = ('energy',) + tuple(sorted(set(XASMode.PLOT_ARRAYS.values())))
+
+
+class Command(BaseCommand):
+    help = 'Normalizes the spectra of the catalogue in batches, and updates the similarity features that are computed from the normalized spectra.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help='ids of the files to normalize, all files if omitted')
+        parser.add_argument('--element', help='only normalize files of this element')
+        parser.add_argument('--missing', action='store_true', help='only normalize files that have no E0 yet')
+        parser.add_argument('--batch-size', type=int, default=500, help='number of files read and written together')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive')
+        files = XASFile.objects.order_by('id')
+        if options['ids']:
+            files = files.filter(id__in=options['ids'])
+        if options['element']:
+            files = files.filter(element=options['element'])
+        if options['missing']:
+            files = files.filter(e0__isnull=True)
+        file_ids = list(files.values_list('id', flat=True))
+
+        start = time.perf_counter()
+        normalized = 0
+        batch_size = options['batch_size']
+        for i in range(0, len(file_ids), batch_size):
+            normalized += normalize_batch(file_ids[i:i + batch_size])
+            if options['verbosity'] > 1:
+                self.stdout.write('normalized {} of {} files'.format(min(i + batch_size, len(file_ids)), len(file_ids)))
+        self.stdout.write('normalized {} of {} files in {:.1f}s'.format(normalized, len(file_ids), time.perf_counter() - start))
+
+
+def normalize_batch(file_ids):
+    # three queries to read the files, their modes and their arrays, and the results are written in one transaction.
+    # returns the number of files that could be normalized
+    files = list(XASFile.objects.filter(id__in=file_ids).only('id', 'element', 'edge'))
+    modes = defaultdict(list)
+    for file_id, mode in XASMode.objects.filter(file_id__in=file_ids).values_list('file_id', 'mode'):
+        modes[file_id].append(mode)
+    arrays = defaultdict(dict)
+    for file_id, name, array in XASArray.objects.filter(file_id__in=file_ids, name__in=INPUT_ARRAYS).values_list('file_id', 'name', 'array'):
+        arrays[file_id][name] = decode_array(array)
+
+    now = timezone.now()
+    xas_arrays = []
+    count = 0
+    for file in files:
+        file.e0 = file.edge_step = None
+        file.modified_timestamp = now
+        file_arrays = arrays[file.id]
+        normalized = normalize_spectrum(file.element, file.edge, file_arrays, modes[file.id])
+        if normalized is not None:
+            file.e0, file.edge_step, normalized_arrays = normalized
+            file_arrays.update(normalized_arrays)
+            xas_arrays.extend(XASArray(file=file, name=name, data=array) for name, array in normalized_arrays.items())
+            count += 1
+        features = spectrum_features(file.element, file.edge, file_arrays, modes[file.id])
+        if features is not None:
+            xas_arrays.append(XASArray(file=file, name=SIMILARITY_ARRAY, data=features))
+
+    with transaction.atomic():
+        XASArray.objects.filter(file_id__in=file_ids).filter(Q(name__in=(NORMALIZED_ARRAY, SIMILARITY_ARRAY)) | Q(name__startswith=NORMALIZED_ARRAY + '@')).delete()
+        XASArray.objects.bulk_create(xas_arrays)
+        XASFile.objects.bulk_update(files, ['e0', 'edge_step', 'modified_timestamp'])
+    return count
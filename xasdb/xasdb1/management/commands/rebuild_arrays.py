@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from xasdb1.arrays import DERIVED_ARRAYS, NORMALIZED_ARRAY, SIMILARITY_ARRAY, derive_channels
+from xasdb1.models import XASFile, XASArray
+from xasdb1.normalization import normalize_spectrum
+from xasdb1.similarity import spectrum_features
+from xasdb1.utils import build_plot_levels
+
+import time
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the arrays derived from the raw channels of each file, the downsampled levels used for plotting, the normalized spectrum and the features of the similarity search.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help='ids of the files to rebuild, all files if omitted')
+        parser.add_argument('--element', help='only rebuild files of this element')
+
+    def handle(self, *args, **options):
+        files = XASFile.objects.order_by('id')
+        if options['ids']:
+            files = files.filter(id__in=options['ids'])
+        if options['element']:
+            files = files.filter(element=options['element'])
+
+        start = time.perf_counter()
+        count = 0
+        for file in files.iterator():
+            rebuild_derived_arrays(file)
+            count += 1
+            if options['verbosity'] > 1:
+                self.stdout.write(f'rebuilt file {file.id} ({file.name})')
+        self.stdout.write('rebuilt {} files in {:.1f}s'.format(count, time.perf_counter() - start))
+
+
+def rebuild_derived_arrays(file):
+    arrays = file.get_arrays('energy', 'i0', 'itrans', 'ifluor', 'irefer', 'xmu')
+    rebuilt = derive_channels(arrays)
+    arrays.update(rebuilt)
+    e0 = edge_step = None
+    if 'energy' in arrays:
+        modes = list(file.xasmode_set.values_list('mode', flat=True))
+        rebuilt.update(build_plot_levels(arrays, modes))
+        normalized = normalize_spectrum(file.element, file.edge, arrays, modes)
+        if normalized is not None:
+            e0, edge_step, normalized_arrays = normalized
+            arrays.update(normalized_arrays)
+            rebuilt.update(normalized_arrays)
+        features = spectrum_features(file.element, file.edge, arrays, modes)
+        if features is not None:
+            rebuilt[SIMILARITY_ARRAY] = features
+    with transaction.atomic():
+        XASArray.objects.filter(file=file).filter(Q(name__in=DERIVED_ARRAYS + (NORMALIZED_ARRAY, SIMILARITY_ARRAY)) | Q(name__contains='@')).delete()
+        XASArray.objects.bulk_create([XASArray(file=file, name=name, data=array) for name, array in rebuilt.items()])
+        XASFile.objects.filter(id=file.id).update(e0=e0, edge_step=edge_step)
+        file.touch()
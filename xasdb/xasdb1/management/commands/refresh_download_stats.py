@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from xasdb1.download_stats import refresh_download_stats, rebuild_download_stats
+
+
+class Command(BaseCommand):
+    help = 'Moves the rolling windows of the download counters on. Run it once a day.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='recompute all counters from the download events')
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            rebuild_download_stats()
+            self.stdout.write('rebuilt the download counters')
+        else:
+            count = refresh_download_stats()
+            self.stdout.write(f'updated {count} download counters')
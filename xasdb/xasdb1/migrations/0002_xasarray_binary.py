@@ -0,0 +1,59 @@
+# Generated by Django 2.2.10 on 2026-10-18 09:12
+
+from django.conf import settings
+from django.db import migrations, models
+import json
+import numpy as np
+
+from xasdb1.arrays import encode_array, decode_array
+
+
+def json_to_binary(apps, schema_editor):
+    XASArray = apps.get_model('xasdb1', 'XASArray')
+    for xas_array in XASArray.objects.only('id', 'array').iterator():
+        array = np.array(json.loads(xas_array.array))
+        xas_array.array_binary = encode_array(array, compress=settings.XASDB_ARRAY_COMPRESSION)
+        xas_array.save(update_fields=['array_binary'])
+
+
+def binary_to_json(apps, schema_editor):
+    XASArray = apps.get_model('xasdb1', 'XASArray')
+    for xas_array in XASArray.objects.only('id', 'array_binary').iterator():
+        array = decode_array(xas_array.array_binary)
+        xas_array.array = json.dumps(array.tolist())
+        xas_array.save(update_fields=['array'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xasarray',
+            name='array_binary',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.AlterField(
+            model_name='xasarray',
+            name='array',
+            field=models.TextField(default=''),
+        ),
+        migrations.RunPython(json_to_binary, binary_to_json),
+        migrations.RemoveField(
+            model_name='xasarray',
+            name='array',
+        ),
+        migrations.RenameField(
+            model_name='xasarray',
+            old_name='array_binary',
+            new_name='array',
+        ),
+        migrations.AlterField(
+            model_name='xasarray',
+            name='array',
+            field=models.BinaryField(),
+        ),
+    ]
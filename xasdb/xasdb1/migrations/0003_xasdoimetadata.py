@@ -0,0 +1,24 @@
+# Generated by Django 2.2.10 on 2026-10-18 11:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0002_xasarray_binary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XASDOIMetadata',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('doi', models.CharField(max_length=256, unique=True)),
+                ('work', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('fetched_timestamp', models.DateTimeField(verbose_name='date fetched')),
+                ('expires_timestamp', models.DateTimeField(verbose_name='date expires')),
+            ],
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.10 on 2026-10-18 11:40
+
+from django.db import migrations, models
+import xasdb1.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0003_xasdoimetadata'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='xasfile',
+            name='upload_file',
+            field=models.FileField(db_index=True, upload_to='uploads/%Y/%m/%d/', validators=[xasdb1.models.file_size_valid, xasdb1.models.xdi_valid]),
+        ),
+        migrations.AlterField(
+            model_name='xasuploadauxdata',
+            name='aux_file',
+            field=models.FileField(db_index=True, upload_to='uploads/%Y/%m/%d/', validators=[xasdb1.models.file_size_valid]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.2.10 on 2026-10-18 11:52
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0004_index_file_paths'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xasfile',
+            name='modified_timestamp',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='date modified'),
+            preserve_default=False,
+        ),
+    ]
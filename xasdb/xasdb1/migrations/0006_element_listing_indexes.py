@@ -0,0 +1,25 @@
+# Generated by Django 2.2.10 on 2026-10-18 11:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0005_xasfile_modified_timestamp'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='xasfile',
+            index=models.Index(fields=['element', 'sample_name', 'id'], name='xasdb1_elem_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='xasfile',
+            index=models.Index(fields=['element', 'review_status', 'sample_name', 'id'], name='xasdb1_elem_status_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='xasfile',
+            index=models.Index(fields=['element', 'uploader', 'sample_name', 'id'], name='xasdb1_elem_uploader_name_idx'),
+        ),
+    ]
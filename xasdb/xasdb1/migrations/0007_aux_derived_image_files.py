@@ -0,0 +1,78 @@
+# Generated by Django 2.2.10 on 2026-10-18 12:02
+
+from django.core.files.base import ContentFile
+from django.db import migrations, models
+import base64
+import xasdb1.models
+
+from xasdb1.models import derived_image_name
+
+
+def _data_uri_to_png(value):
+    # "data:image/png;base64, <payload>"
+    return base64.b64decode(value.split(',', 1)[1])
+
+
+def base64_to_files(apps, schema_editor):
+    XASUploadAuxData = apps.get_model('xasdb1', 'XASUploadAuxData')
+    for aux in XASUploadAuxData.objects.exclude(aux_thumbnail='', aux_image='').iterator():
+        for kind in ('thumbnail', 'image'):
+            value = getattr(aux, 'aux_' + kind)
+            if not value:
+                continue
+            content = _data_uri_to_png(value)
+            getattr(aux, 'aux_' + kind + '_file').save(derived_image_name(aux.aux_file.name, kind, content), ContentFile(content), save=False)
+        aux.save(update_fields=['aux_thumbnail_file', 'aux_image_file'])
+
+
+def files_to_base64(apps, schema_editor):
+    XASUploadAuxData = apps.get_model('xasdb1', 'XASUploadAuxData')
+    for aux in XASUploadAuxData.objects.exclude(aux_thumbnail_file='', aux_image_file='').iterator():
+        for kind in ('thumbnail', 'image'):
+            field = getattr(aux, 'aux_' + kind + '_file')
+            if not field:
+                continue
+            with field.open('rb') as f:
+                content = f.read()
+            setattr(aux, 'aux_' + kind, 'data:image/png;base64, {}'.format(base64.b64encode(content).decode('utf-8')))
+            field.delete(save=False)
+        aux.save(update_fields=['aux_thumbnail', 'aux_image'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0006_element_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xasuploadauxdata',
+            name='aux_thumbnail_file',
+            field=models.FileField(blank=True, max_length=255, upload_to=xasdb1.models.aux_derived_path),
+        ),
+        migrations.AddField(
+            model_name='xasuploadauxdata',
+            name='aux_image_file',
+            field=models.FileField(blank=True, max_length=255, upload_to=xasdb1.models.aux_derived_path),
+        ),
+        migrations.RunPython(base64_to_files, files_to_base64),
+        migrations.RemoveField(
+            model_name='xasuploadauxdata',
+            name='aux_thumbnail',
+        ),
+        migrations.RemoveField(
+            model_name='xasuploadauxdata',
+            name='aux_image',
+        ),
+        migrations.RenameField(
+            model_name='xasuploadauxdata',
+            old_name='aux_thumbnail_file',
+            new_name='aux_thumbnail',
+        ),
+        migrations.RenameField(
+            model_name='xasuploadauxdata',
+            old_name='aux_image_file',
+            new_name='aux_image',
+        ),
+    ]
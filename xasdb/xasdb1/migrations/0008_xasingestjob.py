@@ -0,0 +1,49 @@
+# Generated by Django 2.2.10 on 2026-10-18 11:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('xasdb1', '0007_aux_derived_image_files'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XASIngestJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_file', models.FileField(blank=True, upload_to='ingest/%Y/%m/%d/')),
+                ('upload_name', models.CharField(max_length=256)),
+                ('upload_file_doi', models.CharField(default='', max_length=256, verbose_name='Citation DOI')),
+                ('status', models.SmallIntegerField(choices=[(0, 'Queued'), (1, 'Running'), (2, 'Done'), (3, 'Failed')], default=0)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_timestamp', models.DateTimeField(auto_now_add=True, verbose_name='date created')),
+                ('claimed_timestamp', models.DateTimeField(blank=True, null=True, verbose_name='date claimed')),
+                ('finished_timestamp', models.DateTimeField(blank=True, null=True, verbose_name='date finished')),
+                ('error', models.TextField(blank=True)),
+                ('file', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='xasdb1.XASFile')),
+                ('uploader', models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='XASIngestJobAuxData',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('aux_description', models.CharField(default='', max_length=256, verbose_name='Description')),
+                ('aux_file', models.FileField(blank=True, upload_to='ingest/%Y/%m/%d/')),
+                ('aux_name', models.CharField(max_length=256)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='xasdb1.XASIngestJob')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='xasingestjob',
+            index=models.Index(fields=['status', 'run_after'], name='xasdb1_ingest_status_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.10 on 2026-10-18 12:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0008_xasingestjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='xasdownloadauxdata',
+            name='download_timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='date downloaded'),
+        ),
+        migrations.AlterField(
+            model_name='xasdownloadfile',
+            name='download_timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, verbose_name='date downloaded'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 2.2.10 on 2026-10-18 12:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0009_download_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XASAuxDownloadStats',
+            fields=[
+                ('total_downloads', models.PositiveIntegerField(default=0)),
+                ('unique_downloaders', models.PositiveIntegerField(default=0)),
+                ('downloads_7_days', models.PositiveIntegerField(default=0)),
+                ('downloads_30_days', models.PositiveIntegerField(default=0)),
+                ('file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='download_stats', serialize=False, to='xasdb1.XASUploadAuxData')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='XASFileDownloadStats',
+            fields=[
+                ('total_downloads', models.PositiveIntegerField(default=0)),
+                ('unique_downloaders', models.PositiveIntegerField(default=0)),
+                ('downloads_7_days', models.PositiveIntegerField(default=0)),
+                ('downloads_30_days', models.PositiveIntegerField(default=0)),
+                ('file', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='download_stats', serialize=False, to='xasdb1.XASFile')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='XASFileDownloadDay',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('downloads', models.PositiveIntegerField(default=0)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='download_days', to='xasdb1.XASFile')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='XASAuxDownloadDay',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('downloads', models.PositiveIntegerField(default=0)),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='download_days', to='xasdb1.XASUploadAuxData')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='xasfiledownloadday',
+            index=models.Index(fields=['day'], name='xasdb1_file_dl_day_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='xasfiledownloadday',
+            unique_together={('file', 'day')},
+        ),
+        migrations.AddIndex(
+            model_name='xasauxdownloadday',
+            index=models.Index(fields=['day'], name='xasdb1_aux_dl_day_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='xasauxdownloadday',
+            unique_together={('file', 'day')},
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.2.10 on 2026-10-18 13:02
+
+from django.db import migrations
+
+INDEX_NAME = 'xasdb1_file_search_idx'
+# see xasdb1.search.SEARCH_INDEX_FIELDS
+SEARCH_INDEX_FIELDS = ('sample_name', 'sample_prep', 'beamline_name', 'facility_name', 'mono_name')
+
+
+def create_fulltext_index(apps, schema_editor):
+    # only MySQL and MariaDB have FULLTEXT indexes: elsewhere xasdb1.search falls back to substring matching
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    XASFile = apps.get_model('xasdb1', 'XASFile')
+    schema_editor.execute('CREATE FULLTEXT INDEX {} ON {} ({})'.format(
+        schema_editor.quote_name(INDEX_NAME),
+        schema_editor.quote_name(XASFile._meta.db_table),
+        ', '.join(schema_editor.quote_name(field) for field in SEARCH_INDEX_FIELDS)))
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    XASFile = apps.get_model('xasdb1', 'XASFile')
+    schema_editor.execute('DROP INDEX {} ON {}'.format(schema_editor.quote_name(INDEX_NAME), schema_editor.quote_name(XASFile._meta.db_table)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0010_download_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.10 on 2026-10-18 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0011_xasfile_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xasfile',
+            name='e0',
+            field=models.FloatField(blank=True, null=True, verbose_name='E0'),
+        ),
+        migrations.AddField(
+            model_name='xasfile',
+            name='edge_step',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.10 on 2026-10-18 13:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xasdb1', '0012_xasfile_normalization'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xasingestjob',
+            name='is_archive',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='XASIngestJobMember',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('name', models.CharField(max_length=512)),
+                ('error', models.TextField(blank=True)),
+                ('file', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='xasdb1.XASFile')),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='xasdb1.XASIngestJob')),
+            ],
+            options={
+                'ordering': ['index'],
+            },
+        ),
+    ]
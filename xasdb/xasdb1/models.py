@@ -1,30 +1,35 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 import django
 from django.conf import settings
+from django.db.models.fields.files import FieldFile
+from django.core.files.base import ContentFile
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.core.cache import caches
 
 import xdifile
 import tempfile
 import os.path
 from os.path import exists
 import xraylib as xrl
-from habanero import Crossref
 import imghdr
-import base64
+import hashlib
 
 from PIL import Image
 from io import BytesIO
 import sys
 
+from .arrays import encode_array, decode_array
+
 
 XDI_TMP_DIR = tempfile.TemporaryDirectory()
 
 def doi_valid(value):
+    from .crossref import get_work # avoid circular import
     try:
-        cr = Crossref(mailto = "Tom.Schoonjans@diamond.ac.uk") # necessary to end up in the polite pool
-        work = cr.works(ids=value)
-        work['message']['title']
+        get_work(value)
     except Exception as e:
         raise ValidationError(f"Invalid DOI: {e}")
 
@@ -33,6 +38,11 @@ def file_size_valid(value):
     if value.size > limit:
         raise ValidationError('File size is limited to 10 MB!')
 
+def archive_size_valid(value):
+    limit = settings.XASDB_ARCHIVE_MAX_SIZE
+    if value.size > limit:
+        raise ValidationError('Archive size is limited to {} MB!'.format(limit // (1024 * 1024)))
+
 def mendeljev_valid(value):
     try:
         atomic_number = xrl.SymbolToAtomicNumber(value)
@@ -41,14 +51,30 @@ def mendeljev_valid(value):
     except Exception:
         raise ValidationError(f"Unknown chemical element {value}")
 
-def xdi_valid(value):
-    temp_xdi_file = os.path.join(XDI_TMP_DIR.name, value.name)
+def parse_xdi_upload(value):
+    # validators receive the FieldFile wrapping the upload, views the upload itself:
+    # either way the parsed XDIFile gets attached to the upload, so it is decoded, written and parsed only once per request
+    upload = value.file if isinstance(value, FieldFile) else value
+    xdi_file = getattr(upload, 'xdi_file', None)
+    if xdi_file is not None:
+        return xdi_file
 
+    fd, temp_xdi_file = tempfile.mkstemp(suffix='-' + os.path.basename(upload.name), dir=XDI_TMP_DIR.name)
     try:
-        with open(temp_xdi_file, 'w') as f:
-            f.write(value.read().decode('utf-8'))
-
+        upload.seek(0)
+        with open(fd, 'w') as f:
+            f.write(upload.read().decode('utf-8'))
+        upload.seek(0)
+        upload.xdi_parse_count = getattr(upload, 'xdi_parse_count', 0) + 1
         xdi_file = xdifile.XDIFile(filename=temp_xdi_file)
+    finally:
+        os.remove(temp_xdi_file)
+    upload.xdi_file = xdi_file
+    return xdi_file
+
+def xdi_valid(value):
+    try:
+        xdi_file = parse_xdi_upload(value)
         if xdi_file.element.decode('utf-8') == '':
             raise Exception('no element found')
         return
@@ -64,7 +90,7 @@ class XASFile(models.Model):
 
     EDGE_CHOICES = ((xrl.K_SHELL, "K"), (xrl.L1_SHELL, "L1"), (xrl.L2_SHELL, "L2"), (xrl.L3_SHELL, "L3"))
 
-    upload_file = models.FileField(upload_to='uploads/%Y/%m/%d/', validators=[file_size_valid, xdi_valid])
+    upload_file = models.FileField(upload_to='uploads/%Y/%m/%d/', validators=[file_size_valid, xdi_valid], db_index=True)
     upload_file_doi = models.CharField('Citation DOI', max_length=256, default='', validators=[doi_valid])
     upload_timestamp = models.DateTimeField('date published', auto_now_add=True)
     element = models.CharField(max_length=3, validators=[mendeljev_valid])
@@ -79,17 +105,55 @@ class XASFile(models.Model):
     mono_d_spacing = models.CharField(max_length=30, default='unknown')
     scan_start_time = models.DateTimeField(default=django.utils.timezone.now)
     refer_used = models.BooleanField(default=False)
+    modified_timestamp = models.DateTimeField('date modified', auto_now=True)
+    # from the normalization at ingest, see xasdb1.normalization. null if the spectrum could not be normalized
+    e0 = models.FloatField('E0', null=True, blank=True)
+    edge_step = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        # one index per visibility path of the element listing (staff, anonymous, uploader), all sorted the way the listing is
+        indexes = [
+            models.Index(fields=['element', 'sample_name', 'id'], name='xasdb1_elem_name_idx'),
+            models.Index(fields=['element', 'review_status', 'sample_name', 'id'], name='xasdb1_elem_status_name_idx'),
+            models.Index(fields=['element', 'uploader', 'sample_name', 'id'], name='xasdb1_elem_uploader_name_idx'),
+        ]
 
     @property
     def name(self):
         return os.path.basename(self.upload_file.name)
 
+    @property
+    def content_version(self):
+        # changes whenever the file or its arrays are modified: use it to key anything derived from them
+        return '{}-{:x}'.format(self.id, int(self.modified_timestamp.timestamp() * 1000000))
+
+    @property
+    def plot_cache_key(self):
+        return f'file-plot-{self.id}'
+
+    def get_arrays(self, *names):
+        # fetches the requested arrays in a single query, missing ones are left out
+        return {xas_array.name: xas_array.data for xas_array in self.xasarray_set.filter(name__in=names)}
+
+    def touch(self):
+        # for changes that do not go through save(), such as updates of the arrays
+        self.modified_timestamp = django.utils.timezone.now()
+        XASFile.objects.filter(id=self.id).update(modified_timestamp=self.modified_timestamp)
+
 class XASArray(models.Model):
     file = models.ForeignKey(XASFile, on_delete=models.CASCADE)
-    array = models.TextField() # this will be a numpy array turned into JSON...
+    array = models.BinaryField() # numpy array packed by xasdb1.arrays.encode_array: use the data property instead
     unit = models.CharField(max_length=20)
     name = models.CharField(max_length=50)
 
+    @property
+    def data(self):
+        return decode_array(self.array)
+
+    @data.setter
+    def data(self, value):
+        self.array = encode_array(value, compress=settings.XASDB_ARRAY_COMPRESSION)
+
 class XASMode(models.Model):
     UNKNOWN = -1
     TRANSMISSION= 0
@@ -97,59 +161,261 @@ class XASMode(models.Model):
     FLUORESCENCE_UNITSTEP = 2
     XMU = 3
     MODE_CHOICES = ((UNKNOWN, "Unknown"), (TRANSMISSION, "Transmission"), (FLUORESCENCE, "Fluorescence"), (FLUORESCENCE_UNITSTEP, "Fluorescence, unitstep"), (XMU, "Normalized absorption spectrum"))
+    # the array plotted for each mode
+    PLOT_ARRAYS = {TRANSMISSION: 'mu_trans', FLUORESCENCE: 'mu_fluor', FLUORESCENCE_UNITSTEP: 'mu_fluor', XMU: 'xmu'}
 
     file = models.ForeignKey(XASFile, on_delete=models.CASCADE)
     mode = models.SmallIntegerField(choices=MODE_CHOICES, default=UNKNOWN)
 
+def aux_derived_path(instance, filename):
+    # derived images live next to the aux file they were made from
+    return os.path.join(os.path.dirname(instance.aux_file.name), filename)
+
 class XASUploadAuxData(models.Model):
+    THUMBNAIL_SIZE = (150, 150)
+
     aux_description = models.CharField('Description', max_length=256, default='')
-    aux_file = models.FileField(upload_to='uploads/%Y/%m/%d/', validators=[file_size_valid])
-    aux_thumbnail = models.TextField(blank=True)
-    aux_image = models.TextField(blank=True)
+    aux_file = models.FileField(upload_to='uploads/%Y/%m/%d/', validators=[file_size_valid], db_index=True)
+    # PNGs derived from aux_file if it is an image, named after their content so they can be cached forever
+    aux_thumbnail = models.FileField(upload_to=aux_derived_path, blank=True, max_length=255)
+    aux_image = models.FileField(upload_to=aux_derived_path, blank=True, max_length=255)
     file = models.ForeignKey(XASFile, on_delete=models.CASCADE)
 
     @property
     def name(self):
         return os.path.basename(self.aux_file.name)
 
+    @property
+    def thumbnail_url(self):
+        return self._derived_url('thumbnail')
+
+    @property
+    def image_url(self):
+        return self._derived_url('image')
+
+    def _derived_url(self, kind):
+        from django.urls import reverse # avoid circular import
+        field = getattr(self, 'aux_' + kind)
+        if not field:
+            return ''
+        return reverse('xasdb1:aux_image', args=[self.id, kind, derived_image_digest(field.name)])
+
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         if imghdr.what(self.aux_file.path) is not None:
 
             try:
-                self.aux_thumbnail = make_image_base64(self.aux_file, (150, 150)) # thumbnail
-                self.aux_image = make_image_base64(self.aux_file) # regular size
-                super().save(update_fields=['aux_thumbnail', 'aux_image'])
+                changed = save_derived_image(self.aux_thumbnail, make_image_png(self.aux_file, self.THUMBNAIL_SIZE), self.aux_file.name, 'thumbnail')
+                changed = save_derived_image(self.aux_image, make_image_png(self.aux_file), self.aux_file.name, 'image') or changed
+                if changed:
+                    super().save(update_fields=['aux_thumbnail', 'aux_image'])
             except Exception as e:
                 print("save exception: {}".format(e))
                 raise
 
 
 
+class XASDOIMetadata(models.Model):
+    # cached Crossref metadata, see xasdb1.crossref
+    doi = models.CharField(max_length=256, unique=True)
+    work = models.TextField(blank=True) # JSON encoded Crossref message, empty for invalid DOIs
+    error = models.TextField(blank=True) # why the DOI is invalid
+    fetched_timestamp = models.DateTimeField('date fetched')
+    expires_timestamp = models.DateTimeField('date expires')
+
+    @property
+    def valid(self):
+        return not self.error
+
+
+class XASIngestJob(models.Model):
+    # an upload waiting to be turned into an XASFile by the ingest_worker management command, see xasdb1.ingest
+    QUEUED = 0
+    RUNNING = 1
+    DONE = 2
+    FAILED = 3
+    STATUS_CHOICES = ((QUEUED, "Queued"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed"))
+
+    upload_file = models.FileField(upload_to='ingest/%Y/%m/%d/', blank=True)
+    upload_name = models.CharField(max_length=256) # name of the file as uploaded
+    upload_file_doi = models.CharField('Citation DOI', max_length=256, default='')
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
+    # a zip or tar archive of XDI files, with a report of its members in XASIngestJobMember
+    is_archive = models.BooleanField(default=False)
+    status = models.SmallIntegerField(choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    run_after = models.DateTimeField(default=django.utils.timezone.now)
+    created_timestamp = models.DateTimeField('date created', auto_now_add=True)
+    claimed_timestamp = models.DateTimeField('date claimed', null=True, blank=True)
+    finished_timestamp = models.DateTimeField('date finished', null=True, blank=True)
+    error = models.TextField(blank=True)
+    file = models.ForeignKey(XASFile, on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='xasdb1_ingest_status_idx'),
+        ]
+
+class XASIngestJobAuxData(models.Model):
+    job = models.ForeignKey(XASIngestJob, on_delete=models.CASCADE)
+    aux_description = models.CharField('Description', max_length=256, default='')
+    aux_file = models.FileField(upload_to='ingest/%Y/%m/%d/', blank=True)
+    aux_name = models.CharField(max_length=256) # name of the file as uploaded
+
+
+class XASIngestJobMember(models.Model):
+    # one file of an archive job: the XASFile it became, or why it did not
+    job = models.ForeignKey(XASIngestJob, on_delete=models.CASCADE)
+    index = models.PositiveIntegerField() # position in the archive
+    name = models.CharField(max_length=512)
+    file = models.ForeignKey(XASFile, on_delete=models.SET_NULL, null=True, blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['index']
+
+
 class XASDownloadFile(models.Model):
     #ip_address = models.GenericIPAddressField()
-    download_timestamp = models.DateTimeField('date downloaded', auto_now_add=True)
+    # not auto_now_add: downloads are logged in batches, after the fact, see download_log.py
+    download_timestamp = models.DateTimeField('date downloaded', default=django.utils.timezone.now)
     downloader = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     file = models.ForeignKey(XASFile, on_delete=models.CASCADE)
     
 class XASDownloadAuxData(models.Model):
     #ip_address = models.GenericIPAddressField()
-    download_timestamp = models.DateTimeField('date downloaded', auto_now_add=True)
+    # not auto_now_add: downloads are logged in batches, after the fact, see download_log.py
+    download_timestamp = models.DateTimeField('date downloaded', default=django.utils.timezone.now)
     downloader = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     file = models.ForeignKey(XASUploadAuxData, on_delete=models.CASCADE)
     
 
+class DownloadStats(models.Model):
+    # download counters, kept up to date by download_stats.py whenever download events are stored,
+    # so nobody needs to count rows of the download tables
+    total_downloads = models.PositiveIntegerField(default=0)
+    unique_downloaders = models.PositiveIntegerField(default=0)
+    downloads_7_days = models.PositiveIntegerField(default=0)
+    downloads_30_days = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+class XASFileDownloadStats(DownloadStats):
+    file = models.OneToOneField(XASFile, on_delete=models.CASCADE, primary_key=True, related_name='download_stats')
+
+class XASAuxDownloadStats(DownloadStats):
+    file = models.OneToOneField(XASUploadAuxData, on_delete=models.CASCADE, primary_key=True, related_name='download_stats')
+
+class DownloadDay(models.Model):
+    # downloads per day, for the rolling windows of DownloadStats. only the last 30 days are kept
+    day = models.DateField()
+    downloads = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+class XASFileDownloadDay(DownloadDay):
+    file = models.ForeignKey(XASFile, on_delete=models.CASCADE, related_name='download_days')
+
+    class Meta:
+        unique_together = (('file', 'day'),)
+        indexes = [
+            models.Index(fields=['day'], name='xasdb1_file_dl_day_idx'),
+        ]
+
+class XASAuxDownloadDay(DownloadDay):
+    file = models.ForeignKey(XASUploadAuxData, on_delete=models.CASCADE, related_name='download_days')
+
+    class Meta:
+        unique_together = (('file', 'day'),)
+        indexes = [
+            models.Index(fields=['day'], name='xasdb1_aux_dl_day_idx'),
+        ]
+
+
+@receiver(post_save, sender=XASArray)
+@receiver(post_delete, sender=XASArray)
+def xasarray_changed(sender, instance, **kwargs):
+    XASFile.objects.filter(id=instance.file_id).update(modified_timestamp=django.utils.timezone.now())
+
+@receiver(post_delete, sender=XASFile)
+def xasfile_deleted(sender, instance, **kwargs):
+    caches['plots'].delete(instance.plot_cache_key)
+    _invalidate_element_counts_on_commit(instance.uploader_id)
+
+@receiver(post_save, sender=XASFile)
+def xasfile_saved(sender, instance, **kwargs):
+    # new file, or maybe a new review_status
+    _invalidate_element_counts_on_commit(instance.uploader_id)
+
+def _invalidate_element_counts_on_commit(uploader_id):
+    # until then other requests do not see the change, and may cache counts without it
+    transaction.on_commit(lambda: invalidate_element_counts(uploader_id))
+
+
+# number of spectra per element for the periodic table, as far as a user can see them (see views._visibility_filter).
+# what everybody can see comes from a single grouped query, cached until a file is saved or deleted
+ELEMENT_COUNTS_KEY = 'xasdb1:element_counts'
+
+def _own_element_counts_key(user_id):
+    return f'{ELEMENT_COUNTS_KEY}:{user_id}'
+
+def invalidate_element_counts(uploader_id=None):
+    keys = [ELEMENT_COUNTS_KEY]
+    if uploader_id is not None:
+        keys.append(_own_element_counts_key(uploader_id))
+    caches['counts'].delete_many(keys)
+
+def element_counts(user):
+    cache = caches['counts']
+    # element -> review_status -> count
+    counts = cache.get(ELEMENT_COUNTS_KEY)
+    if counts is None:
+        counts = dict()
+        for row in XASFile.objects.values('element', 'review_status').annotate(count=models.Count('id')).order_by():
+            counts.setdefault(row['element'], dict())[row['review_status']] = row['count']
+        cache.set(ELEMENT_COUNTS_KEY, counts, settings.XASDB_ELEMENT_COUNTS_TIMEOUT)
+
+    if user.is_staff:
+        return dict((element, sum(statuses.values())) for element, statuses in counts.items())
+    visible = dict((element, statuses.get(XASFile.APPROVED, 0)) for element, statuses in counts.items())
+    if user.is_authenticated:
+        # and the user's own files that are pending or rejected
+        key = _own_element_counts_key(user.id)
+        own = cache.get(key)
+        if own is None:
+            own = dict(XASFile.objects.filter(uploader=user).exclude(review_status=XASFile.APPROVED).values('element').annotate(count=models.Count('id')).order_by().values_list('element', 'count'))
+            cache.set(key, own, settings.XASDB_ELEMENT_COUNTS_TIMEOUT)
+        for element, count in own.items():
+            visible[element] = visible.get(element, 0) + count
+    return visible
+
+
 # based on https://stackoverflow.com/a/56304444/1253230
-def make_image_base64(src_image_field, size=None):
+def make_image_png(src_image_field, size=None):
+    src_image_field.seek(0)
     image = Image.open(src_image_field)
     if size is not None:
         image.thumbnail(size)
 
-    # Save thumbnail to in-memory file as StringIO
     dst_bytes = BytesIO()
     image.save(dst_bytes, 'png')
-    image_str = base64.b64encode(dst_bytes.getvalue())
-    dst_bytes.close()
+    return dst_bytes.getvalue()
+
+def derived_image_name(aux_name, kind, content):
+    stem = os.path.splitext(os.path.basename(aux_name))[0]
+    digest = hashlib.sha256(content).hexdigest()[:32]
+    return f'{stem}.{kind}.{digest}.png'
+
+def derived_image_digest(name):
+    # <stem>.<kind>.<digest>.png
+    return os.path.basename(name).rsplit('.', 2)[-2]
 
-    # set save=False, otherwise it will run in an infinite loop
-    return "data:image/png;base64, {}".format(image_str.decode("utf-8"))
+def save_derived_image(field, content, aux_name, kind):
+    # returns True if the field now points to a different file
+    name = derived_image_name(aux_name, kind, content)
+    if field and os.path.basename(field.name) == name:
+        return False
+    field.save(name, ContentFile(content), save=False)
+    return True
@@ -0,0 +1,43 @@
+from django.conf import settings
+
+from .arrays import NORMALIZED_ARRAY, normalize, plot_levels
+from .models import XASMode
+
+import xraylib as xrl
+
+# the absorption that gets normalized, and compared by the similarity search, if a file has more than one
+ABSORPTION_MODES = (XASMode.XMU, XASMode.FLUORESCENCE_UNITSTEP, XASMode.TRANSMISSION, XASMode.FLUORESCENCE)
+
+
+def edge_energy(element, edge):
+    # tabulated edge energy in eV, None if xraylib does not know about it
+    try:
+        energy = xrl.EdgeEnergy(xrl.SymbolToAtomicNumber(element), edge)
+    except (ValueError, TypeError):
+        return None
+    return energy * 1000 if energy > 0 else None
+
+
+def absorption_array(arrays, modes):
+    # name of the array holding mu(E), None if there is none
+    for mode in ABSORPTION_MODES:
+        name = XASMode.PLOT_ARRAYS[mode]
+        if mode in modes and name in arrays:
+            return name
+    return None
+
+
+def normalize_spectrum(element, edge, arrays, modes):
+    # (e0, edge_step, {name: array}) with the normalized spectrum and its plot levels, or None if it cannot be normalized
+    e0_guess = edge_energy(element, edge)
+    name = absorption_array(arrays, modes)
+    if e0_guess is None or name is None or 'energy' not in arrays:
+        return None
+    result = normalize(arrays['energy'], arrays[name], e0_guess,
+        settings.XASDB_NORMALIZATION_E0_WINDOW, settings.XASDB_NORMALIZATION_PRE_EDGE, settings.XASDB_NORMALIZATION_POST_EDGE, settings.XASDB_NORMALIZATION_POST_EDGE_DEGREE)
+    if result is None:
+        return None
+    e0, edge_step, mu_norm = result
+    normalized = {NORMALIZED_ARRAY: mu_norm}
+    normalized.update(plot_levels(NORMALIZED_ARRAY, arrays['energy'], mu_norm, settings.XASDB_PLOT_LEVELS))
+    return e0, edge_step, normalized
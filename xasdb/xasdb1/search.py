@@ -0,0 +1,89 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, Count, F, FloatField, IntegerField, Q, Value, When
+from django.db.models.expressions import Func
+
+import re
+
+# searchable fields -> weight in the ranking of the fallback search
+SEARCH_FIELDS = {
+    'sample_name': 4,
+    'beamline_name': 2,
+    'facility_name': 2,
+    'sample_prep': 1,
+    'mono_name': 1,
+}
+
+# the FULLTEXT index created by migration 0011 on MySQL and MariaDB, covering SEARCH_FIELDS in this order
+SEARCH_INDEX_FIELDS = ('sample_name', 'sample_prep', 'beamline_name', 'facility_name', 'mono_name')
+
+# operators of the boolean full-text search mode, which are not for users to play with
+_BOOLEAN_OPERATORS = re.compile(r'[+\-<>()~*"@]+')
+
+# facet -> field
+SEARCH_FACETS = {
+    'element': 'element',
+    'edge': 'edge',
+    'beamline': 'beamline_name',
+}
+
+
+class MatchAgainst(Func):
+    # MATCH (...) AGAINST (... IN BOOLEAN MODE), the relevance of a row according to the FULLTEXT index
+    template = 'MATCH (%(expressions)s) AGAINST (%%s IN BOOLEAN MODE)'
+    output_field = FloatField()
+
+    def __init__(self, query, fields=SEARCH_INDEX_FIELDS):
+        self.query = query
+        super().__init__(*(F(field) for field in fields))
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = super().as_sql(compiler, connection, arg_joiner=', ', **extra_context)
+        return sql, params + [self.query]
+
+
+def search_terms(query):
+    # lower case words, without operators, in the order they were typed and without repetitions
+    terms = []
+    for term in _BOOLEAN_OPERATORS.sub(' ', query[:settings.XASDB_SEARCH_MAX_QUERY_LENGTH]).lower().split():
+        if term not in terms:
+            terms.append(term)
+    return terms
+
+
+def boolean_query(terms):
+    # every term must be there, as a word or the start of one
+    return ' '.join(f'+{term}*' for term in terms)
+
+
+def use_fulltext(terms):
+    # the FULLTEXT index does not know about words shorter than innodb_ft_min_token_size
+    return connection.vendor == 'mysql' and all(len(term) >= settings.XASDB_SEARCH_FULLTEXT_MIN_LENGTH for term in terms)
+
+
+def search_files(files, terms):
+    # files matching all terms, annotated with their relevance
+    if use_fulltext(terms):
+        relevance = MatchAgainst(boolean_query(terms))
+        return files.annotate(relevance=relevance).filter(relevance__gt=0)
+
+    # everywhere else: substring matches, ranked by where they are found
+    match = Q()
+    relevance = Value(0, output_field=IntegerField())
+    for term in terms:
+        term_match = Q()
+        for field, weight in SEARCH_FIELDS.items():
+            term_match |= Q(**{f'{field}__icontains': term})
+            relevance = relevance + Case(When(**{f'{field}__icontains': term}, then=Value(weight)), default=Value(0), output_field=IntegerField())
+        match &= term_match
+    return files.filter(match).annotate(relevance=relevance)
+
+
+def facet_counts(files, selected):
+    # facet -> [(value, count)], most common first. the counts of a facet take the selected values of the other facets into account
+    facets = dict()
+    for facet, field in SEARCH_FACETS.items():
+        facet_files = files.filter(**dict((SEARCH_FACETS[other], value) for other, value in selected.items() if other != facet))
+        rows = facet_files.order_by().values(field).annotate(count=Count('id')).order_by('-count', field)
+        facets[facet] = [(row[field], row['count']) for row in rows]
+    return facets
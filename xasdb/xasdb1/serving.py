@@ -0,0 +1,116 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+
+from urllib.parse import quote
+import mimetypes
+import os
+import re
+
+DOWNLOAD_BACKENDS = ('django', 'x-accel-redirect', 'x-sendfile')
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _content_type(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def _attachment(response, name):
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(name))
+    return response
+
+
+def parse_range(header, size):
+    # returns (start, end) with end inclusive for a single byte range, None if the whole file should be sent
+    # and raises ValueError if the range cannot be satisfied. multiple ranges get the whole file
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    start, end = match.groups()
+    if start == '' and end == '':
+        return None
+    if start == '':
+        # the last end bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError('empty suffix range')
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = size - 1 if end == '' else min(int(end), size - 1)
+    if start >= size or end < start:
+        raise ValueError('range not satisfiable')
+    return start, end
+
+
+def is_resumed_download(request):
+    # range requests for anything past the first byte continue a download that was already counted
+    match = _RANGE_RE.match(request.META.get('HTTP_RANGE', '').strip())
+    return match is not None and match.group(1) not in ('', '0')
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _django_response(request, path, name):
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = quote_etag('{:x}-{:x}'.format(int(stat.st_mtime), size))
+    last_modified = http_date(stat.st_mtime)
+
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    # a range of an older version of the file is no use: send all of it
+    if not if_range or if_range == etag or parse_http_date_safe(if_range) == int(stat.st_mtime):
+        try:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            response['Accept-Ranges'] = 'bytes'
+            return response
+
+    if byte_range is None:
+        response = FileResponse(open(path, 'rb'), as_attachment=True, filename=os.path.basename(name), content_type=_content_type(name))
+    else:
+        start, end = byte_range
+        response = _attachment(StreamingHttpResponse(_read_range(path, start, end - start + 1), status=206, content_type=_content_type(name)), name)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    return response
+
+
+def serve_media_file(request, name):
+    # name is relative to MEDIA_ROOT. permissions must have been checked already:
+    # the transfer itself is left to the front-end web server, unless the backend is 'django'
+    backend = settings.XASDB_DOWNLOAD_BACKEND
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    if backend == 'django':
+        return _django_response(request, path, name)
+    elif backend == 'x-accel-redirect':
+        # nginx: the prefix must map to MEDIA_ROOT in an internal location
+        response = _attachment(HttpResponse(content_type=_content_type(name)), name)
+        response['X-Accel-Redirect'] = settings.XASDB_DOWNLOAD_INTERNAL_PREFIX.rstrip('/') + '/' + quote(name)
+        return response
+    elif backend == 'x-sendfile':
+        # apache mod_xsendfile or lighttpd
+        response = _attachment(HttpResponse(content_type=_content_type(name)), name)
+        response['X-Sendfile'] = os.path.abspath(path)
+        return response
+    raise ImproperlyConfigured('XASDB_DOWNLOAD_BACKEND must be one of {}, not {}'.format(', '.join(DOWNLOAD_BACKENDS), backend))
@@ -0,0 +1,68 @@
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+
+from .arrays import NORMALIZED_ARRAY, SIMILARITY_ARRAY, decode_array, similarity_features
+from .models import XASFile, XASArray
+from .normalization import absorption_array, edge_energy
+
+import numpy as np
+
+# (element, edge) -> (version, file ids, feature matrix), see feature_matrix
+_matrices = dict()
+
+
+def similarity_grid(element, edge):
+    energy = edge_energy(element, edge)
+    if energy is None:
+        return None
+    start, stop, points = settings.XASDB_SIMILARITY_GRID
+    return energy + np.linspace(start, stop, points)
+
+
+def spectrum_features(element, edge, arrays, modes):
+    # the feature vector of a spectrum, from its energy and (preferably normalized) absorption arrays. None if it does not get one
+    grid = similarity_grid(element, edge)
+    name = NORMALIZED_ARRAY if NORMALIZED_ARRAY in arrays else absorption_array(arrays, modes)
+    if grid is None or name is None or 'energy' not in arrays:
+        return None
+    return similarity_features(arrays['energy'], arrays[name], grid)
+
+
+def feature_matrix(element, edge):
+    # the ids of the approved spectra of an element and edge, and their features as the rows of a matrix.
+    # kept in memory until these spectra change: checking for that costs one aggregate query per search.
+    # concurrent requests may both load a stale matrix, the last one to finish wins
+    files = XASFile.objects.filter(element=element, edge=edge, review_status=XASFile.APPROVED)
+    state = files.aggregate(count=Count('id'), ids=Sum('id'), modified=Max('modified_timestamp'))
+    version = (state['count'], state['ids'], state['modified'], tuple(settings.XASDB_SIMILARITY_GRID))
+    cached = _matrices.get((element, edge))
+    if cached is not None and cached[0] == version:
+        return cached[1], cached[2]
+
+    points = settings.XASDB_SIMILARITY_GRID[2]
+    file_ids = []
+    rows = []
+    for file_id, array in XASArray.objects.filter(file__in=files, name=SIMILARITY_ARRAY).values_list('file_id', 'array'):
+        features = decode_array(array)
+        # computed on another grid: see the rebuild_arrays management command
+        if features.shape == (points,):
+            file_ids.append(file_id)
+            rows.append(features)
+    file_ids = np.array(file_ids, dtype=np.int64)
+    matrix = np.vstack(rows).astype(np.float32) if rows else np.empty((0, points), dtype=np.float32)
+    _matrices[(element, edge)] = (version, file_ids, matrix)
+    return file_ids, matrix
+
+
+def most_similar(features, element, edge, count, exclude=None):
+    # [(file id, score)] of the count approved spectra of the element and edge most similar to features, best first.
+    # the score is the correlation of the two spectra on the grid: 1 for the same shape
+    file_ids, matrix = feature_matrix(element, edge)
+    if not len(file_ids) or count < 1:
+        return []
+    scores = matrix @ np.asarray(features, dtype=np.float32)
+    # one more, in case the spectrum itself is among them
+    n = min(count + 1, len(scores))
+    top = np.argpartition(-scores, n - 1)[:n]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return [(int(file_ids[i]), float(scores[i])) for i in top if file_ids[i] != exclude][:count]
@@ -0,0 +1,22 @@
+from django import template
+from django.urls import reverse
+from django.utils.html import format_html
+
+from xasdb1.models import element_counts
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def mendeljev_cell(context, element):
+    # one cell of the periodic table: elements without spectra are not worth a click
+    render_context = context.render_context
+    if 'element_counts' not in render_context:
+        # once per page
+        render_context['element_counts'] = element_counts(context['request'].user)
+    count = render_context['element_counts'].get(element, 0)
+    if not count:
+        return format_html('<td class="mendeljev-cell mendeljev-empty" title="No spectra">{}</td>', element)
+    return format_html(
+        '<td class="mendeljev-cell" title="{} spectr{}"><a class="mendeljev-anchor" href="{}">{}<span class="mendeljev-count">{}</span></a></td>',
+        count, 'um' if count == 1 else 'a', reverse('xasdb1:element', args=[element]), element, count)
@@ -1,13 +1,32 @@
 from django.test import TestCase, Client, TransactionTestCase
 from django.test import override_settings
 from django.urls import reverse
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, AnonymousUser
 from django.forms.models import model_to_dict
 from django.core import mail
 
 from django.conf import settings
-from .models import XASFile, XASUploadAuxData, XASDownloadFile
+from .models import XASFile, XASUploadAuxData, XASDownloadFile, XASDownloadAuxData, XASFileDownloadStats, XASAuxDownloadStats, XASFileDownloadDay, XASMode, XASArray, XASDOIMetadata, XASIngestJob, XASIngestJobMember
+from .crossref import get_work, InvalidDOI
 from .views import HOST
+from . import views
+from . import ingest
+from . import archive as archive_module
+from . import download_log
+from . import download_stats
+from . import benchmark
+from . import instrumentation
+from . import similarity
+from .search import search_terms, boolean_query, MatchAgainst
+from .arrays import encode_array, decode_array, derive_channels, array_to_json, lttb, plot_levels, similarity_features, normalize, common_grid, SIMILARITY_ARRAY, NORMALIZED_ARRAY
+from .models import parse_xdi_upload, xdi_valid, element_counts, invalidate_element_counts, ELEMENT_COUNTS_KEY
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.exceptions import ValidationError
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction
+from django.db.models import Q
+from django.core.cache import caches
+from django.core.management import call_command
 
 from os.path import join, exists, basename, getsize
 import tempfile
@@ -17,6 +36,20 @@ import random
 import string
 import hashlib
 import xraylib as xrl
+import numpy as np
+from unittest import mock
+from datetime import timedelta
+from django.utils import timezone
+import requests
+import threading
+import multiprocessing
+import subprocess
+import sys
+import tarfile
+import zipfile
+from io import StringIO
+import io
+import json
 
 USERNAME = 'jpwqehfpfewpfhpfweq'
 PASSWORD = 'rtkhnwoehfongnrgekrg'
@@ -31,7 +64,13 @@ SU_EMAIL = 'admin@xasdb.diamond.ac.uk'
 
 TEMPDIR = tempfile.TemporaryDirectory()
 
-OVERRIDE_SETTINGS = dict(MEDIA_ROOT=TEMPDIR.name, EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend')
+OVERRIDE_SETTINGS = dict(MEDIA_ROOT=TEMPDIR.name, EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend', CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'plots': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': join(TEMPDIR.name, 'cache', 'plots')},
+    'counts': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': join(TEMPDIR.name, 'cache', 'counts')},
+    },
+    # downloads are counted right away, unless a test says otherwise
+    XASDB_DOWNLOAD_LOG_DIR=join(TEMPDIR.name, 'spool', 'downloads'), XASDB_DOWNLOAD_LOG_BATCH_SIZE=1)
 
 UPLOAD_FORMSET_DATA = {
     'form-TOTAL_FORMS': '1',
@@ -1102,7 +1141,7 @@ class FileTestsVerify(TransactionTestCase):
         self.assertContains(response, 'Pending')
         self.assertContains(response, 'Not available', count=1)
         self.assertContains(response, 'data-fancybox', count=2)
-        self.assertContains(response, 'data:image/png;base64, ', count=4)
+        self.assertContains(response, '/aux_image/', count=4)
         response = self.client.post(reverse('xasdb1:file', args=[self.xas_file.id]), {'review_status': XASFile.APPROVED}, follow=True)
         self.assertRedirects(response, reverse('xasdb1:index'))
         self.assertContains(response, 'Only staff can make file POST requests!')
@@ -1130,7 +1169,7 @@ class FileTestsVerify(TransactionTestCase):
         self.assertNotContains(response, 'Approved')
         self.assertContains(response, 'Not available', count=1)
         self.assertContains(response, 'data-fancybox', count=2)
-        self.assertContains(response, 'data:image/png;base64, ', count=4)
+        self.assertContains(response, '/aux_image/', count=4)
 
     def test_without_login(self):
         # users should never be able to access forms or do POST requests
@@ -1152,7 +1191,7 @@ class FileTestsVerify(TransactionTestCase):
         self.assertNotContains(response, 'Approved')
         self.assertNotContains(response, 'Not available')
         self.assertNotContains(response, 'data-fancybox')
-        self.assertNotContains(response, 'data:image/png;base64, ')
+        self.assertNotContains(response, '/aux_image/')
 
     def test_as_admin(self):
         User.objects.create_superuser(username=SU_USERNAME, password=SU_PASSWORD, email=SU_EMAIL)
@@ -1179,7 +1218,7 @@ class FileTestsVerify(TransactionTestCase):
 
         response = self.client.get(reverse('xasdb1:file', args=[self.xas_file.id]), follow=True)
         self.assertContains(response, 'data-fancybox', count=2)
-        self.assertContains(response, 'data:image/png;base64, ', count=4)
+        self.assertContains(response, '/aux_image/', count=4)
 
         self.assertContains(response, f'Spectrum: {self.xas_file.sample_name}')
         self.assertNotContains(response, 'Submission Status')
@@ -1285,7 +1324,7 @@ class FileTestsVerify(TransactionTestCase):
         self.assertContains(response, 'Review status')
         self.assertContains(response, 'selected>Pending')
         self.assertContains(response, 'data-fancybox', count=1)
-        self.assertContains(response, 'data:image/png;base64, ', count=2)
+        self.assertContains(response, '/aux_image/', count=2)
         self.assertNotContains(response, 'Could not update file: check error messages below')
         self.assertEqual(self.xas_file.xasuploadauxdata_set.count(), 2)
         self.assertEqual(self.aux_file_description1, self.xas_file.xasuploadauxdata_set.all()[0].aux_description)
@@ -1476,3 +1515,1845 @@ class ResetPasswordTests(TestCase):
 
         
 
+
+class XASArrayEncodingTests(unittest.TestCase):
+    def test_roundtrip(self):
+        array = np.linspace(6900.0, 7500.0, 1234)
+        decoded = decode_array(encode_array(array))
+        self.assertEqual(decoded.dtype, np.float64)
+        np.testing.assert_array_equal(decoded, array)
+        # zero-copy: the decoded array is a read-only view on the database buffer
+        self.assertFalse(decoded.flags.writeable)
+
+    def test_roundtrip_compressed(self):
+        array = np.arange(10000, dtype=np.float32).reshape(2, 5000)
+        encoded = encode_array(array, compress=True)
+        self.assertLess(len(encoded), array.nbytes)
+        decoded = decode_array(encoded)
+        self.assertEqual(decoded.dtype, np.float32)
+        self.assertEqual(decoded.shape, (2, 5000))
+        np.testing.assert_array_equal(decoded, array)
+
+    def test_big_endian_input(self):
+        array = np.arange(10, dtype='>f8')
+        decoded = decode_array(memoryview(encode_array(array)))
+        self.assertEqual(decoded.dtype.str, '<f8')
+        np.testing.assert_array_equal(decoded, array)
+
+    def test_empty(self):
+        decoded = decode_array(encode_array(np.array([])))
+        self.assertEqual(decoded.shape, (0,))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            decode_array(b'[1.0, 2.0, 3.0]' + bytes(10))
+
+@override_settings(**OVERRIDE_SETTINGS)
+class XASArrayStorageTests(TestCase):
+    def setUp(self):
+        User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        with open(test_file) as fp:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI), follow=True)
+        self.assertEqual(XASFile.objects.count(), 1)
+
+    def test_arrays_are_binary(self):
+        xas_file = XASFile.objects.all()[0]
+        energy = xas_file.xasarray_set.get(name='energy')
+        self.assertIsInstance(energy.data, np.ndarray)
+        self.assertEqual(energy.data[0], 6962.0)
+        self.assertEqual(bytes(energy.array)[:4], b'XASA')
+        # all arrays of a file share the same length, apart from the downsampled plot levels and the similarity features
+        lengths = set(len(xas_array.data) for xas_array in xas_file.xasarray_set.exclude(name__contains='@').exclude(name=SIMILARITY_ARRAY))
+        self.assertEqual(len(lengths), 1)
+
+@override_settings(**OVERRIDE_SETTINGS)
+class IngestTests(TransactionTestCase):
+    def setUp(self):
+        User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        self.test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+
+    def test_timings_reported(self):
+        with self.assertLogs('xasdb1.utils', level='INFO') as logs, open(self.test_file) as fp:
+            response = self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI), follow=True)
+        xas_file = XASFile.objects.get()
+        self.assertRedirects(response, reverse('xasdb1:file', args=[xas_file.id]))
+        self.assertEqual(len(logs.output), 1)
+        for stage in ('parse=', 'derive=', 'downsample=', 'normalize=', 'features=', 'serialize=', 'insert=', 'total='):
+            self.assertIn(stage, logs.output[0])
+        # validation and ingestion share a single parse of the upload
+        self.assertIn('parsed 1x', logs.output[0])
+        self.assertEqual(xas_file.xasmode_set.count(), 1)
+        self.assertEqual(xas_file.xasarray_set.count(), 8) # energy, i0, itrans, mu_trans, mu_norm, their coarsest plot levels and the similarity features
+
+    def test_failed_insert_rolls_back(self):
+        media_root = tempfile.TemporaryDirectory(dir=TEMPDIR.name)
+        with override_settings(MEDIA_ROOT=media_root.name), mock.patch.object(XASArray.objects, 'bulk_create', side_effect=RuntimeError('database went away')), open(self.test_file) as fp:
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI))
+        self.assertEqual(XASFile.objects.count(), 0)
+        self.assertEqual(XASMode.objects.count(), 0)
+        self.assertEqual(XASArray.objects.count(), 0)
+        # the stored upload must be cleaned up as well
+        self.assertEqual([files for _, _, files in os.walk(media_root.name) if files], [])
+
+    def test_parse_once(self):
+        with open(self.test_file, 'rb') as fp:
+            upload = SimpleUploadedFile('fe3c_rt.xdi', fp.read())
+        xdi_valid(upload)
+        xdi_file = parse_xdi_upload(upload)
+        self.assertIs(parse_xdi_upload(upload), xdi_file)
+        self.assertEqual(upload.xdi_parse_count, 1)
+        self.assertEqual(xdi_file.element.decode('utf-8'), 'Fe')
+        # the upload can still be read from the start when it gets stored
+        self.assertTrue(upload.read().startswith(b'# XDI/1.0'))
+
+    def test_parse_failure_not_cached(self):
+        with open(join(settings.BASE_DIR, 'xasdb1', 'testdata', 'bad', 'bad_01.xdi'), 'rb') as fp:
+            upload = SimpleUploadedFile('bad_01.xdi', fp.read())
+        for i in range(2):
+            with self.assertRaises(ValidationError):
+                xdi_valid(upload)
+        self.assertEqual(upload.xdi_parse_count, 2)
+
+class CrossrefStub:
+    # stands in for habanero.Crossref: only knows about DOI
+    calls = 0
+    offline = False
+
+    def __init__(self, mailto=None):
+        pass
+
+    def works(self, ids):
+        CrossrefStub.calls += 1
+        if CrossrefStub.offline:
+            raise requests.exceptions.ConnectionError('Crossref is offline')
+        if ids != DOI:
+            raise requests.exceptions.HTTPError(f'404 Client Error: Not Found for url: https://api.crossref.org/works/{ids}')
+        return {'message': {
+            'title': ['The xraylib library for X-ray-matter interactions. Recent developments'],
+            'URL': 'http://dx.doi.org/10.1016/j.sab.2011.09.011',
+            'published-print': {'date-parts': [[2011, 12]]},
+            'short-container-title': ['Spectrochim. Acta Part B At. Spectrosc.'],
+            'is-referenced-by-count': 314,
+            'author': [{'given': 'Tom', 'family': 'Schoonjans'}, {'given': 'Antonio', 'family': 'Brunetti'}],
+        }}
+
+@override_settings(XASDB_CROSSREF_CLIENT='xasdb1.tests.CrossrefStub', XASDB_CROSSREF_BACKGROUND_REFRESH=False, **OVERRIDE_SETTINGS)
+class CrossrefCacheTests(TestCase):
+    def setUp(self):
+        CrossrefStub.calls = 0
+        CrossrefStub.offline = False
+
+    def test_cache_hit(self):
+        work = get_work(DOI)
+        self.assertEqual(work['is-referenced-by-count'], 314)
+        self.assertEqual(get_work(DOI), work)
+        self.assertEqual(CrossrefStub.calls, 1)
+        entry = XASDOIMetadata.objects.get(doi=DOI)
+        self.assertTrue(entry.valid)
+        self.assertEqual(entry.expires_timestamp - entry.fetched_timestamp, timedelta(seconds=settings.XASDB_CROSSREF_TTL))
+
+    def test_negative_cache(self):
+        for i in range(3):
+            with self.assertRaisesMessage(InvalidDOI, '404 Client Error'):
+                get_work('rubbish-doi')
+        self.assertEqual(CrossrefStub.calls, 1)
+        self.assertFalse(XASDOIMetadata.objects.get(doi='rubbish-doi').valid)
+
+    def test_negative_cache_expiry(self):
+        with self.assertRaises(InvalidDOI):
+            get_work('rubbish-doi')
+        XASDOIMetadata.objects.filter(doi='rubbish-doi').update(expires_timestamp=timezone.now() - timedelta(seconds=1))
+        with self.assertRaises(InvalidDOI):
+            get_work('rubbish-doi')
+        self.assertEqual(CrossrefStub.calls, 2)
+
+    def test_stale_while_revalidate(self):
+        get_work(DOI)
+        stale = timezone.now() - timedelta(seconds=1)
+        XASDOIMetadata.objects.filter(doi=DOI).update(work='{"title": ["stale title"]}', expires_timestamp=stale)
+        # the stale metadata is served, while the entry is refreshed behind the scenes
+        self.assertEqual(get_work(DOI)['title'], ['stale title'])
+        self.assertEqual(CrossrefStub.calls, 2)
+        self.assertGreater(XASDOIMetadata.objects.get(doi=DOI).expires_timestamp, timezone.now())
+        self.assertEqual(get_work(DOI)['is-referenced-by-count'], 314)
+        self.assertEqual(CrossrefStub.calls, 2)
+
+    def test_too_stale(self):
+        get_work(DOI)
+        XASDOIMetadata.objects.filter(doi=DOI).update(work='{"title": ["stale title"]}', expires_timestamp=timezone.now() - timedelta(seconds=settings.XASDB_CROSSREF_STALE_TTL + 1))
+        self.assertEqual(get_work(DOI)['is-referenced-by-count'], 314)
+        self.assertEqual(CrossrefStub.calls, 2)
+
+    def test_offline(self):
+        CrossrefStub.offline = True
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            get_work(DOI)
+        # transient errors are not cached
+        self.assertFalse(XASDOIMetadata.objects.exists())
+        CrossrefStub.offline = False
+        get_work(DOI)
+        XASDOIMetadata.objects.filter(doi=DOI).update(expires_timestamp=timezone.now() - timedelta(seconds=settings.XASDB_CROSSREF_STALE_TTL + 1))
+        CrossrefStub.offline = True
+        self.assertEqual(get_work(DOI)['is-referenced-by-count'], 314)
+
+    def test_file_view_uses_cache(self):
+        User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        with open(test_file) as fp:
+            response = self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI), follow=True)
+        self.assertContains(response, 'Times cited: 314')
+        xas_file = XASFile.objects.get()
+        for i in range(3):
+            response = self.client.get(reverse('xasdb1:file', args=[xas_file.id]))
+            self.assertContains(response, 'Times cited: 314')
+        # validation fetched the metadata, the file views reused it
+        self.assertEqual(CrossrefStub.calls, 1)
+
+    def test_upload_invalid_doi(self):
+        User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        for i in range(2):
+            with open(test_file) as fp:
+                response = self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi='rubbish-doi'), follow=True)
+            self.assertContains(response, 'Invalid DOI: 404 Client Error: Not Found for url: https://api.crossref.org/works/rubbish-doi')
+        self.assertEqual(CrossrefStub.calls, 1)
+        self.assertEqual(XASFile.objects.count(), 0)
+
+@override_settings(XASDB_CROSSREF_CLIENT='xasdb1.tests.CrossrefStub', XASDB_CROSSREF_BACKGROUND_REFRESH=True, **OVERRIDE_SETTINGS)
+class CrossrefBackgroundRefreshTests(TransactionTestCase):
+    def test_background_refresh(self):
+        CrossrefStub.calls = 0
+        CrossrefStub.offline = False
+        get_work(DOI)
+        XASDOIMetadata.objects.filter(doi=DOI).update(work='{"title": ["stale title"]}', expires_timestamp=timezone.now() - timedelta(seconds=1))
+        threads_before = set(threading.enumerate())
+        self.assertEqual(get_work(DOI)['title'], ['stale title'])
+        for thread in set(threading.enumerate()) - threads_before:
+            thread.join(10)
+        self.assertEqual(CrossrefStub.calls, 2)
+        self.assertEqual(get_work(DOI)['is-referenced-by-count'], 314)
+
+@override_settings(**OVERRIDE_SETTINGS)
+class DownloadLookupTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        aux_file1 = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'bad', 'bad_01.xdi')
+        with open(test_file) as fp, open(aux_file1) as aux_fp1:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, **{'upload_file':fp, 'upload_file_doi':DOI, 'form-0-aux_description': 'aux', 'form-0-aux_file': aux_fp1}), follow=True)
+        xas_file = XASFile.objects.get()
+        self.upload_file_name = xas_file.upload_file.name
+        self.aux_file_name = xas_file.xasuploadauxdata_set.get().aux_file.name
+
+    def _count_download_queries(self, path_id):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('xasdb1:download', args=[path_id]))
+            self.assertEqual(response.status_code, 200)
+            b''.join(response.streaming_content)
+        return len(queries)
+
+    def test_constant_queries(self):
+        nqueries_file = self._count_download_queries(self.upload_file_name)
+        nqueries_aux = self._count_download_queries(self.aux_file_name)
+
+        # grow the catalogue: this must not affect the number of queries needed for a download
+        files = XASFile.objects.bulk_create([XASFile(upload_file=f'uploads/dummy_{i}.xdi', element='Fe', uploader=self.user) for i in range(50)])
+        files = XASFile.objects.filter(upload_file__startswith='uploads/dummy_')
+        XASUploadAuxData.objects.bulk_create([XASUploadAuxData(aux_description='dummy', aux_file=f'uploads/dummy_{file.id}.txt', file=file) for file in files for j in range(2)])
+
+        self.assertEqual(self._count_download_queries(self.upload_file_name), nqueries_file)
+        self.assertEqual(self._count_download_queries(self.aux_file_name), nqueries_aux)
+
+@override_settings(**OVERRIDE_SETTINGS)
+class DownloadServingTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        with open(test_file) as fp:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, **{'upload_file':fp, 'upload_file_doi':DOI}), follow=True)
+        self.xas_file = XASFile.objects.get()
+        self.upload_file_name = self.xas_file.upload_file.name
+        with open(test_file, 'rb') as f:
+            self.content = f.read()
+        self.url = reverse('xasdb1:download', args=[self.upload_file_name])
+
+    def test_full(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_ranges(self):
+        size = len(self.content)
+        for header, start, end in (('bytes=0-99', 0, 99), ('bytes=100-', 100, size - 1), ('bytes=-50', size - 50, size - 1), ('bytes=10-{}'.format(10 * size), 10, size - 1)):
+            response = self.client.get(self.url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/{size}')
+            self.assertEqual(response['Content-Length'], str(end - start + 1))
+            self.assertEqual(response.get('Content-Disposition'), 'attachment; filename="{}"'.format(basename(self.upload_file_name)))
+            self.assertEqual(b''.join(response.streaming_content), self.content[start:end + 1])
+
+    def test_unsatisfiable_range(self):
+        size = len(self.content)
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={size}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+    def test_ignored_ranges(self):
+        # multiple ranges and ranges of an older version of the file get the whole file
+        for headers in (dict(HTTP_RANGE='bytes=0-9,20-29'), dict(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"outdated"'), dict(HTTP_RANGE='lines=0-9')):
+            response = self.client.get(self.url, **headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), self.content)
+
+    def test_if_range(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[:10])
+
+    def test_resumed_downloads_counted_once(self):
+        b''.join(self.client.get(self.url, HTTP_RANGE='bytes=0-99').streaming_content)
+        b''.join(self.client.get(self.url, HTTP_RANGE='bytes=100-').streaming_content)
+        self.assertEqual(self.xas_file.xasdownloadfile_set.count(), 1)
+
+    @override_settings(XASDB_DOWNLOAD_BACKEND='x-accel-redirect', XASDB_DOWNLOAD_INTERNAL_PREFIX='/protected-media/')
+    def test_x_accel_redirect(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.upload_file_name)
+        self.assertEqual(response.get('Content-Disposition'), 'attachment; filename="{}"'.format(basename(self.upload_file_name)))
+        self.assertEqual(response.content, b'')
+        self.assertEqual(self.xas_file.xasdownloadfile_set.count(), 1)
+
+    @override_settings(XASDB_DOWNLOAD_BACKEND='x-sendfile')
+    def test_x_sendfile(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Sendfile'], join(TEMPDIR.name, self.upload_file_name))
+        self.assertEqual(response.content, b'')
+
+    @override_settings(XASDB_DOWNLOAD_BACKEND='x-accel-redirect')
+    def test_permissions_checked_before_offloading(self):
+        self.client.logout()
+        User.objects.create_user(username=2*USERNAME, password=2*PASSWORD)
+        self.client.login(username=2*USERNAME, password=2*PASSWORD)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn('X-Accel-Redirect', response)
+        self.assertEqual(self.xas_file.xasdownloadfile_set.count(), 0)
+
+@override_settings(XASDB_DOWNLOAD_LOG_BATCH_SIZE=3, XASDB_DOWNLOAD_LOG_FLUSH_INTERVAL=3600)
+@override_settings(**OVERRIDE_SETTINGS)
+class DownloadLogTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        aux_file1 = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'bad', 'bad_01.xdi')
+        with open(test_file) as fp, open(aux_file1) as aux_fp1:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, **{'upload_file':fp, 'upload_file_doi':DOI, 'form-0-aux_description': 'aux', 'form-0-aux_file': aux_fp1}), follow=True)
+        self.xas_file = XASFile.objects.get()
+        self.aux_file = self.xas_file.xasuploadauxdata_set.get()
+        download_log.drain()
+        download_log._pending.update(count=0, oldest=None)
+
+    def _download(self, path_id):
+        response = self.client.get(reverse('xasdb1:download', args=[path_id]))
+        self.assertEqual(response.status_code, 200)
+        b''.join(response.streaming_content)
+
+    def test_batches(self):
+        self._download(self.xas_file.upload_file.name)
+        self._download(self.aux_file.aux_file.name)
+        self.assertEqual(XASDownloadFile.objects.count(), 0)
+        self.assertEqual(XASDownloadAuxData.objects.count(), 0)
+        before = timezone.now()
+        with CaptureQueriesContext(connection) as queries:
+            self._download(self.xas_file.upload_file.name)
+        self.assertEqual(XASDownloadFile.objects.count(), 2)
+        self.assertEqual(XASDownloadAuxData.objects.count(), 1)
+        self.assertEqual(XASDownloadFile.objects.filter(downloader=self.user).count(), 2)
+        # the timestamps are those of the downloads, not of the flush
+        self.assertLess(XASDownloadFile.objects.earliest('download_timestamp').download_timestamp, before)
+        self.assertEqual(os.listdir(settings.XASDB_DOWNLOAD_LOG_DIR), [])
+
+    def test_flush_interval(self):
+        with mock.patch('xasdb1.download_log.time.monotonic', return_value=1000.0):
+            self._download(self.xas_file.upload_file.name)
+        self.assertEqual(XASDownloadFile.objects.count(), 0)
+        with mock.patch('xasdb1.download_log.time.monotonic', return_value=1000.0 + 3600):
+            self._download(self.xas_file.upload_file.name)
+        self.assertEqual(XASDownloadFile.objects.count(), 2)
+
+    def test_flush_download_log_command(self):
+        self._download(self.xas_file.upload_file.name)
+        # the spool of a process that died, and a flush that was interrupted
+        event = json.dumps(dict(kind='aux', file=self.aux_file.id, downloader=self.user.id, timestamp=timezone.now().isoformat()))
+        with open(join(settings.XASDB_DOWNLOAD_LOG_DIR, 'downloads.999999.log'), 'w') as f:
+            f.write(event + '\n' + event + '\n' + '{"kind": "aux", "fi')
+        with open(join(settings.XASDB_DOWNLOAD_LOG_DIR, 'downloads.999998.log.0123.flushing'), 'w') as f:
+            f.write(event + '\n')
+        out = StringIO()
+        call_command('flush_download_log', stdout=out)
+        self.assertIn('stored 4 download events', out.getvalue())
+        self.assertEqual(XASDownloadFile.objects.count(), 1)
+        self.assertEqual(XASDownloadAuxData.objects.count(), 3)
+        self.assertEqual(os.listdir(settings.XASDB_DOWNLOAD_LOG_DIR), [])
+
+    def test_deleted_files_and_users(self):
+        other = User.objects.create_user(username=2*USERNAME, password=2*PASSWORD)
+        download_log.log_download('file', self.xas_file.id, other.id)
+        self._download(self.aux_file.aux_file.name)
+        # both are gone before the events are stored
+        other.delete()
+        self.aux_file.delete()
+        self.assertEqual(download_log.drain(), 1)
+        self.assertEqual(XASDownloadFile.objects.get().downloader, None)
+        self.assertEqual(XASDownloadAuxData.objects.count(), 0)
+
+@override_settings(**OVERRIDE_SETTINGS)
+class DownloadStatsTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.other = User.objects.create_user(username=2*USERNAME, password=2*PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        aux_file1 = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'bad', 'bad_01.xdi')
+        with open(test_file) as fp, open(aux_file1) as aux_fp1:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, **{'upload_file':fp, 'upload_file_doi':DOI, 'form-0-aux_description': 'aux', 'form-0-aux_file': aux_fp1}), follow=True)
+        self.xas_file = XASFile.objects.get()
+        self.xas_file.review_status = XASFile.APPROVED
+        self.xas_file.save()
+        self.aux_file = self.xas_file.xasuploadauxdata_set.get()
+
+    def test_counters(self):
+        for user_id in (self.user.id, self.user.id, self.other.id):
+            download_log.log_download('file', self.xas_file.id, user_id)
+        download_log.log_download('aux', self.aux_file.id, self.other.id)
+        stats = XASFileDownloadStats.objects.get(file=self.xas_file)
+        self.assertEqual((stats.total_downloads, stats.unique_downloaders, stats.downloads_7_days, stats.downloads_30_days), (3, 2, 3, 3))
+        stats = XASAuxDownloadStats.objects.get(file=self.aux_file)
+        self.assertEqual((stats.total_downloads, stats.unique_downloaders, stats.downloads_7_days, stats.downloads_30_days), (1, 1, 1, 1))
+        self.assertEqual(XASFileDownloadDay.objects.get().downloads, 3)
+
+        response = self.client.get(reverse('xasdb1:file', args=[self.xas_file.id]))
+        self.assertContains(response, '3 by 2 users, 3 in the last 30 days')
+
+    def test_rolling_windows(self):
+        download_log.log_download('file', self.xas_file.id, self.user.id)
+        today = timezone.localdate()
+        self.assertEqual(download_stats.refresh_download_stats(today), 0)
+        self.assertEqual(download_stats.refresh_download_stats(today + timedelta(days=7)), 1)
+        stats = XASFileDownloadStats.objects.get(file=self.xas_file)
+        self.assertEqual((stats.total_downloads, stats.downloads_7_days, stats.downloads_30_days), (1, 0, 1))
+        self.assertEqual(download_stats.refresh_download_stats(today + timedelta(days=30)), 1)
+        stats = XASFileDownloadStats.objects.get(file=self.xas_file)
+        self.assertEqual((stats.total_downloads, stats.downloads_7_days, stats.downloads_30_days), (1, 0, 0))
+        self.assertEqual(XASFileDownloadDay.objects.count(), 0)
+
+    def test_rebuild(self):
+        now = timezone.now()
+        XASDownloadFile.objects.bulk_create([
+            XASDownloadFile(file=self.xas_file, downloader=self.user, download_timestamp=now - timedelta(days=100)),
+            XASDownloadFile(file=self.xas_file, downloader=self.other, download_timestamp=now - timedelta(days=10)),
+            XASDownloadFile(file=self.xas_file, downloader=self.other, download_timestamp=now),
+        ])
+        XASDownloadAuxData.objects.create(file=self.aux_file, downloader=self.user)
+        out = StringIO()
+        call_command('refresh_download_stats', '--rebuild', stdout=out)
+        self.assertIn('rebuilt', out.getvalue())
+        stats = XASFileDownloadStats.objects.get(file=self.xas_file)
+        self.assertEqual((stats.total_downloads, stats.unique_downloaders, stats.downloads_7_days, stats.downloads_30_days), (3, 2, 1, 2))
+        self.assertEqual(XASAuxDownloadStats.objects.get(file=self.aux_file).total_downloads, 1)
+        # new downloads carry on from there
+        download_log.log_download('file', self.xas_file.id, self.user.id)
+        stats = XASFileDownloadStats.objects.get(file=self.xas_file)
+        self.assertEqual((stats.total_downloads, stats.unique_downloaders, stats.downloads_7_days, stats.downloads_30_days), (4, 2, 2, 3))
+
+    @override_settings(XASDB_ELEMENT_PAGE_SIZE=2)
+    def test_sort_by_popularity(self):
+        XASFile.objects.bulk_create([XASFile(upload_file=f'uploads/dummy_{i}.xdi', element='Fe', sample_name=f'sample {i}', uploader=self.user, review_status=XASFile.APPROVED) for i in range(4)])
+        dummies = list(XASFile.objects.filter(upload_file__startswith='uploads/dummy_').order_by('sample_name'))
+        ndownloads = dict(zip((file.id for file in dummies), (1, 3, 0, 3)))
+        for file_id, n in ndownloads.items():
+            for i in range(n):
+                download_log.log_download('file', file_id, self.user.id)
+        expected = [file.id for file in sorted(XASFile.objects.filter(element='Fe'), key=lambda file: (-ndownloads.get(file.id, 0), file.sample_name, file.id))]
+
+        seen = []
+        url = reverse('xasdb1:element', args=['Fe']) + '?sort=popular'
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            seen.extend(file.id for file in response.context['files'])
+            cursor = response.context['next_cursor']
+            url = reverse('xasdb1:element', args=['Fe']) + f'?sort=popular&after={cursor}' if cursor else None
+        self.assertEqual(seen, expected)
+        self.assertContains(response, '<td>0</td>')
+        # the counters come with the listing itself
+        nqueries = len(queries)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('xasdb1:element', args=['Fe']))
+        self.assertEqual(len(queries), nqueries)
+
+@override_settings(XASDB_CROSSREF_CLIENT='xasdb1.benchmark.CrossrefStub', XASDB_CROSSREF_BACKGROUND_REFRESH=False, **OVERRIDE_SETTINGS)
+class BenchmarkTests(TransactionTestCase):
+    def test_run_benchmark(self):
+        results = benchmark.run_benchmark(3, 1, 4, views=list(benchmark.BENCHMARK_VIEWS))
+        self.assertEqual(results['parameters']['spectra'], 3)
+        self.assertEqual(XASFile.objects.count(), 3 + 4)
+        for view, result in results['views'].items():
+            self.assertEqual(result['requests'], 4, view)
+            self.assertEqual(result['errors'], 0, view)
+            self.assertLessEqual(result['latency']['p50'], result['latency']['p99'])
+            self.assertGreater(result['queries']['mean'], 0)
+        # machine readable
+        json.dumps(results)
+
+    def test_command(self):
+        # in a process of its own: the command sets up a test environment and a throwaway database, with settings of their own
+        result = subprocess.run([sys.executable, 'manage.py', 'benchmark', '--spectra', '1', '--clients', '1', '--requests', '1', '--warmup', '0'],
+            cwd=settings.BASE_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=300)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('element', result.stdout)
+
+    def test_compare(self):
+        baseline = dict(views=dict(file=dict(latency=dict(p95=10.0), queries=dict(mean=4.0)), element=dict(latency=dict(p95=5.0), queries=dict(mean=2.0))))
+        results = dict(views=dict(file=dict(latency=dict(p95=15.0), queries=dict(mean=4.0)), download=dict(latency=dict(p95=1.0), queries=dict(mean=1.0))))
+        self.assertEqual(benchmark.compare(results, baseline), dict(file=dict(p95=0.5, queries=0.0)))
+
+    def test_percentiles(self):
+        self.assertEqual(benchmark.percentiles(list(range(101))), dict(p50=50.0, p95=95.0, p99=99.0))
+        self.assertEqual(benchmark.percentiles([]), dict(p50=None, p95=None, p99=None))
+
+@override_settings(XASDB_CROSSREF_CLIENT='xasdb1.tests.CrossrefStub', XASDB_CROSSREF_BACKGROUND_REFRESH=False, XASDB_INSTRUMENTATION_SAMPLE_RATE=1.0, **OVERRIDE_SETTINGS)
+class InstrumentationTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        with open(test_file) as fp:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, **{'upload_file':fp, 'upload_file_doi':DOI}), follow=True)
+        self.xas_file = XASFile.objects.get()
+        XASDOIMetadata.objects.all().delete()
+        caches['plots'].clear()
+
+    def test_file_page(self):
+        with self.assertLogs('xasdb1.instrumentation', 'INFO') as logs:
+            response = self.client.get(reverse('xasdb1:file', args=[self.xas_file.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([entry.strip().split(';')[0] for entry in response['Server-Timing'].split(',')], ['db', 'plot', 'crossref', 'render', 'total'])
+        self.assertRegex(response['Server-Timing'], r'db;dur=[0-9.]+;desc="[0-9]+ queries \([0-9]+ duplicated\)"')
+
+        self.assertEqual(len(logs.records), 1)
+        record = logs.records[0].metrics
+        self.assertEqual(record['view'], 'xasdb1:file')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['queries'], 0)
+        self.assertEqual(json.loads(logs.records[0].getMessage()[len('request '):]), record)
+        for name in ('total_ms', 'db_ms', 'crossref_ms', 'plot_ms', 'render_ms'):
+            self.assertGreaterEqual(record[name], 0, name)
+
+        # the second time the plot and the Crossref metadata come from their caches
+        response = self.client.get(reverse('xasdb1:file', args=[self.xas_file.id]))
+        self.assertEqual([entry.strip().split(';')[0] for entry in response['Server-Timing'].split(',')], ['db', 'render', 'total'])
+
+    @override_settings(XASDB_INSTRUMENTATION_SAMPLE_RATE=0.0)
+    def test_not_sampled(self):
+        response = self.client.get(reverse('xasdb1:file', args=[self.xas_file.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(XASDB_INSTRUMENTATION_SERVER_TIMING=False)
+    def test_log_only(self):
+        with self.assertLogs('xasdb1.instrumentation', 'INFO') as logs:
+            response = self.client.get(reverse('xasdb1:element', args=['Fe']))
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(logs.records[0].metrics['view'], 'xasdb1:element')
+
+    def test_duplicates(self):
+        metrics = instrumentation.RequestMetrics()
+        with connection.execute_wrapper(metrics):
+            for i in range(3):
+                list(XASFile.objects.filter(id=self.xas_file.id))
+            list(XASFile.objects.filter(id=self.xas_file.id + 1))
+        self.assertEqual(metrics.queries, 4)
+        self.assertEqual(metrics.duplicates, 2)
+
+@override_settings(**OVERRIDE_SETTINGS)
+class ElementCountsTests(TransactionTestCase):
+    def setUp(self):
+        caches['counts'].clear()
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.other = User.objects.create_user(username=2*USERNAME, password=2*PASSWORD)
+        self.staff = User.objects.create_superuser(username=SU_USERNAME, password=SU_PASSWORD, email=SU_EMAIL)
+        for i, (element, uploader, review_status) in enumerate((
+                ('Fe', self.user, XASFile.APPROVED),
+                ('Fe', self.other, XASFile.APPROVED),
+                ('Fe', self.user, XASFile.PENDING),
+                ('Fe', self.other, XASFile.REJECTED),
+                ('Cu', self.other, XASFile.PENDING))):
+            XASFile.objects.create(upload_file=f'uploads/dummy_{i}.xdi', element=element, uploader=uploader, review_status=review_status)
+
+    def test_visibility(self):
+        self.assertEqual(element_counts(AnonymousUser()), dict(Fe=2, Cu=0))
+        self.assertEqual(element_counts(self.user), dict(Fe=3, Cu=0))
+        self.assertEqual(element_counts(self.other), dict(Fe=3, Cu=1))
+        self.assertEqual(element_counts(self.staff), dict(Fe=4, Cu=1))
+
+    def test_one_cached_query(self):
+        with self.assertNumQueries(1):
+            element_counts(AnonymousUser())
+        with self.assertNumQueries(0):
+            element_counts(AnonymousUser())
+            element_counts(self.staff)
+        with self.assertNumQueries(1):
+            element_counts(self.user)
+        with self.assertNumQueries(0):
+            element_counts(self.user)
+
+    def test_invalidation(self):
+        self.assertEqual(element_counts(AnonymousUser())['Fe'], 2)
+        self.assertEqual(element_counts(self.user)['Fe'], 3)
+        # upload
+        XASFile.objects.create(upload_file='uploads/new.xdi', element='Fe', uploader=self.user)
+        self.assertEqual(element_counts(AnonymousUser())['Fe'], 2)
+        self.assertEqual(element_counts(self.user)['Fe'], 4)
+        # review
+        xas_file = XASFile.objects.get(upload_file='uploads/new.xdi')
+        xas_file.review_status = XASFile.APPROVED
+        xas_file.save()
+        self.assertEqual(element_counts(AnonymousUser())['Fe'], 3)
+        self.assertEqual(element_counts(self.user)['Fe'], 4)
+        # delete
+        xas_file.delete()
+        self.assertEqual(element_counts(AnonymousUser())['Fe'], 2)
+        self.assertEqual(element_counts(self.user)['Fe'], 3)
+
+    def test_cached_during_transaction(self):
+        # a request that runs while a file is being ingested counts without it
+        self.assertEqual(element_counts(AnonymousUser())['Fe'], 2)
+        stale = caches['counts'].get(ELEMENT_COUNTS_KEY)
+        with transaction.atomic():
+            XASFile.objects.create(upload_file='uploads/new.xdi', element='Fe', uploader=self.user, review_status=XASFile.APPROVED)
+            caches['counts'].set(ELEMENT_COUNTS_KEY, stale)
+            self.assertEqual(element_counts(AnonymousUser())['Fe'], 2)
+        self.assertEqual(element_counts(AnonymousUser())['Fe'], 3)
+
+    def test_other_process(self):
+        # such as the ingest_worker storing a file, or another web worker approving one
+        self.assertEqual(element_counts(AnonymousUser())['Fe'], 2)
+        XASFile.objects.filter(uploader=self.user, review_status=XASFile.PENDING).update(review_status=XASFile.APPROVED)
+        process = multiprocessing.get_context('fork').Process(target=invalidate_element_counts, args=(self.user.id,))
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(element_counts(AnonymousUser())['Fe'], 3)
+
+    def test_periodic_table(self):
+        response = self.client.get(reverse('xasdb1:index'))
+        self.assertContains(response, '<td class="mendeljev-cell" title="2 spectra"><a class="mendeljev-anchor" href="{}">Fe<span class="mendeljev-count">2</span></a></td>'.format(reverse('xasdb1:element', args=['Fe'])), html=True)
+        self.assertContains(response, '<td class="mendeljev-cell mendeljev-empty" title="No spectra">Cu</td>', html=True)
+        self.assertNotContains(response, reverse('xasdb1:element', args=['Cu']))
+        self.client.login(username=2*USERNAME, password=2*PASSWORD)
+        response = self.client.get(reverse('xasdb1:element', args=['Fe']))
+        self.assertContains(response, '<td class="mendeljev-cell" title="1 spectrum"><a class="mendeljev-anchor" href="{}">Cu<span class="mendeljev-count">1</span></a></td>'.format(reverse('xasdb1:element', args=['Cu'])), html=True)
+
+@override_settings(**OVERRIDE_SETTINGS)
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        other = User.objects.create_user(username=2*USERNAME, password=2*PASSWORD)
+        self.files = dict()
+        for key, element, edge, sample_name, sample_prep, beamline_name, uploader, review_status in (
+                ('hematite', 'Fe', xrl.K_SHELL, 'Fe2O3 hematite', 'pellet in BN', 'B18', self.user, XASFile.APPROVED),
+                ('hematite_l', 'Fe', xrl.L3_SHELL, 'Fe2O3', 'thin film', 'I20', self.user, XASFile.APPROVED),
+                ('prep', 'Fe', xrl.K_SHELL, 'iron oxide', 'mixed with Fe2O3 and cellulose', 'B18', self.user, XASFile.APPROVED),
+                ('pending', 'Fe', xrl.K_SHELL, 'Fe2O3 pending', 'pellet', 'B18', other, XASFile.PENDING),
+                ('copper', 'Cu', xrl.K_SHELL, 'Cu foil', 'foil', 'B18', self.user, XASFile.APPROVED)):
+            self.files[key] = XASFile.objects.create(upload_file=f'uploads/{key}.xdi', element=element, edge=edge, sample_name=sample_name, sample_prep=sample_prep, beamline_name=beamline_name, facility_name='Diamond', uploader=uploader, review_status=review_status)
+
+    def _ids(self, response):
+        return [file.id for file in response.context['page']]
+
+    def test_terms(self):
+        self.assertEqual(search_terms('  Fe2O3 +B18 -"fe2o3" (foo*)  '), ['fe2o3', 'b18', 'foo'])
+        self.assertEqual(boolean_query(['fe2o3', 'b18']), '+fe2o3* +b18*')
+        sql = str(XASFile.objects.annotate(relevance=MatchAgainst('+fe2o3*')).query)
+        self.assertIn('MATCH ("xasdb1_xasfile"."sample_name", "xasdb1_xasfile"."sample_prep", "xasdb1_xasfile"."beamline_name", "xasdb1_xasfile"."facility_name", "xasdb1_xasfile"."mono_name") AGAINST (+fe2o3* IN BOOLEAN MODE)', sql)
+
+    def test_ranked(self):
+        response = self.client.get(reverse('xasdb1:search'), {'q': 'fe2o3 b18'})
+        self.assertEqual(self._ids(response), [self.files['hematite'].id, self.files['prep'].id])
+        self.assertContains(response, '2 spectra found for fe2o3 b18')
+        response = self.client.get(reverse('xasdb1:search'), {'q': 'Fe2O3'})
+        # matches in the sample name come first
+        self.assertEqual(self._ids(response), [self.files['hematite_l'].id, self.files['hematite'].id, self.files['prep'].id])
+
+    def test_visibility(self):
+        response = self.client.get(reverse('xasdb1:search'), {'q': 'pending'})
+        self.assertEqual(self._ids(response), [])
+        self.client.login(username=2*USERNAME, password=2*PASSWORD)
+        response = self.client.get(reverse('xasdb1:search'), {'q': 'pending'})
+        self.assertEqual(self._ids(response), [self.files['pending'].id])
+
+    def test_facets(self):
+        response = self.client.get(reverse('xasdb1:search'), {'q': 'diamond'})
+        self.assertEqual(len(self._ids(response)), 4)
+        facets = dict((facet, [(label, count) for label, count, _, _ in values]) for facet, values, _ in response.context['facets'])
+        self.assertEqual(facets['element'], [('Fe', 3), ('Cu', 1)])
+        self.assertEqual(facets['edge'], [('K', 3), ('L3', 1)])
+        self.assertEqual(facets['beamline'], [('B18', 3), ('I20', 1)])
+
+        response = self.client.get(reverse('xasdb1:search'), {'q': 'diamond', 'element': 'Fe', 'beamline': 'B18'})
+        self.assertEqual(set(self._ids(response)), set((self.files['hematite'].id, self.files['prep'].id)))
+        facets = dict((facet, [(label, count) for label, count, _, _ in values]) for facet, values, _ in response.context['facets'])
+        # the counts of a facet ignore its own selection
+        self.assertEqual(facets['element'], [('Fe', 2), ('Cu', 1)])
+        self.assertEqual(facets['beamline'], [('B18', 2), ('I20', 1)])
+        self.assertEqual(facets['edge'], [('K', 2)])
+
+        # nonsense is ignored
+        response = self.client.get(reverse('xasdb1:search'), {'q': 'diamond', 'edge': 'K'})
+        self.assertEqual(len(self._ids(response)), 4)
+
+    @override_settings(XASDB_SEARCH_PAGE_SIZE=2)
+    def test_pages(self):
+        seen = []
+        response = self.client.get(reverse('xasdb1:search'), {'q': 'diamond'})
+        seen.extend(self._ids(response))
+        self.assertIsNone(response.context['previous_url'])
+        response = self.client.get(response.context['next_url'])
+        seen.extend(self._ids(response))
+        self.assertIsNone(response.context['next_url'])
+        self.assertEqual(len(seen), 4)
+        self.assertEqual(len(set(seen)), 4)
+
+    def test_empty(self):
+        response = self.client.get(reverse('xasdb1:search'), {'q': '  +-* '})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context['page'])
+        response = self.client.get(reverse('xasdb1:search'), {'q': 'unobtainium'})
+        self.assertContains(response, 'No spectra found for unobtainium')
+
+    def test_api(self):
+        response = self.client.get(reverse('xasdb1:api_search'), {'q': 'fe2o3 b18'})
+        data = response.json()
+        self.assertEqual(data['count'], 2)
+        self.assertEqual([result['id'] for result in data['results']], [self.files['hematite'].id, self.files['prep'].id])
+        self.assertEqual(data['results'][0]['url'], reverse('xasdb1:file', args=[self.files['hematite'].id]))
+        self.assertEqual(data['facets']['edge'], [['K', 2]])
+
+class SimilarityFeaturesTests(unittest.TestCase):
+    def test_features(self):
+        energy = np.linspace(7000, 7300, 301)
+        mu = np.arctan((energy - 7112) / 3)
+        grid = 7112 + np.linspace(-30, 150, 64)
+        features = similarity_features(energy, mu, grid)
+        self.assertEqual(features.shape, (64,))
+        self.assertAlmostEqual(float(np.linalg.norm(features)), 1.0, places=5)
+        # offset, scale, order and gaps do not matter
+        mu2 = 5 * mu + 2
+        mu2[10] = np.nan
+        np.testing.assert_allclose(similarity_features(energy[::-1], mu2[::-1], grid), features, atol=1e-5)
+        # not enough of the grid covered
+        self.assertIsNone(similarity_features(energy[:100], mu[:100], grid))
+        self.assertIsNone(similarity_features(energy, np.ones_like(energy), grid))
+
+@override_settings(**OVERRIDE_SETTINGS)
+class SimilarityTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser(username=SU_USERNAME, password=SU_PASSWORD, email=SU_EMAIL)
+        self.client.login(username=SU_USERNAME, password=SU_PASSWORD)
+        self.files = dict()
+        for name in ('fe_metal_rt', 'fe2o3_rt', 'feo_rt1', 'fe3c_rt', 'cu_metal_rt'):
+            self.files[name] = self._upload(name)
+        XASFile.objects.exclude(id=self.files['fe3c_rt'].id).update(review_status=XASFile.APPROVED)
+        self.client.logout()
+
+    def _upload(self, name):
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', name + '.xdi')
+        with open(test_file) as fp:
+            response = self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI))
+        return XASFile.objects.get(id=response.url.split('/')[-2])
+
+    def _ids(self, response):
+        return [file.id for file, _ in response.context['results']]
+
+    def test_stored_at_ingest(self):
+        features = self.files['fe_metal_rt'].get_arrays(SIMILARITY_ARRAY)[SIMILARITY_ARRAY]
+        self.assertEqual(features.shape, (settings.XASDB_SIMILARITY_GRID[2],))
+
+    def test_similar(self):
+        response = self.client.get(reverse('xasdb1:similar', args=[self.files['fe_metal_rt'].id]))
+        self.assertEqual(response.status_code, 200)
+        # approved Fe K spectra only, without the spectrum itself
+        self.assertEqual(set(self._ids(response)), {self.files['fe2o3_rt'].id, self.files['feo_rt1'].id})
+        scores = [score for _, score in response.context['results']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        self.assertContains(response, self.files['fe2o3_rt'].sample_name)
+
+        response = self.client.get(reverse('xasdb1:similar', args=[self.files['fe_metal_rt'].id]), {'n': 1})
+        self.assertEqual(len(self._ids(response)), 1)
+
+        # pending spectra are not for everyone to see
+        response = self.client.get(reverse('xasdb1:similar', args=[self.files['fe3c_rt'].id]))
+        self.assertRedirects(response, reverse('xasdb1:index'))
+
+    def test_upload(self):
+        self.client.login(username=SU_USERNAME, password=SU_PASSWORD)
+        count = XASFile.objects.count()
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'feo_rt1.xdi')
+        with open(test_file) as fp:
+            response = self.client.post(reverse('xasdb1:similar_upload'), {'upload_file': fp})
+        self.assertEqual(response.status_code, 200)
+        results = response.context['results']
+        self.assertEqual(results[0][0].id, self.files['feo_rt1'].id)
+        self.assertAlmostEqual(results[0][1], 1.0, places=4)
+        self.assertEqual(XASFile.objects.count(), count)
+
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'bad', 'bad_01.xdi')
+        with open(test_file) as fp:
+            response = self.client.post(reverse('xasdb1:similar_upload'), {'upload_file': fp})
+        self.assertIsNone(response.context['results'])
+        self.assertContains(response, 'not an XDI file')
+
+    def test_upload_errors(self):
+        # anonymous users do not get to have their files parsed
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'feo_rt1.xdi')
+        with open(test_file) as fp:
+            response = self.client.post(reverse('xasdb1:similar_upload'), {'upload_file': fp})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith(reverse('xasdb1:login')))
+
+        self.client.login(username=SU_USERNAME, password=SU_PASSWORD)
+        with open(test_file) as fp:
+            content = fp.read()
+        upload = SimpleUploadedFile('unknown.xdi', content.replace('Element.symbol: Fe', 'Element.symbol: Xx').encode('utf-8'))
+        response = self.client.post(reverse('xasdb1:similar_upload'), {'upload_file': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context['results'])
+        self.assertTrue(response.context['form'].errors['upload_file'])
+
+        # valid XDI, but nothing to be done with it
+        with mock.patch('xasdb1.views.extract_xdi_data', side_effect=AttributeError('no energy column')):
+            response = self.client.post(reverse('xasdb1:similar_upload'), {'upload_file': SimpleUploadedFile('feo.xdi', content.encode('utf-8'))})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context['results'])
+        self.assertContains(response, 'no energy column')
+
+    def test_matrix_cache(self):
+        url = reverse('xasdb1:api_file_similar', args=[self.files['fe_metal_rt'].id])
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        # only the features of the spectrum itself
+        self.assertEqual(len([query for query in queries if 'xasdb1_xasarray' in query['sql']]), 1)
+        self.assertEqual(len(response.json()['results']), 2)
+
+        fe3c = self.files['fe3c_rt']
+        fe3c.review_status = XASFile.APPROVED
+        fe3c.save()
+        data = self.client.get(url).json()
+        self.assertIn(fe3c.id, [result['id'] for result in data['results']])
+        self.assertEqual(data['edge'], 'K')
+        self.assertEqual(self.client.get(reverse('xasdb1:api_file_similar', args=[self.files['cu_metal_rt'].id])).json()['results'], [])
+        self.assertEqual(self.client.get(reverse('xasdb1:api_file_similar', args=[fe3c.id + 100])).status_code, 404)
+
+    def test_scan(self):
+        # many spectra, one of them the one asked for
+        rng = np.random.RandomState(0)
+        matrix = rng.normal(size=(20000, 256)).astype(np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1)[:, np.newaxis]
+        file_ids = np.arange(20000, dtype=np.int64)
+        with mock.patch.object(similarity, 'feature_matrix', return_value=(file_ids, matrix)):
+            results = similarity.most_similar(matrix[1234], 'Fe', xrl.K_SHELL, 5)
+            self.assertEqual(results[0][0], 1234)
+            self.assertAlmostEqual(results[0][1], 1.0, places=4)
+            self.assertNotIn(1234, [file_id for file_id, _ in similarity.most_similar(matrix[1234], 'Fe', xrl.K_SHELL, 5, exclude=1234)])
+
+    def test_rebuild(self):
+        XASArray.objects.filter(name=SIMILARITY_ARRAY).delete()
+        # the features of the spectrum asked for can be computed on the fly, those of the others are missing until rebuilt
+        response = self.client.get(reverse('xasdb1:similar', args=[self.files['fe_metal_rt'].id]))
+        self.assertEqual(response.context['results'], [])
+        call_command('rebuild_arrays', stdout=StringIO())
+        self.assertEqual(XASArray.objects.filter(name=SIMILARITY_ARRAY).count(), 5)
+        response = self.client.get(reverse('xasdb1:similar', args=[self.files['fe_metal_rt'].id]))
+        self.assertEqual(len(response.context['results']), 2)
+
+class NormalizeTests(unittest.TestCase):
+    def test_normalize(self):
+        energy = np.arange(6900.0, 7700.0, 0.5)
+        pre_edge = 0.2 + 1e-4 * (energy - 6900)
+        mu = pre_edge + 1.5 * 0.5 * (1 + np.tanh((energy - 7115) / 3))
+        mu[100] = np.nan
+        e0, edge_step, mu_norm = normalize(energy, mu, 7112.0, 30.0, (-150.0, -30.0), (50.0, None), 2)
+        self.assertAlmostEqual(e0, 7115.0, delta=0.5)
+        self.assertAlmostEqual(edge_step, 1.5, places=2)
+        self.assertEqual(mu_norm.shape, energy.shape)
+        self.assertTrue(np.isnan(mu_norm[100]))
+        np.testing.assert_allclose(mu_norm[(energy < 7085) & np.isfinite(mu)], 0.0, atol=1e-3)
+        np.testing.assert_allclose(mu_norm[energy > 7165], 1.0, atol=1e-2)
+        # the order of the points does not matter
+        np.testing.assert_allclose(normalize(energy[::-1], mu[::-1], 7112.0, 30.0, (-150.0, -30.0), (50.0, None), 2)[2], mu_norm[::-1])
+        # no pre-edge, or no edge anywhere near
+        self.assertIsNone(normalize(energy[energy > 7100], mu[energy > 7100], 7112.0, 30.0, (-150.0, -30.0), (50.0, None), 2))
+        self.assertIsNone(normalize(energy, mu, 8979.0, 30.0, (-150.0, -30.0), (50.0, None), 2))
+
+@override_settings(**OVERRIDE_SETTINGS)
+class NormalizationTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser(username=SU_USERNAME, password=SU_PASSWORD, email=SU_EMAIL)
+        self.client.login(username=SU_USERNAME, password=SU_PASSWORD)
+        for name in ('fe_metal_rt', 'feo_rt1', 'cu_metal_rt'):
+            test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', name + '.xdi')
+            with open(test_file) as fp:
+                self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI))
+        self.xas_file = XASFile.objects.filter(element='Fe').order_by('id').first()
+        caches['plots'].clear()
+
+    def test_stored_at_ingest(self):
+        self.assertAlmostEqual(self.xas_file.e0, 7112.0, delta=3.0)
+        self.assertGreater(self.xas_file.edge_step, 0)
+        mu_norm = self.xas_file.get_arrays(NORMALIZED_ARRAY)[NORMALIZED_ARRAY]
+        energy = self.xas_file.get_arrays('energy')['energy']
+        self.assertEqual(mu_norm.shape, energy.shape)
+        self.assertAlmostEqual(float(np.nanmean(mu_norm[energy < self.xas_file.e0 - 50])), 0.0, places=2)
+        self.assertTrue(XASFile.objects.filter(element='Cu', e0__gt=8970, e0__lt=8990).exists())
+
+    def test_file_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('xasdb1:file', args=[self.xas_file.id]))
+        # both tabs in one plot, from one query
+        self.assertContains(response, 'class="bk-root"', count=1)
+        self.assertContains(response, 'Normalized')
+        self.assertContains(response, '{:.1f} eV'.format(self.xas_file.e0))
+        self.assertEqual(len([query for query in queries if 'xasdb1_xasarray' in query['sql']]), 1)
+
+    def test_batch(self):
+        XASArray.objects.filter(Q(name=NORMALIZED_ARRAY) | Q(name__startswith=NORMALIZED_ARRAY + '@')).delete()
+        XASFile.objects.update(e0=None, edge_step=None)
+        version = XASFile.objects.get(id=self.xas_file.id).content_version
+        out = StringIO()
+        call_command('normalize_spectra', '--batch-size', '2', stdout=out)
+        self.assertIn('normalized 3 of 3 files', out.getvalue())
+        xas_file = XASFile.objects.get(id=self.xas_file.id)
+        self.assertAlmostEqual(xas_file.e0, self.xas_file.e0)
+        self.assertNotEqual(xas_file.content_version, version)
+        self.assertEqual(XASArray.objects.filter(name=NORMALIZED_ARRAY).count(), 3)
+        self.assertEqual(XASArray.objects.filter(name=SIMILARITY_ARRAY).count(), 3)
+
+        # the number of queries does not grow with the number of files
+        XASFile.objects.update(e0=None)
+        with CaptureQueriesContext(connection) as queries:
+            call_command('normalize_spectra', '--missing', stdout=StringIO())
+        self.assertLess(len([query for query in queries if query['sql'].startswith('SELECT')]), 10)
+        self.assertFalse(XASFile.objects.filter(e0__isnull=True).exists())
+        out = StringIO()
+        call_command('normalize_spectra', '--missing', stdout=out)
+        self.assertIn('normalized 0 of 0 files', out.getvalue())
+
+class CommonGridTests(unittest.TestCase):
+    def test_common_grid(self):
+        grid, values = common_grid([([3.0, 1.0, 2.0], [30.0, 10.0, 20.0]), ([2.0, 5.0, np.nan], [0.0, 3.0, 1.0]), ([], [])], 9)
+        np.testing.assert_array_equal(grid, np.linspace(1.0, 5.0, 9))
+        self.assertEqual(values.shape, (3, 9))
+        np.testing.assert_allclose(values[0], [10, 15, 20, 25, 30] + [np.nan] * 4)
+        np.testing.assert_allclose(values[1], [np.nan] * 2 + [0, 0.5, 1, 1.5, 2, 2.5, 3])
+        self.assertTrue(np.isnan(values[2]).all())
+
+@override_settings(**OVERRIDE_SETTINGS)
+class CompareTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser(username=SU_USERNAME, password=SU_PASSWORD, email=SU_EMAIL)
+        self.client.login(username=SU_USERNAME, password=SU_PASSWORD)
+        self.ids = []
+        for name in ('fe_metal_rt', 'feo_rt1', 'fe2o3_rt'):
+            test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', name + '.xdi')
+            with open(test_file) as fp:
+                response = self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI))
+            self.ids.append(int(response.url.split('/')[-2]))
+        XASFile.objects.filter(id__in=self.ids[:2]).update(review_status=XASFile.APPROVED)
+
+    def test_compare(self):
+        with CaptureQueriesContext(connection) as queries, mock.patch('xasdb1.views._compare_plot', wraps=views._compare_plot) as compare_plot:
+            response = self.client.get(reverse('xasdb1:compare'), {'id': self.ids})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'class="bk-root"', count=1)
+        self.assertEqual([file.id for file in response.context['files']], self.ids)
+        # one query for the files, one for their arrays
+        self.assertEqual(len([query for query in queries if 'FROM "xasdb1_xasfile"' in query['sql']]), 1)
+        self.assertEqual(len([query for query in queries if 'xasdb1_xasarray' in query['sql']]), 1)
+        self.assertEqual(len([query for query in queries if 'xasdb1_xasmode' in query['sql']]), 1)
+        args, _ = compare_plot.call_args
+        grid, values, labels, yaxis_name = args
+        self.assertEqual(values.shape, (3, settings.XASDB_COMPARE_GRID_POINTS))
+        self.assertEqual(yaxis_name, 'Normalized absorption')
+        # normalized: all of them end up around 1 above the edge
+        self.assertTrue(all(0.5 < np.nanmean(row[grid > 7200]) < 1.5 for row in values))
+
+    def test_ids(self):
+        response = self.client.get(reverse('xasdb1:compare'), {'id': ['{},{}'.format(self.ids[1], self.ids[0]), 'foo', str(self.ids[1])]})
+        self.assertEqual([file.id for file in response.context['files']], [self.ids[1], self.ids[0]])
+        with override_settings(XASDB_COMPARE_MAX_SPECTRA=2):
+            response = self.client.get(reverse('xasdb1:compare'), {'id': self.ids})
+        self.assertEqual(len(response.context['files']), 2)
+        self.assertContains(response, 'At most 2 spectra')
+        response = self.client.get(reverse('xasdb1:compare'))
+        self.assertIsNone(response.context['plot'])
+
+    def test_raw(self):
+        with mock.patch('xasdb1.views._compare_plot', wraps=views._compare_plot) as compare_plot:
+            response = self.client.get(reverse('xasdb1:compare'), {'id': self.ids, 'y': 'raw'})
+        self.assertFalse(response.context['normalized'])
+        self.assertEqual(compare_plot.call_args[0][3], 'Absorption')
+        self.assertContains(response, response.context['normalized_url'].replace('&', '&amp;'))
+
+    def test_visibility(self):
+        self.client.logout()
+        response = self.client.get(reverse('xasdb1:compare'), {'id': self.ids})
+        self.assertEqual([file.id for file in response.context['files']], self.ids[:2])
+        self.assertContains(response, 'not accessible')
+
+    def test_raw_follows_modes(self):
+        # a fluorescence channel the file was not measured in does not take the place of its transmission spectrum
+        xas_file = XASFile.objects.get(id=self.ids[0])
+        self.assertEqual(list(xas_file.xasmode_set.values_list('mode', flat=True)), [XASMode.TRANSMISSION])
+        mu_trans = xas_file.get_arrays('mu_trans')['mu_trans']
+        XASArray.objects.create(file=xas_file, name='mu_fluor', data=np.ones_like(mu_trans))
+        with mock.patch('xasdb1.views.common_grid', wraps=views.common_grid) as grid:
+            self.client.get(reverse('xasdb1:compare'), {'id': self.ids[0], 'y': 'raw'})
+        np.testing.assert_array_equal(grid.call_args[0][0][0][1], mu_trans)
+
+    @override_settings(XASDB_COMPARE_PLOT_POINTS=50)
+    def test_downsampled(self):
+        with mock.patch('xasdb1.views.lttb', wraps=views.lttb) as downsample:
+            self.client.get(reverse('xasdb1:compare'), {'id': self.ids})
+        self.assertEqual(downsample.call_count, 3)
+        for call in downsample.call_args_list:
+            self.assertEqual(len(lttb(*call[0])), 50)
+
+    def test_element_page(self):
+        response = self.client.get(reverse('xasdb1:element', args=['Fe']))
+        self.assertContains(response, 'name="id" value="{}"'.format(self.ids[0]))
+        self.assertContains(response, reverse('xasdb1:compare'))
+
+@override_settings(**OVERRIDE_SETTINGS)
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        self.ids = []
+        aux_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'bad', 'bad_01.xdi')
+        for name in ('fe_metal_rt', 'feo_rt1', 'cu_metal_rt'):
+            test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', name + '.xdi')
+            with open(test_file) as fp, open(aux_file) as aux_fp:
+                response = self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, **{'upload_file': fp, 'upload_file_doi': DOI, 'form-0-aux_description': 'aux', 'form-0-aux_file': aux_fp}))
+            self.ids.append(int(response.url.split('/')[-2]))
+        XASFile.objects.filter(id__in=self.ids).update(review_status=XASFile.APPROVED)
+
+    def _export(self, params):
+        response = self.client.get(reverse('xasdb1:export'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertIn('attachment', response['Content-Disposition'])
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_export(self):
+        with self._export({'id': self.ids[:2]}) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            names = zip_file.namelist()
+            self.assertEqual(len(names), 5)
+            self.assertEqual(names[-1], 'manifest.csv')
+            for file in XASFile.objects.filter(id__in=self.ids[:2]):
+                with file.upload_file.open('rb') as f:
+                    self.assertEqual(zip_file.read('Fe/{}/{}'.format(file.id, file.name)), f.read())
+                aux = file.xasuploadauxdata_set.get()
+                with aux.aux_file.open('rb') as f:
+                    self.assertEqual(zip_file.read('Fe/{}/aux/{}'.format(file.id, aux.name)), f.read())
+            manifest = zip_file.read('manifest.csv').decode('utf-8').splitlines()
+        self.assertEqual(manifest[0], 'id,path,element,edge,sample_name,beamline,facility,doi,url')
+        self.assertEqual(len(manifest), 3)
+        self.assertTrue(manifest[1].startswith('{},Fe/{}/'.format(self.ids[0], self.ids[0])))
+        self.assertIn(HOST + reverse('xasdb1:file', args=[self.ids[0]]), manifest[1])
+
+    def test_selection(self):
+        with self._export({'element': 'Fe'}) as zip_file:
+            self.assertEqual(sorted(set(name.split('/')[1] for name in zip_file.namelist() if '/' in name)), sorted(str(file_id) for file_id in self.ids[:2]))
+        with self._export({'element': 'Cu', 'edge': xrl.K_SHELL}) as zip_file:
+            self.assertEqual(len(zip_file.namelist()), 3)
+        with self._export({'q': 'cu'}) as zip_file:
+            self.assertTrue(all(name.startswith('Cu/') for name in zip_file.namelist()[:-1]))
+        response = self.client.get(reverse('xasdb1:export'), {'edge': 'foo'}, follow=True)
+        self.assertContains(response, 'No spectra were selected')
+
+    def test_visibility(self):
+        XASFile.objects.filter(id=self.ids[0]).update(review_status=XASFile.PENDING)
+        other = User.objects.create_user(username=2*USERNAME, password=2*PASSWORD)
+        self.client.login(username=2*USERNAME, password=2*PASSWORD)
+        with self._export({'id': self.ids}) as zip_file:
+            self.assertFalse(any(name.startswith('Fe/{}/'.format(self.ids[0])) for name in zip_file.namelist()))
+            self.assertEqual(len(zip_file.namelist()), 5)
+        response = self.client.get(reverse('xasdb1:export'), {'id': self.ids[0]}, follow=True)
+        self.assertContains(response, 'None of the selected spectra are accessible')
+        # the uploader still gets it
+        self.client.login(username=USERNAME, password=PASSWORD)
+        with self._export({'id': self.ids[0]}) as zip_file:
+            self.assertEqual(len(zip_file.namelist()), 3)
+        self.client.logout()
+        response = self.client.get(reverse('xasdb1:export'), {'id': self.ids})
+        self.assertRedirects(response, reverse('xasdb1:login') + '?next=' + reverse('xasdb1:export') + '%3Fid%3D{}%26id%3D{}%26id%3D{}'.format(*self.ids), fetch_redirect_response=False)
+
+    def test_downloads_logged(self):
+        with mock.patch('xasdb1.download_log._append', wraps=download_log._append) as append:
+            self._export({'id': self.ids})
+        self.assertEqual(append.call_count, 1)
+        self.assertEqual(XASDownloadFile.objects.filter(downloader=self.user).count(), 3)
+        self.assertEqual(XASDownloadAuxData.objects.filter(downloader=self.user).count(), 3)
+
+    def test_bounded_chunks(self):
+        # a big aux file that does not compress: it goes out as it is read, not in one piece
+        aux = XASUploadAuxData.objects.filter(file_id=self.ids[0]).get()
+        content = np.random.default_rng(0).bytes(1024 * 1024)
+        with open(aux.aux_file.path, 'wb') as f:
+            f.write(content)
+        with mock.patch('xasdb1.export.EXPORT_CHUNK_SIZE', 16 * 1024):
+            response = self.client.get(reverse('xasdb1:export'), {'id': self.ids})
+            chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 16)
+        self.assertLess(max(len(chunk) for chunk in chunks), 128 * 1024)
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.read('Fe/{}/aux/{}'.format(self.ids[0], aux.name)), content)
+
+    def test_missing_file(self):
+        # neither in the zip, nor in the manifest or the download log, and its aux files are left out with it
+        file = XASFile.objects.get(id=self.ids[0])
+        os.remove(file.upload_file.path)
+        missing_aux = XASUploadAuxData.objects.get(file_id=self.ids[1])
+        os.remove(missing_aux.aux_file.path)
+        with self._export({'id': self.ids}) as zip_file:
+            self.assertFalse(any(name.startswith('Fe/{}/'.format(file.id)) for name in zip_file.namelist()))
+            self.assertNotIn('Fe/{}/aux/{}'.format(self.ids[1], missing_aux.name), zip_file.namelist())
+            self.assertEqual(len(zip_file.namelist()), 4)
+            manifest = zip_file.read('manifest.csv').decode('utf-8').splitlines()
+        self.assertEqual(sorted(int(line.split(',')[0]) for line in manifest[1:]), self.ids[1:])
+        self.assertEqual(sorted(XASDownloadFile.objects.values_list('file_id', flat=True)), self.ids[1:])
+        self.assertEqual(list(XASDownloadAuxData.objects.values_list('file__file_id', flat=True)), [self.ids[2]])
+
+        os.remove(XASFile.objects.get(id=self.ids[1]).upload_file.path)
+        os.remove(XASFile.objects.get(id=self.ids[2]).upload_file.path)
+        response = self.client.get(reverse('xasdb1:export'), {'id': self.ids}, follow=True)
+        self.assertContains(response, 'None of the selected spectra are available')
+
+    @override_settings(XASDB_EXPORT_MAX_FILES=2)
+    def test_max_files(self):
+        response = self.client.get(reverse('xasdb1:export'), {'id': self.ids}, follow=True)
+        self.assertContains(response, 'At most 2 spectra')
+
+    def test_links(self):
+        response = self.client.get(reverse('xasdb1:element', args=['Fe']))
+        self.assertContains(response, reverse('xasdb1:export'))
+        response = self.client.get(reverse('xasdb1:search'), {'q': 'fe', 'page': 1})
+        self.assertEqual(response.context['export_url'], reverse('xasdb1:export') + '?q=fe')
+
+@override_settings(**OVERRIDE_SETTINGS)
+class PlotCacheTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser(username=SU_USERNAME, password=SU_PASSWORD, email=SU_EMAIL)
+        self.client.login(username=SU_USERNAME, password=SU_PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        with open(test_file) as fp:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI))
+        self.xas_file = XASFile.objects.get()
+        caches['plots'].clear()
+
+    def _get_file(self):
+        with mock.patch('xasdb1.views._file_plot', wraps=views._file_plot) as file_plot:
+            response = self.client.get(reverse('xasdb1:file', args=[self.xas_file.id]))
+        self.assertContains(response, 'class="bk-root"', count=1)
+        return file_plot.call_count
+
+    def test_rendered_once(self):
+        self.assertEqual(self._get_file(), 1)
+        self.assertEqual(self._get_file(), 0)
+        self.assertEqual(self._get_file(), 0)
+
+    def test_invalidated_by_metadata(self):
+        self.assertEqual(self._get_file(), 1)
+        self.xas_file.review_status = XASFile.APPROVED
+        self.xas_file.save()
+        self.assertEqual(self._get_file(), 1)
+        self.assertEqual(self._get_file(), 0)
+
+    def test_invalidated_by_arrays(self):
+        self.assertEqual(self._get_file(), 1)
+        energy = self.xas_file.xasarray_set.get(name='energy')
+        energy.data = energy.data + 1.0
+        energy.save()
+        self.assertEqual(self._get_file(), 1)
+        self.assertEqual(self._get_file(), 0)
+
+    def test_deleted_with_file(self):
+        self._get_file()
+        key = self.xas_file.plot_cache_key
+        self.assertIsNotNone(caches['plots'].get(key))
+        self.xas_file.delete()
+        self.assertIsNone(caches['plots'].get(key))
+
+@override_settings(**OVERRIDE_SETTINGS)
+class ElementPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        other = User.objects.create_user(username=2*USERNAME, password=2*PASSWORD)
+        # a few duplicate sample names to make sure the id tie-breaker works
+        XASFile.objects.bulk_create([XASFile(upload_file=f'uploads/dummy_{i}.xdi', element='Fe', sample_name=f'sample {i % 4}', uploader=self.user, review_status=XASFile.PENDING) for i in range(7)])
+        XASFile.objects.bulk_create([XASFile(upload_file=f'uploads/other_{i}.xdi', element='Fe', sample_name=f'sample {i % 3}', uploader=other, review_status=XASFile.APPROVED if i % 2 else XASFile.PENDING) for i in range(6)])
+        self.client.login(username=USERNAME, password=PASSWORD)
+        self.visible = set(XASFile.objects.filter(Q(uploader=self.user) | Q(review_status=XASFile.APPROVED)).values_list('id', flat=True))
+
+    @override_settings(XASDB_ELEMENT_PAGE_SIZE=3)
+    def test_pages_forward_and_back(self):
+        seen = []
+        pages = []
+        url = reverse('xasdb1:element', args=['Fe'])
+        while url:
+            response = self.client.get(url)
+            self.assertContains(response, f'{len(self.visible)} spectra found for Fe')
+            self.assertLessEqual(len(response.context['files']), 3)
+            pages.append([file.id for file in response.context['files']])
+            seen.extend(pages[-1])
+            cursor = response.context['next_cursor']
+            url = reverse('xasdb1:element', args=['Fe']) + f'?after={cursor}' if cursor else None
+        self.assertEqual(len(seen), len(self.visible))
+        self.assertEqual(set(seen), self.visible)
+        expected = list(XASFile.objects.filter(id__in=self.visible).order_by('sample_name', 'id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+        # and back again
+        cursor = response.context['previous_cursor']
+        for page in reversed(pages[:-1]):
+            response = self.client.get(reverse('xasdb1:element', args=['Fe']) + f'?before={cursor}')
+            self.assertEqual([file.id for file in response.context['files']], page)
+            cursor = response.context['previous_cursor']
+        self.assertIsNone(cursor)
+
+    def test_bad_cursor(self):
+        response = self.client.get(reverse('xasdb1:element', args=['Fe']) + '?after=garbage')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['files']), len(self.visible))
+
+@override_settings(**OVERRIDE_SETTINGS)
+class AuxImageTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        aux_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'images', '1155.png')
+        with open(test_file) as fp, open(aux_file, 'rb') as aux_fp:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, **{'upload_file':fp, 'upload_file_doi':DOI, 'form-0-aux_description': 'image', 'form-0-aux_file': aux_fp}), follow=True)
+        self.xas_file = XASFile.objects.get()
+        self.aux = self.xas_file.xasuploadauxdata_set.get()
+
+    def test_stored_next_to_upload(self):
+        for field in (self.aux.aux_thumbnail, self.aux.aux_image):
+            self.assertTrue(exists(field.path))
+            self.assertEqual(os.path.dirname(field.name), os.path.dirname(self.aux.aux_file.name))
+        response = self.client.get(reverse('xasdb1:file', args=[self.xas_file.id]))
+        self.assertContains(response, self.aux.thumbnail_url)
+        self.assertContains(response, self.aux.image_url)
+        self.assertNotContains(response, 'data:image/png;base64')
+
+    def test_served_with_cache_headers(self):
+        response = self.client.get(self.aux.thumbnail_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('private', response['Cache-Control'])
+        with open(self.aux.aux_thumbnail.path, 'rb') as f:
+            self.assertEqual(b''.join(response.streaming_content), f.read())
+        etag = response['ETag']
+
+        # revalidation
+        response = self.client.get(self.aux.thumbnail_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # approved spectra may be cached by anyone
+        self.xas_file.review_status = XASFile.APPROVED
+        self.xas_file.save()
+        self.client.logout()
+        response = self.client.get(self.aux.image_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+
+    def test_not_visible(self):
+        url = self.aux.thumbnail_url
+        self.client.logout()
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        # stale digests are not served
+        self.assertEqual(self.client.get(reverse('xasdb1:aux_image', args=[self.aux.id, 'thumbnail', 'abcdef'])).status_code, 404)
+
+    def test_no_uploader(self):
+        # such as the files of import_xdi without --uploader: anonymous users have no id either
+        XASFile.objects.filter(id=self.xas_file.id).update(uploader=None)
+        self.client.logout()
+        self.assertEqual(self.client.get(self.aux.thumbnail_url).status_code, 404)
+        self.assertEqual(self.client.get(self.aux.image_url).status_code, 404)
+
+    def test_deleted_with_aux(self):
+        paths = (self.aux.aux_thumbnail.path, self.aux.aux_image.path)
+        self.xas_file.delete()
+        for path in paths:
+            self.assertFalse(exists(path))
+
+@override_settings(XASDB_ASYNC_INGEST=True, **OVERRIDE_SETTINGS)
+class AsyncIngestTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD, email=EMAIL)
+        self.client.login(username=USERNAME, password=PASSWORD)
+
+    def _upload(self):
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        aux_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'images', '1155.png')
+        with open(test_file) as fp, open(aux_file, 'rb') as aux_fp:
+            response = self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, **{'upload_file':fp, 'upload_file_doi':DOI, 'form-0-aux_description': 'image', 'form-0-aux_file': aux_fp}), follow=True)
+        job = XASIngestJob.objects.get()
+        self.assertRedirects(response, reverse('xasdb1:ingest_job', args=[job.id]))
+        self.assertContains(response, 'is being processed')
+        self.assertEqual(XASFile.objects.count(), 0)
+        self.assertFalse(mail.outbox)
+        return job
+
+    def test_ingest(self):
+        job = self._upload()
+        staged = (job.upload_file.path, job.xasingestjobauxdata_set.get().aux_file.path)
+        call_command('ingest_worker', '--once', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, XASIngestJob.DONE)
+        self.assertEqual(job.attempts, 1)
+        xas_file = XASFile.objects.get()
+        self.assertEqual(job.file, xas_file)
+        self.assertEqual(xas_file.uploader, self.user)
+        self.assertEqual(xas_file.upload_file_doi, DOI)
+        self.assertTrue(xas_file.upload_file.name.startswith('uploads/'))
+        self.assertTrue(xas_file.xasuploadauxdata_set.get().aux_thumbnail)
+        for path in staged:
+            self.assertFalse(exists(path))
+        self.assertEqual(mail.outbox[-1].subject, settings.EMAIL_SUBJECT_PREFIX + 'a new dataset has been uploaded')
+
+        response = self.client.get(reverse('xasdb1:ingest_job', args=[job.id]), follow=True)
+        self.assertRedirects(response, reverse('xasdb1:file', args=[xas_file.id]))
+        self.assertContains(response, 'File uploaded')
+
+        # other users do not get to see the job
+        self.client.logout()
+        User.objects.create_user(username=2*USERNAME, password=2*PASSWORD)
+        self.client.login(username=2*USERNAME, password=2*PASSWORD)
+        response = self.client.get(reverse('xasdb1:ingest_job', args=[job.id]), follow=True)
+        self.assertContains(response, 'The requested upload is not accessible')
+
+    @override_settings(XASDB_INGEST_MAX_ATTEMPTS=2)
+    def test_retry(self):
+        job = self._upload()
+        with mock.patch('xasdb1.ingest.process_xdi_file', side_effect=RuntimeError('database on fire')):
+            call_command('ingest_worker', '--once', stdout=StringIO())
+            job.refresh_from_db()
+            self.assertEqual(job.status, XASIngestJob.QUEUED)
+            self.assertEqual(job.attempts, 1)
+            self.assertEqual(job.error, 'database on fire')
+            self.assertGreater(job.run_after, timezone.now())
+            # not due yet
+            call_command('ingest_worker', '--once', stdout=StringIO())
+            job.refresh_from_db()
+            self.assertEqual(job.attempts, 1)
+
+            XASIngestJob.objects.update(run_after=timezone.now())
+            call_command('ingest_worker', '--once', stdout=StringIO())
+            job.refresh_from_db()
+            self.assertEqual(job.status, XASIngestJob.FAILED)
+            self.assertEqual(job.attempts, 2)
+        self.assertEqual(XASFile.objects.count(), 0)
+        self.assertEqual(mail.outbox[-1].subject, settings.EMAIL_SUBJECT_PREFIX + 'an upload could not be processed')
+        response = self.client.get(reverse('xasdb1:ingest_job', args=[job.id]))
+        self.assertContains(response, 'failed: database on fire')
+
+    def test_claimed_once(self):
+        job = self._upload()
+        self.assertEqual(ingest.claim_job(), job)
+        self.assertIsNone(ingest.claim_job())
+
+    def test_stale_job_reclaimed(self):
+        job = self._upload()
+        ingest.claim_job()
+        XASIngestJob.objects.update(claimed_timestamp=timezone.now() - timedelta(seconds=settings.XASDB_INGEST_STALE_TIMEOUT + 1))
+        call_command('ingest_worker', '--once', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, XASIngestJob.DONE)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(XASFile.objects.count(), 1)
+
+    @override_settings(XASDB_INGEST_MAX_ATTEMPTS=1)
+    def test_stale_job_failed(self):
+        # the worker died on its last attempt
+        job = self._upload()
+        ingest.claim_job()
+        XASIngestJob.objects.update(claimed_timestamp=timezone.now() - timedelta(seconds=settings.XASDB_INGEST_STALE_TIMEOUT + 1))
+        call_command('ingest_worker', '--once', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, XASIngestJob.FAILED)
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNotNone(job.finished_timestamp)
+        self.assertEqual(XASFile.objects.count(), 0)
+        self.assertEqual(mail.outbox[-1].subject, settings.EMAIL_SUBJECT_PREFIX + 'an upload could not be processed')
+
+    def test_rolled_back_files_deleted(self):
+        job = self._upload()
+        save = XASIngestJob.save
+
+        def failing_save(self, *args, **kwargs):
+            if 'file' in kwargs.get('update_fields', ()):
+                raise RuntimeError('database on fire')
+            return save(self, *args, **kwargs)
+
+        def stored_files():
+            return set(join(root, name) for root, _, names in os.walk(join(settings.MEDIA_ROOT, 'uploads')) for name in names)
+
+        before = stored_files()
+        with mock.patch.object(XASIngestJob, 'save', failing_save):
+            call_command('ingest_worker', '--once', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, XASIngestJob.QUEUED)
+        self.assertEqual(XASFile.objects.count(), 0)
+        self.assertEqual(stored_files(), before)
+        # the staged upload is still there for the next attempt
+        self.assertTrue(exists(job.upload_file.path))
+
+class DerivedChannelTests(unittest.TestCase):
+    def test_derive(self):
+        arrays = dict(i0=np.array([2.0, 2.0, 0.0, 2.0]), itrans=np.array([1.0, 0.0, 1.0, 2.0]), ifluor=np.array([1.0, 1.0, 1.0, 4.0]), irefer=np.array([0.5, 1.0, 1.0, -1.0]))
+        derived = derive_channels(arrays)
+        self.assertEqual(set(derived), {'mu_trans', 'mu_fluor', 'mu_refer'})
+        np.testing.assert_array_equal(derived['mu_trans'], [np.log(2.0), np.nan, np.nan, 0.0])
+        np.testing.assert_array_equal(derived['mu_fluor'], [0.5, 0.5, np.nan, 2.0])
+        np.testing.assert_array_equal(derived['mu_refer'], [np.log(2.0), np.nan, 0.0, np.nan])
+
+    def test_missing_channels(self):
+        self.assertEqual(derive_channels(dict(energy=np.arange(3.0))), {})
+        self.assertEqual(set(derive_channels(dict(i0=np.ones(3), ifluor=np.ones(3)))), {'mu_fluor'})
+
+@override_settings(**OVERRIDE_SETTINGS)
+class DerivedArraysTests(TestCase):
+    def setUp(self):
+        User.objects.create_superuser(username=SU_USERNAME, password=SU_PASSWORD, email=SU_EMAIL)
+        self.client.login(username=SU_USERNAME, password=SU_PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        with open(test_file) as fp:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI))
+        self.xas_file = XASFile.objects.get()
+        caches['plots'].clear()
+
+    def test_stored_at_ingest(self):
+        arrays = self.xas_file.get_arrays('i0', 'itrans', 'mu_trans')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.testing.assert_allclose(arrays['mu_trans'], -np.log(arrays['itrans'] / arrays['i0']))
+
+    def test_plot_fetches_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('xasdb1:file', args=[self.xas_file.id]))
+        self.assertContains(response, 'class="bk-root"', count=1)
+        self.assertEqual(len([query for query in queries if 'xasdb1_xasarray' in query['sql']]), 1)
+
+    def test_rebuild(self):
+        XASArray.objects.filter(file=self.xas_file, name='mu_trans').delete()
+        # still plotted, from the raw channels
+        response = self.client.get(reverse('xasdb1:file', args=[self.xas_file.id]))
+        self.assertContains(response, 'class="bk-root"', count=1)
+        version = XASFile.objects.get().content_version
+        call_command('rebuild_arrays', stdout=StringIO())
+        self.assertIn('mu_trans', self.xas_file.get_arrays('mu_trans'))
+        self.assertEqual(self.xas_file.xasarray_set.filter(name='mu_trans').count(), 1)
+        self.assertNotEqual(XASFile.objects.get().content_version, version)
+
+@override_settings(**OVERRIDE_SETTINGS)
+class ArraysAPITests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        with open(test_file) as fp:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI))
+        self.xas_file = XASFile.objects.get()
+        self.url = reverse('xasdb1:api_file_arrays', args=[self.xas_file.id])
+
+    def test_json(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        content = response.json()
+        self.assertEqual(content['element'], 'Fe')
+        self.assertEqual(set(content['arrays']), {'energy', 'i0', 'itrans', 'mu_trans', 'mu_norm'})
+        np.testing.assert_array_equal(content['arrays']['energy'], self.xas_file.get_arrays('energy')['energy'])
+
+        response = self.client.get(self.url, {'names': 'energy,mu_trans'})
+        self.assertEqual(set(response.json()['arrays']), {'energy', 'mu_trans'})
+
+    def test_npz(self):
+        response = self.client.get(self.url, {'format': 'npz'})
+        self.assertEqual(response.status_code, 200)
+        with np.load(io.BytesIO(response.content)) as npz:
+            self.assertEqual(set(npz.files), {'energy', 'i0', 'itrans', 'mu_trans', 'mu_norm'})
+            np.testing.assert_array_equal(npz['i0'], self.xas_file.get_arrays('i0')['i0'])
+        self.assertEqual(self.client.get(self.url, {'format': 'hdf5'}).status_code, 400)
+
+    def test_conditional_get(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertFalse(etag.startswith('W/'))
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotEqual(self.client.get(self.url, {'format': 'npz'})['ETag'], etag)
+
+        # repeat fetches do not touch the arrays
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([query for query in queries if 'xasdb1_xasarray' in query['sql']])
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        # changing the arrays changes the ETag
+        energy = self.xas_file.xasarray_set.get(name='energy')
+        energy.data = energy.data + 1.0
+        energy.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_visibility(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.xas_file.review_status = XASFile.APPROVED
+        self.xas_file.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertEqual(self.client.get(reverse('xasdb1:api_file_arrays', args=[self.xas_file.id + 1])).status_code, 404)
+
+class ArrayJSONTests(unittest.TestCase):
+    def test_nan(self):
+        self.assertEqual(array_to_json(np.array([1.0, np.nan, np.inf])), [1.0, None, None])
+        self.assertEqual(json.loads(json.dumps(array_to_json(np.array([np.nan])))), [None])
+        self.assertEqual(array_to_json(np.arange(3)), [0, 1, 2])
+
+class LTTBTests(unittest.TestCase):
+    def test_lttb(self):
+        x = np.linspace(0.0, 10.0, 10001)
+        y = np.exp(-(x - 5.0) ** 2 / 0.01)
+        y[100] = np.nan
+        indices = lttb(x, y, 500)
+        self.assertEqual(len(indices), 500)
+        self.assertEqual(indices[0], 0)
+        self.assertEqual(indices[-1], len(x) - 1)
+        self.assertTrue(np.all(np.diff(indices) > 0))
+        # the peak survives
+        self.assertGreater(np.nanmax(y[indices]), 0.99)
+        np.testing.assert_array_equal(lttb(x[:10], y[:10], 500), np.arange(10))
+
+    def test_plot_levels(self):
+        x = np.arange(3000.0)
+        levels = plot_levels('mu_trans', x, np.sin(x), (5000, 1000, 2000))
+        self.assertEqual({name: array.shape for name, array in levels.items()}, {'mu_trans@1000': (2, 1000), 'mu_trans@2000': (2, 2000)})
+        # the coarsest level is always stored
+        levels = plot_levels('mu_trans', x[:10], x[:10], (1000, 2000))
+        self.assertEqual(list(levels), ['mu_trans@1000'])
+        np.testing.assert_array_equal(levels['mu_trans@1000'], [x[:10], x[:10]])
+
+@override_settings(**OVERRIDE_SETTINGS)
+class PlotLevelsTests(TestCase):
+    def setUp(self):
+        User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        caches['plots'].clear()
+
+    def _upload(self):
+        test_file = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good', 'fe3c_rt.xdi')
+        with open(test_file) as fp:
+            self.client.post(reverse('xasdb1:upload'), dict(UPLOAD_FORMSET_DATA, upload_file=fp, upload_file_doi=DOI))
+        return XASFile.objects.get()
+
+    @override_settings(XASDB_PLOT_LEVELS=(100, 200, 1000))
+    def test_levels(self):
+        xas_file = self._upload()
+        self.assertEqual(set(xas_file.xasarray_set.filter(name__contains='@').values_list('name', flat=True)), {'mu_trans@100', 'mu_trans@200', 'mu_norm@100', 'mu_norm@200'})
+        with mock.patch('xasdb1.views._file_plot', wraps=views._file_plot) as file_plot:
+            response = self.client.get(reverse('xasdb1:file', args=[xas_file.id]))
+        self.assertContains(response, 'class="bk-root"', count=1)
+        args, kwargs = file_plot.call_args
+        self.assertEqual(len(args[0]), 100)
+        self.assertEqual(kwargs['zoom']['levels'], [[200, 'mu_trans@200'], [1000, 'mu_trans@1000']])
+        self.assertEqual(kwargs['zoom']['url'], reverse('xasdb1:api_file_arrays', args=[xas_file.id]))
+        # the normalized spectrum in the other tab zooms the same way
+        self.assertEqual(kwargs['normalized'][2]['levels'], [[200, 'mu_norm@200'], [1000, 'mu_norm@1000']])
+
+        # levels are fetched from the arrays API by name
+        response = self.client.get(kwargs['zoom']['url'], {'names': 'mu_trans@200'})
+        self.assertEqual(np.array(response.json()['arrays']['mu_trans@200']).shape, (2, 200))
+        self.assertNotIn('mu_trans@100', self.client.get(kwargs['zoom']['url']).json()['arrays'])
+
+    def test_small_spectrum(self):
+        xas_file = self._upload()
+        with mock.patch('xasdb1.views._file_plot', wraps=views._file_plot) as file_plot:
+            self.client.get(reverse('xasdb1:file', args=[xas_file.id]))
+        args, kwargs = file_plot.call_args
+        # everything fits in the coarsest level: nothing to zoom into
+        self.assertEqual(len(args[0]), len(xas_file.get_arrays('energy')['energy']))
+        self.assertIsNone(kwargs['zoom'])
+
+    @override_settings(XASDB_PLOT_LEVELS=(100, 200))
+    def test_rebuild(self):
+        xas_file = self._upload()
+        XASArray.objects.filter(name__contains='@').delete()
+        call_command('rebuild_arrays', stdout=StringIO())
+        self.assertEqual(set(xas_file.xasarray_set.filter(name__contains='@').values_list('name', flat=True)), {'mu_trans@100', 'mu_trans@200', 'mu_norm@100', 'mu_norm@200'})
+
+@override_settings(XASDB_ASYNC_INGEST=True, **OVERRIDE_SETTINGS)
+class ArchiveUploadTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD, email=EMAIL)
+        self.client.login(username=USERNAME, password=PASSWORD)
+        self.good_dir = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good')
+        self.bad_dir = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'bad')
+        self.good_files = sorted(os.listdir(self.good_dir))
+        # not an XDI file, no element, unknown element
+        self.bad_files = ['bad_01.xdi', 'bad_03.xdi', 'bad_05.xdi']
+
+    def _members(self):
+        members = [('campaign/' + name, open(join(self.good_dir, name), 'rb').read()) for name in self.good_files]
+        members += [('campaign/bad/' + name, open(join(self.bad_dir, name), 'rb').read()) for name in self.bad_files]
+        members.append(('__MACOSX/campaign/._fe3c_rt.xdi', b'resource fork'))
+        return members
+
+    def _zip(self):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zip_file:
+            for name, content in self._members():
+                zip_file.writestr(name, content)
+        return SimpleUploadedFile('campaign.zip', buffer.getvalue())
+
+    def _tar(self):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as tar_file:
+            for name, content in self._members():
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                tar_file.addfile(info, io.BytesIO(content))
+        return SimpleUploadedFile('campaign.tar.gz', buffer.getvalue())
+
+    def _post(self, archive):
+        return self.client.post(reverse('xasdb1:upload_archive'), {'archive_file': archive, 'upload_file_doi': DOI})
+
+    def _upload(self, archive):
+        # nothing happens in the request but staging the archive
+        response = self._post(archive)
+        job = XASIngestJob.objects.get()
+        self.assertTrue(job.is_archive)
+        self.assertRedirects(response, reverse('xasdb1:ingest_job', args=[job.id]))
+        self.assertEqual(XASFile.objects.count(), 0)
+        response = self.client.get(reverse('xasdb1:ingest_job', args=[job.id]))
+        self.assertContains(response, 'is being processed')
+        staged = job.upload_file.path
+        call_command('ingest_worker', '--once', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, XASIngestJob.DONE)
+        self.assertFalse(exists(staged))
+        response = self.client.get(reverse('xasdb1:ingest_job', args=[job.id]))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def _check(self, response):
+        report = response.context['report']
+        self.assertEqual([member.name for member in report], ['campaign/' + name for name in self.good_files] + ['campaign/bad/' + name for name in self.bad_files])
+        for member in report[:len(self.good_files)]:
+            self.assertEqual(member.error, '')
+            self.assertTrue(member.file.name.startswith(os.path.splitext(basename(member.name))[0]))
+        for member in report[len(self.good_files):]:
+            self.assertIsNone(member.file)
+            self.assertTrue(member.error)
+        self.assertContains(response, '{} of {} files uploaded'.format(len(self.good_files), len(report)))
+        self.assertContains(response, '3 of {} files could not be uploaded'.format(len(report)))
+
+        self.assertEqual(XASFile.objects.count(), len(self.good_files))
+        for xas_file in XASFile.objects.all():
+            self.assertEqual(xas_file.uploader, self.user)
+            self.assertEqual(xas_file.upload_file_doi, DOI)
+            self.assertTrue(exists(xas_file.upload_file.path))
+            self.assertTrue(xas_file.xasarray_set.filter(name='energy').exists())
+        # a single mail for the whole archive
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, settings.EMAIL_SUBJECT_PREFIX + '{} new datasets have been uploaded'.format(len(self.good_files)))
+
+    @override_settings(XASDB_ARCHIVE_WORKERS=2)
+    def test_zip_process_pool(self):
+        self._check(self._upload(self._zip()))
+
+    @override_settings(XASDB_ARCHIVE_WORKERS=0)
+    def test_tar_inline(self):
+        self._check(self._upload(self._tar()))
+
+    @override_settings(XASDB_ASYNC_INGEST=False, XASDB_ARCHIVE_WORKERS=0)
+    def test_without_worker(self):
+        # ingested in the request, as single files are
+        response = self._post(self._zip())
+        job = XASIngestJob.objects.get()
+        self.assertRedirects(response, reverse('xasdb1:ingest_job', args=[job.id]), fetch_redirect_response=False)
+        self.assertEqual(job.status, XASIngestJob.DONE)
+        self.assertEqual(job.attempts, 1)
+        response = self.client.get(reverse('xasdb1:ingest_job', args=[job.id]))
+        self.assertNotContains(response, 'http-equiv="refresh"')
+        self._check(response)
+
+    @override_settings(XASDB_ASYNC_INGEST=False, XASDB_ARCHIVE_WORKERS=0)
+    def test_without_worker_failed(self):
+        with mock.patch('xasdb1.ingest.ingest_archive', side_effect=RuntimeError('disk full')):
+            self._post(self._zip())
+        job = XASIngestJob.objects.get()
+        self.assertEqual(job.status, XASIngestJob.FAILED)
+        response = self.client.get(reverse('xasdb1:ingest_job', args=[job.id]))
+        self.assertContains(response, 'failed: disk full')
+
+    def test_invalid_archive(self):
+        response = self._post(SimpleUploadedFile('campaign.zip', b'not an archive'))
+        self.assertContains(response, 'Not a zip or tar archive')
+        self.assertFalse(XASIngestJob.objects.exists())
+
+    @override_settings(XASDB_ARCHIVE_MAX_MEMBERS=3)
+    def test_too_many_members(self):
+        response = self._post(self._zip())
+        self.assertContains(response, 'Archives are limited to 3 files')
+        self.assertFalse(XASIngestJob.objects.exists())
+
+    @override_settings(XASDB_ARCHIVE_WORKERS=0)
+    def test_resumed(self):
+        # the worker dies after storing the first member, which is not stored again by the next one
+        self._post(self._zip())
+        store_xdi_data = archive_module.store_xdi_data
+        def store(*args):
+            if XASFile.objects.exists():
+                raise KeyboardInterrupt
+            return store_xdi_data(*args)
+        with mock.patch('xasdb1.archive.store_xdi_data', side_effect=store), self.assertRaises(KeyboardInterrupt):
+            call_command('ingest_worker', '--once', stdout=StringIO())
+        job = XASIngestJob.objects.get()
+        self.assertEqual(job.status, XASIngestJob.RUNNING)
+        self.assertEqual(job.xasingestjobmember_set.count(), 1)
+        self.assertEqual(XASFile.objects.count(), 1)
+        XASIngestJob.objects.update(claimed_timestamp=timezone.now() - timedelta(seconds=settings.XASDB_INGEST_STALE_TIMEOUT + 1))
+        call_command('ingest_worker', '--once', stdout=StringIO())
+        job.refresh_from_db()
+        self.assertEqual(job.status, XASIngestJob.DONE)
+        self.assertEqual(job.attempts, 2)
+        self._check(self.client.get(reverse('xasdb1:ingest_job', args=[job.id])))
+
+    @override_settings(XASDB_ARCHIVE_WORKERS=0)
+    def test_failed_member_rolls_back(self):
+        real_bulk_create = XASArray.objects.bulk_create
+        calls = []
+        def bulk_create(objs, *args, **kwargs):
+            calls.append(objs)
+            if len(calls) == 2:
+                raise RuntimeError('database went away')
+            return real_bulk_create(objs, *args, **kwargs)
+        with mock.patch.object(XASArray.objects, 'bulk_create', side_effect=bulk_create):
+            response = self._upload(self._zip())
+        report = response.context['report']
+        self.assertEqual(report[1].error, 'database went away')
+        self.assertEqual(XASFile.objects.count(), len(self.good_files) - 1)
+        self.assertFalse(XASFile.objects.filter(upload_file__endswith=self.good_files[1]).exists())
+
+@override_settings(**OVERRIDE_SETTINGS)
+class ImportXDITests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username=USERNAME, password=PASSWORD)
+        self.tree = tempfile.TemporaryDirectory()
+        good_dir = join(settings.BASE_DIR, 'xasdb1', 'testdata', 'good')
+        self.good_files = sorted(os.listdir(good_dir))
+        for index, name in enumerate(self.good_files):
+            # spread them over a few nested directories
+            directory = join(self.tree.name, 'run{}'.format(index % 3), 'scans' if index % 2 else '')
+            os.makedirs(directory, exist_ok=True)
+            with open(join(good_dir, name), 'rb') as src, open(join(directory, name), 'wb') as dst:
+                dst.write(src.read())
+        os.makedirs(join(self.tree.name, '.snapshot'))
+        with open(join(self.tree.name, '.snapshot', 'fe3c_rt.xdi'), 'w') as f:
+            f.write('hidden')
+        with open(join(settings.BASE_DIR, 'xasdb1', 'testdata', 'bad', 'bad_01.xdi'), 'rb') as src, open(join(self.tree.name, 'run0', 'bad_01.xdi'), 'wb') as dst:
+            dst.write(src.read())
+        self.checkpoint = join(self.tree.name, 'checkpoint')
+
+    def tearDown(self):
+        self.tree.cleanup()
+
+    def _import(self, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_xdi', self.tree.name, '--doi', DOI, '--uploader', USERNAME, '--checkpoint', self.checkpoint, '--batch-size', '4', *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def _check(self, stdout, stderr):
+        self.assertEqual(XASFile.objects.count(), len(self.good_files))
+        self.assertEqual(set(os.path.splitext(xas_file.name)[0][:5] for xas_file in XASFile.objects.all()), set(name[:5] for name in self.good_files))
+        self.assertEqual(XASFile.objects.filter(uploader=self.user, upload_file_doi=DOI).count(), len(self.good_files))
+        self.assertIn('imported {} files (1 failed, 0 skipped)'.format(len(self.good_files)), stdout)
+        for stage in ('parse=', 'derive=', 'serialize=', 'insert='):
+            self.assertIn(stage, stdout)
+        self.assertIn('bad_01.xdi', stderr)
+
+    def test_import_process_pool(self):
+        self._check(*self._import('--workers', '2'))
+
+    def test_import_resume(self):
+        self._check(*self._import('--workers', '0'))
+        with open(self.checkpoint) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), len(self.good_files) + 1)
+        self.assertIn('failed\t' + join(self.tree.name, 'run0', 'bad_01.xdi'), lines)
+
+        # nothing left to do
+        stdout, stderr = self._import('--workers', '0')
+        self.assertIn('imported 0 files (0 failed, {} skipped)'.format(len(self.good_files) + 1), stdout)
+        self.assertEqual(XASFile.objects.count(), len(self.good_files))
+
+        # unless failed files are retried
+        stdout, stderr = self._import('--workers', '0', '--retry-failed')
+        self.assertIn('imported 0 files (1 failed, {} skipped)'.format(len(self.good_files)), stdout)
+
+    def test_interrupted_import_resumes(self):
+        from .management.commands import import_xdi
+        real_store = import_xdi.store_xdi_data
+        calls = []
+        def store(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 6:
+                raise KeyboardInterrupt()
+            return real_store(*args, **kwargs)
+        with mock.patch('xasdb1.management.commands.import_xdi.store_xdi_data', side_effect=store):
+            with self.assertRaises(KeyboardInterrupt):
+                self._import('--workers', '0')
+        # the batch that was interrupted is rolled back and not recorded
+        with open(self.checkpoint) as f:
+            self.assertEqual(len(f.read().splitlines()), 4)
+        self.assertEqual(XASFile.objects.count(), 3)
+        # the next run takes over where the last one stopped
+        stdout, stderr = self._import('--workers', '0')
+        self.assertIn('imported {} files (0 failed, 4 skipped)'.format(len(self.good_files) - 3), stdout)
+        self.assertEqual(XASFile.objects.count(), len(self.good_files))
@@ -15,8 +15,19 @@ urlpatterns = [
     path('login/', views.login, name='login'),
     path('logout/', views.logout, name='logout'),
     path('upload/', views.upload, name='upload'),
+    path('upload/<int:job_id>/', views.ingest_job, name='ingest_job'),
+    path('upload_archive/', views.upload_archive, name='upload_archive'),
     path('download/<path:path_id>/', views.download, name='download'),
     path('element/<str:element_id>/', views.element, name='element'),
     path('file/<int:file_id>/', views.file, name='file'),
+    path('file/<int:file_id>/similar/', views.similar, name='similar'),
+    path('similar/', views.similar_upload, name='similar_upload'),
+    path('compare/', views.compare, name='compare'),
+    path('export/', views.export, name='export'),
+    path('search/', views.search, name='search'),
+    path('api/search/', views.api_search, name='api_search'),
+    path('api/file/<int:file_id>/arrays/', views.api_file_arrays, name='api_file_arrays'),
+    path('api/file/<int:file_id>/similar/', views.api_file_similar, name='api_file_similar'),
+    path('aux_image/<int:aux_id>/<str:kind>/<str:digest>/', views.aux_image, name='aux_image'),
     re_path(r'^activate/(?P<uidb64>[0-9A-Za-z_\-]+)/(?P<token>[0-9A-Za-z]{1,13}-[0-9A-Za-z]{1,20})/$', views.activate, name='activate'),
 ]
@@ -1,11 +1,19 @@
-import json
-import xdifile
 import xraylib as xrl
 import numpy as np
 from datetime import datetime, timezone
-from .models import XASFile, XASMode
+from django.conf import settings
+from django.db import transaction
+from .models import XASFile, XASMode, XASArray, parse_xdi_upload
+from .arrays import SIMILARITY_ARRAY, derive_channels, plot_levels
+from .normalization import normalize_spectrum
+from .similarity import spectrum_features
 import os.path
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
+logger = logging.getLogger(__name__)
 
 OPTIONAL_KWARGS = ( \
         ('sample', 'name'), \
@@ -16,10 +24,37 @@ OPTIONAL_KWARGS = ( \
         ('mono', 'd_spacing'), \
     )
 
-def process_xdi_file(temp_xdi_file, request):
-    value = request.FILES['upload_file']
-    xdi_file = xdifile.XDIFile(filename=temp_xdi_file)
-    value.seek(0)
+class StageTimer:
+    # accumulates wall clock time per named stage
+    def __init__(self):
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    @property
+    def total(self):
+        return sum(self.timings.values())
+
+    def __str__(self):
+        return ' '.join('{}={:.1f}ms'.format(name, duration * 1000) for name, duration in self.timings.items())
+
+def process_xdi_file(value, upload_file_doi, uploader):
+    timer = StageTimer()
+    with timer.stage('parse'):
+        # normally already parsed by the xdi_valid validator
+        xdi_file = parse_xdi_upload(value)
+    xdi_data = extract_xdi_data(xdi_file, value.name, timer)
+    return store_xdi_data(xdi_data, value, upload_file_doi, uploader, timer)
+
+def extract_xdi_data(xdi_file, name, timer):
+    # everything that can be done without the database: the result is picklable,
+    # so this can run in another process, see xasdb1.archive
     element = xdi_file.element.decode('utf-8')
     edge = xdi_file.edge.decode('utf-8')
     for pair in XASFile.EDGE_CHOICES:
@@ -39,77 +74,119 @@ def process_xdi_file(temp_xdi_file, request):
         pass
 
     if 'sample_name' not in kwargs:
-        kwargs['sample_name'] = os.path.splitext(value.name)[0]
-
+        kwargs['sample_name'] = os.path.splitext(os.path.basename(name))[0]
+
+    modes = []
+    arrays = {'energy': xdi_file.energy}
+
+    if hasattr(xdi_file, 'xmu'):
+        arrays['xmu'] = xdi_file.xmu
+        modes.append(XASMode.XMU)
+
+    if hasattr(xdi_file, 'i0'):
+        arrays['i0'] = xdi_file.i0
+
+    if hasattr(xdi_file, 'itrans'):
+        arrays['itrans'] = xdi_file.itrans
+        modes.append(XASMode.TRANSMISSION)
+    elif hasattr(xdi_file, 'i1'):
+        arrays['itrans'] = xdi_file.i1
+        modes.append(XASMode.TRANSMISSION)
+
+    if hasattr(xdi_file, 'ifluor'):
+        arrays['ifluor'] = xdi_file.ifluor
+        modes.append(XASMode.FLUORESCENCE)
+
+    elif hasattr(xdi_file, 'ifl'):
+        arrays['ifluor'] = xdi_file.ifl
+        modes.append(XASMode.FLUORESCENCE)
+
+    # special case: mutrans given,
+    # itrans not available,
+    # and maybe i0 not available
+    if (hasattr(xdi_file, 'mutrans') and
+        not hasattr(xdi_file, 'itrans')):
+        if not hasattr(xdi_file, 'i0'):
+            arrays['i0'] = np.ones(len(xdi_file.mutrans))
+            arrays['itrans'] = np.exp(-xdi_file.mutrans)
+        modes.append(XASMode.TRANSMISSION)
+
+    if (hasattr(xdi_file, 'mufluor') and
+        not hasattr(xdi_file, 'ifluor')):
+        if not hasattr(xdi_file, 'i0'):
+            arrays['i0'] = np.ones(len(xdi_file.mufluor))
+            arrays['ifluor'] = xdi_file.mufluor
+        modes.append(XASMode.FLUORESCENCE)
+
+    if (hasattr(xdi_file, 'munorm')):
+        arrays['i0'] = np.ones(len(xdi_file.munorm))
+        arrays['ifluor'] = xdi_file.munorm
+        modes.append(XASMode.FLUORESCENCE_UNITSTEP)
+
+    refer_used = False
+    if hasattr(xdi_file, 'irefer'):
+        refer_used = True
+        arrays['irefer'] = xdi_file.irefer
+    elif hasattr(xdi_file, 'i2'):
+        refer_used = True
+        arrays['irefer'] = xdi_file.i2
+
+    with timer.stage('derive'):
+        arrays.update(derive_channels(arrays))
+
+    with timer.stage('downsample'):
+        arrays.update(build_plot_levels(arrays, modes))
+
+    e0 = edge_step = None
+    with timer.stage('normalize'):
+        normalized = normalize_spectrum(element, edge, arrays, modes)
+        if normalized is not None:
+            e0, edge_step, normalized_arrays = normalized
+            arrays.update(normalized_arrays)
+
+    with timer.stage('features'):
+        features = spectrum_features(element, edge, arrays, modes)
+        if features is not None:
+            arrays[SIMILARITY_ARRAY] = features
+
+    return dict(element=element, edge=edge, e0=e0, edge_step=edge_step, refer_used=refer_used, kwargs=kwargs, modes=modes, arrays=arrays)
+
+def store_xdi_data(xdi_data, value, upload_file_doi, uploader, timer):
+    arrays = xdi_data['arrays']
+    xas_file = XASFile(upload_file=value, upload_file_doi=upload_file_doi, uploader=uploader, element=xdi_data['element'], edge=xdi_data['edge'], e0=xdi_data['e0'], edge_step=xdi_data['edge_step'], refer_used=xdi_data['refer_used'], **xdi_data['kwargs'])
+
+    with timer.stage('serialize'):
+        xas_modes = [XASMode(mode=mode) for mode in set(xdi_data['modes'])]
+        xas_arrays = [XASArray(name=name, data=array) for name, array in arrays.items()]
+
+    # all or nothing: either the file ends up in the database with all its modes and arrays, or none of it does
     try:
-        modes = []
-        arrays = {'energy': xdi_file.energy}
-
-        if hasattr(xdi_file, 'xmu'):
-            arrays['xmu'] = xdi_file.xmu
-            modes.append(XASMode.XMU)
-
-        if hasattr(xdi_file, 'i0'):
-            arrays['i0'] = xdi_file.i0
-
-        if hasattr(xdi_file, 'itrans'):
-            arrays['itrans'] = xdi_file.itrans
-            modes.append(XASMode.TRANSMISSION)
-        elif hasattr(xdi_file, 'i1'):
-            arrays['itrans'] = xdi_file.i1
-            modes.append(XASMode.TRANSMISSION)
-
-        if hasattr(xdi_file, 'ifluor'):
-            arrays['ifluor'] = xdi_file.ifluor
-            modes.append(XASMode.FLUORESCENCE)
-
-        elif hasattr(xdi_file, 'ifl'):
-            arrays['ifluor'] = xdi_file.ifl
-            modes.append(XASMode.FLUORESCENCE)
-
-        # special case: mutrans given,
-        # itrans not available,
-        # and maybe i0 not available
-        if (hasattr(xdi_file, 'mutrans') and
-            not hasattr(xdi_file, 'itrans')):
-            if not hasattr(xdi_file, 'i0'):
-                arrays['i0'] = np.ones(len(xdi_file.mutrans))
-                arrays['itrans'] = np.exp(-xdi_file.mutrans)
-            modes.append(XASMode.TRANSMISSION)
-
-        if (hasattr(xdi_file, 'mufluor') and
-            not hasattr(xdi_file, 'ifluor')):
-            if not hasattr(xdi_file, 'i0'):
-                arrays['i0'] = np.ones(len(xdi_file.mufluor))
-                arrays['ifluor'] = xdi_file.mufluor
-            modes.append(XASMode.FLUORESCENCE)
-
-        if (hasattr(xdi_file, 'munorm')):
-            arrays['i0'] = np.ones(len(xdi_file.munorm))
-            arrays['ifluor'] = xdi_file.munorm
-            modes.append(XASMode.FLUORESCENCE_UNITSTEP)
-
-        refer_used = False
-        if hasattr(xdi_file, 'irefer'):
-            refer_used = True
-            arrays['irefer'] = xdi_file.irefer
-        elif hasattr(xdi_file, 'i2'):
-            refer_used = True
-            arrays['irefer'] = xdi_file.i2
-
-        xas_file = XASFile(upload_file=value, upload_file_doi=request.POST['upload_file_doi'], uploader=request.user, element=element, edge=edge, refer_used=refer_used, **kwargs)
-        xas_file.save()
-
-        for mode in set(modes):
-            xas_file.xasmode_set.create(mode=mode)
-
-        # add arrays
-        for name, array in arrays.items():
-            xas_file.xasarray_set.create(name=name, array=json.dumps(array.tolist()))
-        return xas_file
+        with timer.stage('insert'), transaction.atomic():
+            xas_file.save()
+            for xas_object in xas_modes + xas_arrays:
+                xas_object.file = xas_file
+            XASMode.objects.bulk_create(xas_modes)
+            XASArray.objects.bulk_create(xas_arrays)
     except Exception:
+        # the upload was already written to MEDIA_ROOT by save()
+        if xas_file.upload_file._committed:
+            xas_file.upload_file.delete(save=False)
         raise
 
+    xas_file.ingest_timings = timer.timings
+    # archive members are parsed by a worker process and do not keep count
+    logger.info('ingested file {} ({}, {} points, {} arrays, parsed {}x): {} total={:.1f}ms'.format(xas_file.id, xas_file.name, len(arrays['energy']), len(xas_arrays), getattr(value, 'xdi_parse_count', 1), timer, timer.total * 1000))
+    return xas_file
+
+
+def build_plot_levels(arrays, modes):
+    plot_arrays = dict()
+    for mode in set(modes):
+        name = XASMode.PLOT_ARRAYS.get(mode)
+        if name in arrays and name not in plot_arrays:
+            plot_arrays.update(plot_levels(name, arrays['energy'], arrays[name], settings.XASDB_PLOT_LEVELS))
+    return plot_arrays
+
 
 def isotime2datetime(isotime):
     sdate, stime = isotime.split('T')
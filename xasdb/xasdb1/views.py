@@ -1,5 +1,5 @@
 from django.shortcuts import (render, redirect)
-from django.http import HttpResponse, FileResponse
+from django.http import HttpResponse, FileResponse, Http404, JsonResponse, StreamingHttpResponse
 from django.urls import reverse, reverse_lazy
 
 from django.contrib.auth.decorators import login_required
@@ -16,37 +16,50 @@ from django.contrib.auth import views as auth_views
 from django.conf import settings
 
 from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.core.cache import caches
+from django.core.paginator import Paginator
 
 from django.utils.encoding import force_bytes, force_text, smart_str
-from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
+from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode, http_date
+from django.utils.cache import get_conditional_response, patch_cache_control
 
 from django.core.mail import mail_admins, send_mail
 
-from .forms import XASFileSubmissionForm, XASDBUserCreationForm, XASUploadAuxDataFormSet, XASFileVerificationForm, XASUploadAuxDataVerificationFormSet, XASDBUserDeletionForm
-from .models import XASFile, XASMode, XASArray, XASUploadAuxData
-from .utils import process_xdi_file
+from .forms import XASFileSubmissionForm, XASArchiveSubmissionForm, XASDBUserCreationForm, XASUploadAuxDataFormSet, XASFileVerificationForm, XASUploadAuxDataVerificationFormSet, XASDBUserDeletionForm, XASSimilaritySearchForm
+from .arrays import DERIVED_ARRAYS, NORMALIZED_ARRAY, SIMILARITY_ARRAY, derive_channels, array_to_json, plot_level_name, common_grid, lttb
+from .models import XASFile, XASMode, XASArray, XASUploadAuxData, XASIngestJob, derived_image_digest, mendeljev_valid, parse_xdi_upload
+from .archive import error_message
+from .ingest import ingest_upload, enqueue_upload, enqueue_archive, run_archive_job, notify_admins
+from .crossref import get_work
+from .serving import serve_media_file, is_resumed_download
+from .export import export_manifest, export_members, stored_selection, stream_zip
+from .download_log import log_download, log_downloads
+from .instrumentation import timed
+from .search import SEARCH_FACETS, search_terms, search_files, facet_counts
+from .normalization import absorption_array
+from .similarity import most_similar, spectrum_features
+from .utils import StageTimer, extract_xdi_data
 from .tokens import account_activation_token
 
 import xraylib as xrl
-import tempfile
 import json
 import numpy as np
-import mimetypes
+import io
 
 from bokeh.plotting import figure, output_file, show 
 from bokeh.embed import components
+from bokeh.models import ColumnDataSource, CustomJS, Panel, Tabs
+from bokeh.palettes import Category10_10
 from bokeh import __version__ as bokeh_version
 
-import os.path
 import base64
-from habanero import Crossref
 import traceback
+from collections import OrderedDict, defaultdict
 
 #HOST = 'https://xasdb.diamond.ac.uk'
 HOST = 'http://xasdb.diamond.ac.uk:8050'
 
-XDI_TMP_DIR = tempfile.TemporaryDirectory()
-
 OUR_CITATION = \
         '''<div style="padding-left:30px">G. Cibin, D. Gianolio, S. A. Parry, T. Schoonjans, O. Moore, R. Draper, L. A. Miller, A. Thoma, C. L. Doswell, and A. Graham. An open access, integrated XAS data repository at Diamond Light Source. <i>XAFS 2018 conference proceedings</i> (2019)</div>''' # add clickable doi url when known!
 
@@ -181,24 +194,167 @@ def logout(request):
     messages.success(request, 'Logged out!')
     return redirect('xasdb1:index')
 
+def _visibility_filter(user):
+    # make a distinction between staff and non-staff:
+    # 1. staff should be able to see all spectra, regardless of review_status, and should be able to change that review_status
+    if user.is_staff:
+        return Q()
+    # 2. non-staff should be able to see all APPROVED spectra, as well as those uploaded by the user that were either rejected or pending review
+    elif user.is_authenticated:
+        return Q(uploader=user) | Q(review_status=XASFile.APPROVED)
+    # 3. anonymous users only get to see APPROVED spectra
+    else:
+        return Q(review_status=XASFile.APPROVED)
+
+# sort -> (field, descending, cast) of the keys of the element listing, the last one must be unique
+ELEMENT_SORTS = {
+    'name': (('sample_name', False, str), ('id', False, int)),
+    # downloads in the last 30 days, from the download counters
+    'popular': (('recent_downloads', True, int), ('sample_name', False, str), ('id', False, int)),
+}
+
+def _encode_cursor(file, keys):
+    return urlsafe_base64_encode(force_bytes(json.dumps([getattr(file, field) for field, _, _ in keys])))
+
+def _decode_cursor(cursor, keys):
+    if not cursor:
+        return None
+    try:
+        values = json.loads(force_text(urlsafe_base64_decode(cursor)))
+        if len(values) != len(keys):
+            return None
+        return [cast(value) for (_, _, cast), value in zip(keys, values)]
+    except Exception:
+        return None
+
+def _keyset_filter(keys, values, forward):
+    # everything after (or before) the row with these values, in the order of the keys
+    q = Q()
+    for i, (field, descending, _) in enumerate(keys):
+        lookup = 'gt' if forward != descending else 'lt'
+        q |= Q(**{f'{field}__{lookup}': values[i]}, **dict((field, value) for (field, _, _), value in zip(keys[:i], values[:i])))
+    return q
+
+def _keyset_page(files, request, page_size, keys=ELEMENT_SORTS['name']):
+    # keyset pagination: with the sort keys covered by an index, a page costs the same no matter how deep into the listing it is
+    ordering = ['-' + field if descending else field for field, descending, _ in keys]
+    reverse_ordering = [field[1:] if field.startswith('-') else '-' + field for field in ordering]
+    before = _decode_cursor(request.GET.get('before'), keys)
+    after = _decode_cursor(request.GET.get('after'), keys)
+    if before is not None:
+        page = list(files.filter(_keyset_filter(keys, before, False)).order_by(*reverse_ordering)[:page_size + 1])
+        has_previous = len(page) > page_size
+        page = page[:page_size][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            files = files.filter(_keyset_filter(keys, after, True))
+        page = list(files.order_by(*ordering)[:page_size + 1])
+        has_next = len(page) > page_size
+        page = page[:page_size]
+        has_previous = after is not None
+    previous_cursor = _encode_cursor(page[0], keys) if page and has_previous else None
+    next_cursor = _encode_cursor(page[-1], keys) if page and has_next else None
+    return page, previous_cursor, next_cursor
+
 def element(request, element_id):
     # user may be naughty by providing a non-existent element
     if xrl.SymbolToAtomicNumber(element_id) == 0:
         messages.error(request, 'I am sure you already know that there is no element called ' + element_id + ' . Use the periodic table and stop fooling around.')
         return redirect('xasdb1:index')
 
-    # make a distinction between staff and non-staff:
-    # 1. staff should be able to see all spectra, regardless of review_status, and should be able to change that review_status
-    elif request.user.is_staff:
-        return render(request, 'xasdb1/element.html', {'element': element_id, 'files': XASFile.objects.filter(element=element_id).order_by('sample_name')})
-
-    # 2. non-staff should be able to see all APPROVED spectra, as well as those uploaded by the user that were either rejected or pending review
-    elif request.user.is_authenticated:
-        data_filter = Q(uploader=request.user) | (~Q(uploader=request.user) & Q(review_status=XASFile.APPROVED))
-        return render(request, 'xasdb1/element.html', {'element': element_id, 'files': XASFile.objects.filter(element=element_id).filter(data_filter).order_by('sample_name')})
-
-    else:
-        return render(request, 'xasdb1/element.html', {'element': element_id, 'files': XASFile.objects.filter(element=element_id).filter(review_status=XASFile.APPROVED).order_by('sample_name')})
+    sort = request.GET.get('sort')
+    if sort not in ELEMENT_SORTS:
+        sort = 'name'
+    files = XASFile.objects.filter(element=element_id).filter(_visibility_filter(request.user))
+    count = files.count()
+    # the download counters come along in the same query
+    files = files.annotate(
+        total_downloads=Coalesce('download_stats__total_downloads', 0),
+        recent_downloads=Coalesce('download_stats__downloads_30_days', 0))
+    page, previous_cursor, next_cursor = _keyset_page(files, request, settings.XASDB_ELEMENT_PAGE_SIZE, ELEMENT_SORTS[sort])
+    return render(request, 'xasdb1/element.html', {'element': element_id, 'files': page, 'count': count, 'sort': sort, 'previous_cursor': previous_cursor, 'next_cursor': next_cursor})
+
+EDGE_NAMES = dict(XASFile.EDGE_CHOICES)
+
+def _selected_facets(request):
+    # facet -> value of the facets in the query string, ignoring edges that are not numbers
+    selected = dict()
+    for facet in SEARCH_FACETS:
+        value = request.GET.get(facet)
+        if value:
+            if facet == 'edge':
+                try:
+                    value = int(value)
+                except ValueError:
+                    continue
+            selected[facet] = value
+    return selected
+
+def _search(request):
+    # everything the search page and the search API have in common
+    query = request.GET.get('q', '').strip()
+    terms = search_terms(query)
+    result = {'query': query, 'terms': terms, 'selected': {}, 'facets': {}, 'page': None}
+    if not terms:
+        return result
+
+    files = search_files(XASFile.objects.filter(_visibility_filter(request.user)), terms)
+    selected = _selected_facets(request)
+    result['selected'] = selected
+    result['facets'] = facet_counts(files, selected)
+    files = files.filter(**dict((SEARCH_FACETS[facet], value) for facet, value in selected.items()))
+    result['page'] = Paginator(files.order_by('-relevance', 'sample_name', 'id'), settings.XASDB_SEARCH_PAGE_SIZE).get_page(request.GET.get('page'))
+    return result
+
+def _search_url(request, view='xasdb1:search', **changes):
+    # the current search with some parameters changed, None removes one. always back to the first page
+    params = request.GET.copy()
+    params.pop('page', None)
+    for key, value in changes.items():
+        if value is None:
+            params.pop(key, None)
+        else:
+            params[key] = value
+    return reverse(view) + '?' + params.urlencode()
+
+def search(request):
+    result = _search(request)
+    facets = []
+    for facet, values in result['facets'].items():
+        selected = result['selected'].get(facet)
+        facets.append((facet, [(EDGE_NAMES.get(value, value) if facet == 'edge' else value, count, _search_url(request, **{facet: value}), value == selected) for value, count in values], _search_url(request, **{facet: None}) if selected is not None else None))
+    page = result['page']
+    return render(request, 'xasdb1/search.html', {
+        'query': result['query'],
+        'terms': result['terms'],
+        'facets': facets,
+        'page': page,
+        'previous_url': _search_url(request, page=page.previous_page_number()) if page and page.has_previous() else None,
+        'next_url': _search_url(request, page=page.next_page_number()) if page and page.has_next() else None,
+        'export_url': _search_url(request, view='xasdb1:export'),
+        })
+
+def api_search(request):
+    result = _search(request)
+    page = result['page']
+    return JsonResponse({
+        'query': result['query'],
+        'count': page.paginator.count if page else 0,
+        'page': page.number if page else 1,
+        'num_pages': page.paginator.num_pages if page else 0,
+        'facets': dict((facet, [[EDGE_NAMES.get(value, value) if facet == 'edge' else value, count] for value, count in values]) for facet, values in result['facets'].items()),
+        'results': [{
+            'id': file.id,
+            'url': reverse('xasdb1:file', args=[file.id]),
+            'sample_name': file.sample_name,
+            'element': file.element,
+            'edge': file.get_edge_display(),
+            'beamline_name': file.beamline_name,
+            'facility_name': file.facility_name,
+            'relevance': file.relevance,
+            } for file in (page or [])],
+        })
 
 @login_required(login_url='xasdb1:login')
 def upload(request):
@@ -212,30 +368,16 @@ def upload(request):
         #print(f"upload_aux_formset_is_valid: {upload_aux_formset_is_valid}")
         if form_is_valid and upload_aux_formset_is_valid:
             #print("upload::POST -> is_valid")
-            value = request.FILES['upload_file']
-            value.seek(0)
-            temp_xdi_file = os.path.join(XDI_TMP_DIR.name, value.name)
-            with open(temp_xdi_file, 'w') as f:
-                contents = value.read().decode('utf-8')
-                f.write(contents)
-            xas_file = process_xdi_file(temp_xdi_file, request)
-            # add auxiliary data
-            for index, upload_aux_form in enumerate(upload_aux_formset):
-                #print(f"index: {index}")
-                try:
-                    xas_file.xasuploadauxdata_set.create(aux_description=upload_aux_form.cleaned_data['aux_description'], aux_file=upload_aux_form.cleaned_data['aux_file'])
-                except:
-                    pass
-            messages.success(request, 'File uploaded')
-
-            new_redirect = redirect('xasdb1:file', xas_file.id)
-            # send email to maintainers
-            mail_admins( \
-                'a new dataset has been uploaded', \
-                'A new dataset has been uploaded by {} ({}).\nPlease process this submission by visiting {}.'.format(request.user.get_full_name(), request.user.email, HOST + new_redirect.url))
+            aux = [(upload_aux_form.cleaned_data['aux_description'], upload_aux_form.cleaned_data['aux_file']) for upload_aux_form in upload_aux_formset if upload_aux_form.cleaned_data.get('aux_file')]
+            if settings.XASDB_ASYNC_INGEST:
+                # parsing and thumbnailing is left to the ingest_worker
+                job = enqueue_upload(request.FILES['upload_file'], request.POST['upload_file_doi'], request.user, aux)
+                return redirect('xasdb1:ingest_job', job.id)
 
-
-            return new_redirect
+            xas_file = ingest_upload(request.FILES['upload_file'], request.POST['upload_file_doi'], request.user, aux)
+            messages.success(request, 'File uploaded')
+            notify_admins(xas_file, request.user)
+            return redirect('xasdb1:file', xas_file.id)
     else:
         form = XASFileSubmissionForm()
         data = {
@@ -247,9 +389,46 @@ def upload(request):
         upload_aux_formset = XASUploadAuxDataFormSet(data, initial=[{'aux_description': "", 'aux_file': ""}])
     return render(request, 'xasdb1/upload.html', {'form': form, 'upload_aux_formset': upload_aux_formset})
 
+@login_required(login_url='xasdb1:login')
+def upload_archive(request):
+    # the members are ingested by the ingest_worker, the job page reports on them as they are stored
+    if request.method == 'POST':
+        form = XASArchiveSubmissionForm(request.POST, request.FILES)
+        if form.is_valid():
+            job = enqueue_archive(form.cleaned_data['archive_file'], form.cleaned_data['upload_file_doi'], request.user, queued=settings.XASDB_ASYNC_INGEST)
+            if not settings.XASDB_ASYNC_INGEST:
+                # no worker to leave it to: the job page has the whole report right away
+                run_archive_job(job, retry=False)
+            return redirect('xasdb1:ingest_job', job.id)
+    else:
+        form = XASArchiveSubmissionForm()
+    return render(request, 'xasdb1/upload_archive.html', {'form': form})
+
+@login_required(login_url='xasdb1:login')
+def ingest_job(request, job_id):
+    job = XASIngestJob.objects.filter(id=job_id).first()
+    if job is None or (not request.user.is_staff and request.user.id != job.uploader_id):
+        messages.error(request, 'The requested upload is not accessible')
+        return redirect('xasdb1:index')
+
+    if not job.is_archive and job.status == XASIngestJob.DONE and job.file_id is not None:
+        messages.success(request, 'File uploaded')
+        return redirect('xasdb1:file', job.file_id)
+
+    report = None
+    if job.is_archive:
+        report = list(job.xasingestjobmember_set.all())
+        if job.status == XASIngestJob.DONE:
+            uploaded = len([member for member in report if member.file_id is not None])
+            if uploaded:
+                messages.success(request, '{} of {} files uploaded'.format(uploaded, len(report)))
+            if uploaded < len(report):
+                messages.error(request, '{} of {} files could not be uploaded'.format(len(report) - uploaded, len(report)))
+    return render(request, 'xasdb1/ingest_job.html', {'job': job, 'report': report, 'refresh': settings.XASDB_INGEST_POLL_INTERVAL})
+
 def file(request, file_id):
     # check first if this should be visible for the current user
-    file = XASFile.objects.get(id=file_id)
+    file = XASFile.objects.select_related('download_stats').get(id=file_id)
     #print(f'request.user: {request.user}')
     #print(f'request.user.is_authenticated: {request.user.is_authenticated}')
     #print(f'request.user.is_staff: {request.user.is_staff}')
@@ -260,76 +439,78 @@ def file(request, file_id):
         return redirect('xasdb1:index')
 
 
-    # get modes
-    file = XASFile.objects.get(id=file_id)
-    modes = file.xasmode_set.all()
     plots = []
-
-    if len(modes) == 0:
-        messages.error(request, 'No modes found')
+    # the plot only changes when the arrays or metadata of the file do: render it once per version
+    plot = _get_cached_file_plot(file)
+    if plot is not None:
+        plots.append(plot)
     else:
-        if len(modes) > 1:
-            print('Warning: more than one mode detected. Using first mode!')
-        mode = modes[0].mode
-        yaxis_title = "Raw XAFS"
-        if mode == XASMode.TRANSMISSION:
-            try:
-                energy = np.array(json.loads(file.xasarray_set.get(name='energy').array))
-                i0 = np.array(json.loads(file.xasarray_set.get(name='i0').array))
-                itrans = np.array(json.loads(file.xasarray_set.get(name='itrans').array))
-                mutrans = -np.log(itrans/i0)
-            except Exception as e:
-                messages.error(request, 'Could not extract data from transmission spectrum: ' + str(e))
-        elif mode == XASMode.FLUORESCENCE or mode == XASMode.FLUORESCENCE_UNITSTEP:
-            try:
-                energy = np.array(json.loads(file.xasarray_set.get(name='energy').array))
-                i0 = np.array(json.loads(file.xasarray_set.get(name='i0').array))
-                ifluor = np.array(json.loads(file.xasarray_set.get(name='ifluor').array))
-                mutrans = ifluor/i0
-            except Exception as e:
-                messages.error(request, 'Could not extract data from fluorescence spectrum: ' + str(e))
-        elif mode == XASMode.XMU:
-            try:
-                energy = np.array(json.loads(file.xasarray_set.get(name='energy').array))
-                mutrans = np.array(json.loads(file.xasarray_set.get(name='xmu').array))
-                yaxis_title = "Normalized absorption spectrum"
-            except Exception as e:
-                messages.error(request, 'Could not extract data from normalized absorption spectrum: ' + str(e))
+        # get modes
+        modes = file.xasmode_set.all()
+
+        if len(modes) == 0:
+            messages.error(request, 'No modes found')
         else:
-            messages.error(request, 'Unsupported mode detected!')
+            if len(modes) > 1:
+                print('Warning: more than one mode detected. Using first mode!')
+            mode = modes[0].mode
+            if mode in MODE_PLOTS:
+                description, yaxis_title = MODE_PLOTS[mode]
+                yaxis_name = XASMode.PLOT_ARRAYS[mode]
+                levels = sorted(settings.XASDB_PLOT_LEVELS)
+                coarsest = plot_level_name(yaxis_name, levels[0])
+                # the normalized spectrum gets a tab of its own, unless the file holds a normalized spectrum already
+                normalized_coarsest = plot_level_name(NORMALIZED_ARRAY, levels[0]) if file.e0 is not None and mode != XASMode.XMU else None
+                # only fetch what gets plotted: the coarsest downsampled levels, finer ones are fetched by the browser when zooming in
+                arrays = file.get_arrays(*filter(None, (coarsest, normalized_coarsest)))
+                zoom = None
+                normalized = None
+                if normalized_coarsest in arrays:
+                    normalized_energy, mu_norm = arrays[normalized_coarsest]
+                    normalized = (normalized_energy, mu_norm, _plot_zoom(file, NORMALIZED_ARRAY, len(normalized_energy)))
+                if coarsest in arrays:
+                    energy, mutrans = arrays[coarsest]
+                    zoom = _plot_zoom(file, yaxis_name, len(energy))
+                else:
+                    # ingested before plot levels were stored: see the rebuild_arrays management command
+                    arrays = file.get_arrays('energy', yaxis_name)
+                    if yaxis_name not in arrays and yaxis_name in DERIVED_ARRAYS:
+                        arrays.update(derive_channels(file.get_arrays('i0', 'itrans', 'ifluor', 'irefer')))
+                    try:
+                        energy = arrays['energy']
+                        mutrans = arrays[yaxis_name]
+                    except KeyError as e:
+                        messages.error(request, 'Could not extract data from {} spectrum: no {} array found'.format(description, e))
+            else:
+                messages.error(request, 'Unsupported mode detected!')
 
         
-        if len(list(filter(lambda message: message.level_tag != 'success', messages.get_messages(request)))) == 0:
-            murefer = None
-            try:
-                irefer = np.array(json.loads(file.xasarray_set.get(name='irefer').array))
-                murefer = -np.log(irefer/itrans)
-            except:
-                pass
-            plots.append(_file_plot(energy, mutrans, "Energy (eV)", yaxis_title))
+            if len(list(filter(lambda message: message.level_tag != 'success', messages.get_messages(request)))) == 0:
+                with timed('plot'):
+                    plot = _file_plot(energy, mutrans, "Energy (eV)", yaxis_title, zoom=zoom, normalized=normalized)
+                _set_cached_file_plot(file, plot)
+                plots.append(plot)
 
     # try getting the doi information
     try:
-        # this should probably get cached -> TODO
-        cr = Crossref(mailto = "Tom.Schoonjans@diamond.ac.uk") # necessary to end up in the polite pool
         doi = {}
-        work = cr.works(ids=file.upload_file_doi)
-        doi['title'] = work['message']['title'][0]
-        doi['url'] = work['message']['URL']
-        doi['year'] = work['message']['published-print']['date-parts'][0][0]
-        doi['journal'] = work['message']['short-container-title'][0]
-        doi['ncited'] = work['message']['is-referenced-by-count']
+        work = get_work(file.upload_file_doi)
+        doi['title'] = work['title'][0]
+        doi['url'] = work['URL']
+        doi['year'] = work['published-print']['date-parts'][0][0]
+        doi['journal'] = work['short-container-title'][0]
+        doi['ncited'] = work['is-referenced-by-count']
         authorlist = ""
-        for index, author in enumerate(work['message']['author']):
+        for index, author in enumerate(work['author']):
             givens = author['given'].split()
             for given in givens:
                 authorlist += "{}. ".format(given[0])
             family = author['family']
             authorlist += family
-            if len(work['message']['author']) > 1:
-                    if index == len(work['message']['author']) - 2:
+            if len(work['author']) > 1:
+                    if index == len(work['author']) - 2:
                         authorlist += ' and '
-                    elif index != len(work['message']['author']) - 1:
+                    elif index != len(work['author']) - 1:
                         authorlist += ', '
                         
         doi['authors'] = authorlist
@@ -341,7 +522,7 @@ def file(request, file_id):
         traceback.print_exc()
         doi = None
         message = \
-'''By downloading this file, I agree to cite the manuscript of this website {}'''.format(doi['citation'], OUR_CITATION)
+'''By downloading this file, I agree to cite the manuscript of this website {}'''.format(OUR_CITATION)
 
     form = None
     formset = None
@@ -368,52 +549,421 @@ def file(request, file_id):
         messages.error(request, 'Only staff can make file POST requests!')
         return redirect('xasdb1:index')
 
-    return render(request, 'xasdb1/file.html', {'file' : file, 'plots': plots, 'aux' : file.xasuploadauxdata_set.all(), 'doi' : doi, 'bokeh_version': bokeh_version, 'message': message, 'form': form, 'formset': formset})
+    return render(request, 'xasdb1/file.html', {'file' : file, 'plots': plots, 'aux' : file.xasuploadauxdata_set.select_related('download_stats'), 'doi' : doi, 'bokeh_version': bokeh_version, 'message': message, 'form': form, 'formset': formset})
     
 
-def _file_plot(xaxis, yaxis, xaxis_name, yaxis_name):
+# mode -> (description, y axis title), see XASMode.PLOT_ARRAYS for what gets plotted
+MODE_PLOTS = {
+    XASMode.TRANSMISSION: ('transmission', 'Raw XAFS'),
+    XASMode.FLUORESCENCE: ('fluorescence', 'Raw XAFS'),
+    XASMode.FLUORESCENCE_UNITSTEP: ('fluorescence', 'Raw XAFS'),
+    XASMode.XMU: ('normalized absorption', 'Normalized absorption spectrum'),
+}
+
+def _get_cached_file_plot(file):
+    cached = caches['plots'].get(file.plot_cache_key)
+    if cached is not None and cached['version'] == (file.content_version, bokeh_version):
+        return cached['plot']
+    return None
+
+def _set_cached_file_plot(file, plot):
+    caches['plots'].set(file.plot_cache_key, {'version': (file.content_version, bokeh_version), 'plot': plot})
+
+# fetches finer plot levels from api_file_arrays when zooming in, and only hands the visible window to the renderer
+ZOOM_JS = """
+if (source.xasdb === undefined) {
+    const x = source.data.x;
+    source.xasdb = {data: {coarse: {x: x, y: source.data.y}}, missing: {}, timer: null, xmin: x[0], xmax: x[x.length - 1]};
+}
+const state = source.xasdb;
+
+function bisect(x, value) {
+    let lo = 0, hi = x.length;
+    while (lo < hi) {
+        const mid = (lo + hi) >> 1;
+        if (x[mid] < value) lo = mid + 1; else hi = mid;
+    }
+    return lo;
+}
+
+function show(data) {
+    const margin = 0.5 * (x_range.end - x_range.start);
+    const lo = Math.max(bisect(data.x, x_range.start - margin) - 1, 0);
+    const hi = bisect(data.x, x_range.end + margin) + 1;
+    source.data = {x: data.x.slice(lo, hi), y: data.y.slice(lo, hi)};
+}
+
+function load(key, names) {
+    if (state.data[key]) {
+        show(state.data[key]);
+        return;
+    }
+    fetch(url + '?names=' + names.join(','), {credentials: 'same-origin'}).then(response => response.json()).then(function(content) {
+        if (key == 'full') {
+            state.data[key] = {x: content.arrays[full[0]], y: content.arrays[full[1]]};
+        } else if (content.arrays[key]) {
+            state.data[key] = {x: content.arrays[key][0], y: content.arrays[key][1]};
+        } else {
+            // spectrum too short for this level
+            state.missing[key] = true;
+            load('full', full);
+            return;
+        }
+        show(state.data[key]);
+    });
+}
+
+clearTimeout(state.timer);
+state.timer = setTimeout(function() {
+    const fraction = (x_range.end - x_range.start) / (state.xmax - state.xmin);
+    if (fraction >= 1) {
+        show(state.data.coarse);
+        return;
+    }
+    // the coarsest level that still puts about as many points in view as the initial plot has
+    for (const [level, name] of levels) {
+        if (level * fraction >= points && !state.missing[name]) {
+            load(name, [name]);
+            return;
+        }
+    }
+    load('full', full);
+}, 200);
+"""
+
+def _plot_zoom(file, name, points):
+    # what ZOOM_JS needs to fetch the finer levels of an array, None if the coarsest level already holds all of it
+    levels = sorted(settings.XASDB_PLOT_LEVELS)
+    if points != levels[0]:
+        return None
+    return dict(url=reverse('xasdb1:api_file_arrays', args=[file.id]), levels=[[level, plot_level_name(name, level)] for level in levels[1:]], full=['energy', name], points=levels[0])
+
+def _spectrum_figure(xaxis, yaxis, xaxis_name, yaxis_name, zoom=None):
+    source = ColumnDataSource(data=dict(x=xaxis, y=yaxis))
     plot = figure(x_axis_label = xaxis_name, y_axis_label = yaxis_name, plot_width = 500, plot_height = 400, tooltips = [('(x, y)', '($x, $y)')])
     plot.hover.mode = 'vline'
-    plot.line(xaxis, yaxis, line_width=2)
+    plot.line('x', 'y', source=source, line_width=2)
+    if zoom is not None:
+        callback = CustomJS(args=dict(source=source, x_range=plot.x_range, **zoom), code=ZOOM_JS)
+        plot.x_range.js_on_change('start', callback)
+        plot.x_range.js_on_change('end', callback)
+    return plot
+
+def _file_plot(xaxis, yaxis, xaxis_name, yaxis_name, zoom=None, normalized=None):
+    # normalized is (x, y, zoom) of the normalized spectrum, which then goes into a tab next to the raw one
+    plot = _spectrum_figure(xaxis, yaxis, xaxis_name, yaxis_name, zoom=zoom)
+    if normalized is not None:
+        normalized_plot = _spectrum_figure(normalized[0], normalized[1], xaxis_name, 'Normalized absorption', zoom=normalized[2])
+        plot = Tabs(tabs=[Panel(child=plot, title=yaxis_name), Panel(child=normalized_plot, title='Normalized')])
     return dict(zip(('script', 'div'), components(plot)))
 
 @login_required(login_url='xasdb1:login')
 def download(request, path_id):
-    # figure out who this file belongs to
-    try:
-        # check if path_id corresponds to XDI file
-        file = XASFile.objects.get(upload_file=path_id)
+    # figure out who this file belongs to: both lookups are resolved through an index
+    files = None
+    # check if path_id corresponds to XDI file
+    file = XASFile.objects.filter(upload_file=path_id).first()
+    if file is not None:
         files = (file, file)
-    except Exception:
+    else:
         # check if path_id corresponds to AUX file
-        files = None
-        for xasfile in XASFile.objects.all():
-            for auxfile in xasfile.xasuploadauxdata_set.all():
-                if auxfile.aux_file.name == path_id:
-                    files = (xasfile, auxfile)
-                    break
-            else:
-                continue
-            break
+        auxfile = XASUploadAuxData.objects.select_related('file').filter(aux_file=path_id).first()
+        if auxfile is not None:
+            files = (auxfile.file, auxfile)
 
     if files is None:
         messages.error(request, 'The requested file {} does not exist'.format(path_id))
         return redirect('xasdb1:index')
 
-    if not request.user.is_staff and request.user != files[0].uploader and files[0].review_status != XASFile.APPROVED:
+    if not request.user.is_staff and request.user.id != files[0].uploader_id and files[0].review_status != XASFile.APPROVED:
         messages.error(request, 'The requested file is not accessible')
         return redirect('xasdb1:index')
 
     # at this point we are going to serve the file!
-    if isinstance(files[1], XASFile):
-        # create download entry
-        files[1].xasdownloadfile_set.create(downloader=request.user)
-    elif isinstance(files[1], XASUploadAuxData):
-        files[1].xasdownloadauxdata_set.create(downloader=request.user)
+    # resumed downloads have been counted when they started
+    if not is_resumed_download(request):
+        # create download entry: it is written to the database in batches
+        if isinstance(files[1], XASFile):
+            log_download('file', files[1].id, request.user.id)
+        elif isinstance(files[1], XASUploadAuxData):
+            log_download('aux', files[1].id, request.user.id)
+
+    return serve_media_file(request, path_id)
+
+def aux_image(request, aux_id, kind, digest):
+    # thumbnails and previews of aux images: the URL contains the digest of the content,
+    # so whatever is served here never changes and can be cached forever
+    if kind not in ('thumbnail', 'image'):
+        raise Http404('Unknown image kind')
+    auxfile = XASUploadAuxData.objects.select_related('file').filter(id=aux_id, file__in=XASFile.objects.filter(_visibility_filter(request.user))).first()
+    if auxfile is None:
+        raise Http404('Image not found')
+    file = auxfile.file
+    field = getattr(auxfile, 'aux_' + kind)
+    if not field or derived_image_digest(field.name) != digest:
+        raise Http404('Image not found')
+
+    etag = f'"{digest}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = FileResponse(field.open('rb'), content_type='image/png')
+    response['ETag'] = etag
+    _patch_file_cache_control(response, file, max_age=settings.XASDB_AUX_IMAGE_MAX_AGE, immutable=True)
+    return response
+
+def _patch_file_cache_control(response, file, **kwargs):
+    # spectra that are not approved yet must not end up in shared caches
+    if file.review_status == XASFile.APPROVED:
+        patch_cache_control(response, public=True, **kwargs)
+    else:
+        patch_cache_control(response, private=True, **kwargs)
+
+API_ARRAY_FORMATS = ('json', 'npz')
+
+def api_file_arrays(request, file_id):
+    # energy and channel arrays of a file, as JSON or as a numpy .npz archive (?format=npz).
+    # ?names=energy,mu_trans restricts the arrays returned
+    array_format = request.GET.get('format', 'json')
+    if array_format not in API_ARRAY_FORMATS:
+        return JsonResponse({'error': 'Unknown format {}, use one of {}'.format(array_format, ', '.join(API_ARRAY_FORMATS))}, status=400)
+    names = sorted(filter(None, request.GET.get('names', '').split(',')))
+
+    file = XASFile.objects.filter(_visibility_filter(request.user)).filter(id=file_id).first()
+    if file is None:
+        return JsonResponse({'error': 'File not found'}, status=404)
+
+    # the arrays only change together with content_version, so the headers can be checked before fetching any of them
+    etag = '"{}-{}-{}"'.format(file.content_version, array_format, '+'.join(names))
+    # HTTP dates have a resolution of one second
+    last_modified = int(file.modified_timestamp.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        if names:
+            xas_arrays = file.xasarray_set.filter(name__in=names)
+        else:
+            # downsampled plot levels and similarity features are only sent when asked for by name
+            xas_arrays = file.xasarray_set.exclude(name__contains='@').exclude(name=SIMILARITY_ARRAY)
+        arrays = {xas_array.name: xas_array.data for xas_array in xas_arrays}
+        if array_format == 'npz':
+            buffer = io.BytesIO()
+            np.savez(buffer, **arrays)
+            response = HttpResponse(buffer.getvalue(), content_type='application/octet-stream')
+            response['Content-Disposition'] = f'attachment; filename="xasdb-{file.id}.npz"'
+        else:
+            response = JsonResponse({
+                'id': file.id,
+                'element': file.element,
+                'edge': file.get_edge_display(),
+                'arrays': {name: array_to_json(array) for name, array in arrays.items()},
+            })
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    # always revalidate: a matching ETag gets a 304
+    _patch_file_cache_control(response, file, no_cache=True)
+    return response
+
+def _similarity_count(request):
+    try:
+        count = int(request.GET.get('n', settings.XASDB_SIMILARITY_RESULTS))
+    except ValueError:
+        count = settings.XASDB_SIMILARITY_RESULTS
+    return max(1, min(count, settings.XASDB_SIMILARITY_MAX_RESULTS))
+
+def _file_features(file):
+    # stored at ingest, files ingested before that get them computed here: see the rebuild_arrays management command
+    arrays = file.get_arrays(SIMILARITY_ARRAY)
+    if SIMILARITY_ARRAY in arrays:
+        return arrays[SIMILARITY_ARRAY]
+    arrays = file.get_arrays('energy', NORMALIZED_ARRAY, *set(XASMode.PLOT_ARRAYS.values()))
+    return spectrum_features(file.element, file.edge, arrays, list(file.xasmode_set.values_list('mode', flat=True)))
+
+def _similar(features, element, edge, count, exclude=None):
+    # [(file, score)] of the most similar approved spectra, best first
+    if features is None:
+        return []
+    with timed('similarity'):
+        results = most_similar(features, element, edge, count, exclude=exclude)
+    files = XASFile.objects.in_bulk([file_id for file_id, _ in results])
+    return [(files[file_id], score) for file_id, score in results if file_id in files]
+
+def similar(request, file_id):
+    file = XASFile.objects.filter(_visibility_filter(request.user)).filter(id=file_id).first()
+    if file is None:
+        messages.error(request, 'The requested file is not accessible')
+        return redirect('xasdb1:index')
+    features = _file_features(file)
+    if features is None:
+        messages.error(request, 'This spectrum does not cover enough of the absorption edge to be compared with others')
+    return render(request, 'xasdb1/similar.html', {
+        'file': file,
+        'name': file.sample_name,
+        'element': file.element,
+        'edge': file.get_edge_display(),
+        'results': _similar(features, file.element, file.edge, _similarity_count(request), exclude=file.id),
+        'form': XASSimilaritySearchForm(),
+        })
+
+@login_required(login_url='xasdb1:login')
+def similar_upload(request):
+    # the most similar spectra to one that is uploaded just for this, and not stored
+    context = {'results': None}
+    if request.method == 'POST':
+        form = XASSimilaritySearchForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['upload_file']
+            try:
+                # same checks as the archive members get
+                xdi_file = parse_xdi_upload(upload)
+                mendeljev_valid(xdi_file.element.decode('utf-8'))
+                data = extract_xdi_data(xdi_file, upload.name, StageTimer())
+            except Exception as e:
+                form.add_error('upload_file', error_message(e))
+            else:
+                features = data['arrays'].get(SIMILARITY_ARRAY)
+                if features is None:
+                    messages.error(request, 'This spectrum does not cover enough of the absorption edge to be compared with others')
+                context.update(name=data['kwargs']['sample_name'], element=data['element'], edge=EDGE_NAMES.get(data['edge'], data['edge']),
+                    results=_similar(features, data['element'], data['edge'], _similarity_count(request)))
+                form = XASSimilaritySearchForm()
+    else:
+        form = XASSimilaritySearchForm()
+    context['form'] = form
+    return render(request, 'xasdb1/similar.html', context)
+
+def api_file_similar(request, file_id):
+    # ?n= sets the number of spectra returned
+    file = XASFile.objects.filter(_visibility_filter(request.user)).filter(id=file_id).first()
+    if file is None:
+        return JsonResponse({'error': 'File not found'}, status=404)
+    results = _similar(_file_features(file), file.element, file.edge, _similarity_count(request), exclude=file.id)
+    return JsonResponse({
+        'id': file.id,
+        'element': file.element,
+        'edge': file.get_edge_display(),
+        'results': [{
+            'id': similar_file.id,
+            'url': reverse('xasdb1:file', args=[similar_file.id]),
+            'sample_name': similar_file.sample_name,
+            'beamline_name': similar_file.beamline_name,
+            'facility_name': similar_file.facility_name,
+            'score': score,
+            } for similar_file, score in results],
+        })
+
+# what the compare view may plot: preferably the normalized spectrum
+COMPARE_ARRAYS = ('energy', NORMALIZED_ARRAY) + tuple(sorted(set(XASMode.PLOT_ARRAYS.values())))
+
+def _selected_ids(request):
+    # ?id=1&id=2 (as sent by the checkboxes of the element page) or ?id=1,2, without repetitions
+    ids = []
+    for value in request.GET.getlist('id'):
+        for part in value.split(','):
+            try:
+                ids.append(int(part))
+            except ValueError:
+                pass
+    return list(OrderedDict.fromkeys(ids))
+
+def _compare_plot(grid, values, labels, yaxis_name):
+    plot = figure(x_axis_label = 'Energy (eV)', y_axis_label = yaxis_name, plot_width = 800, plot_height = 500, tooltips = [('spectrum', '$name'), ('(x, y)', '($x, $y)')])
+    for i, (y, label) in enumerate(zip(values, labels)):
+        finite = np.isfinite(y)
+        x = grid[finite]
+        y = y[finite]
+        # every series is downsampled on its own, so the page stays light however many there are
+        indices = lttb(x, y, settings.XASDB_COMPARE_PLOT_POINTS)
+        plot.line(x[indices], y[indices], line_width=2, color=Category10_10[i % len(Category10_10)], legend_label=label, name=label)
+    plot.legend.click_policy = 'hide'
+    plot.legend.location = 'bottom_right'
+    return dict(zip(('script', 'div'), components(plot)))
+
+def compare(request):
+    # overlay of several spectra: one query for the files, one for their modes and one for all of their arrays
+    ids = _selected_ids(request)
+    if len(ids) > settings.XASDB_COMPARE_MAX_SPECTRA:
+        messages.error(request, 'At most {} spectra can be compared at once'.format(settings.XASDB_COMPARE_MAX_SPECTRA))
+        ids = ids[:settings.XASDB_COMPARE_MAX_SPECTRA]
+    normalized = request.GET.get('y') != 'raw'
+    files = XASFile.objects.filter(_visibility_filter(request.user)).in_bulk(ids)
+    if len(files) < len(ids):
+        messages.error(request, 'Some of the requested spectra are not accessible')
+
+    # the raw spectrum is the one that was normalized, see normalization.absorption_array
+    modes = defaultdict(list)
+    for file_id, mode in XASMode.objects.filter(file_id__in=list(files)).values_list('file_id', 'mode'):
+        modes[file_id].append(mode)
+    arrays = defaultdict(dict)
+    for xas_array in XASArray.objects.filter(file_id__in=list(files), name__in=COMPARE_ARRAYS):
+        arrays[xas_array.file_id][xas_array.name] = xas_array.data
+    series = []
+    for file_id in ids:
+        if file_id not in files:
+            continue
+        file_arrays = arrays[file_id]
+        name = NORMALIZED_ARRAY if normalized and NORMALIZED_ARRAY in file_arrays else absorption_array(file_arrays, modes[file_id])
+        if 'energy' not in file_arrays or name is None:
+            messages.error(request, 'No spectrum found for {}'.format(files[file_id].sample_name))
+            continue
+        series.append((files[file_id], file_arrays['energy'], file_arrays[name], name == NORMALIZED_ARRAY or name == 'xmu'))
+
+    plot = None
+    if series:
+        grid, values = common_grid([(energy, mu) for _, energy, mu, _ in series], settings.XASDB_COMPARE_GRID_POINTS)
+        # spectra that could not be normalized are plotted raw, and say so
+        labels = ['{} ({})'.format(file.sample_name, file.id) + ('' if is_normalized or not normalized else ' (raw)') for file, _, _, is_normalized in series]
+        with timed('plot'):
+            plot = _compare_plot(grid, values, labels, 'Normalized absorption' if normalized else 'Absorption')
+
+    query = '&'.join('id={}'.format(file.id) for file, _, _, _ in series)
+    return render(request, 'xasdb1/compare.html', {
+        'files': [file for file, _, _, _ in series],
+        'plot': plot,
+        'normalized': normalized,
+        'normalized_url': reverse('xasdb1:compare') + '?' + query,
+        'raw_url': reverse('xasdb1:compare') + '?' + query + '&y=raw',
+        'bokeh_version': bokeh_version,
+        })
+
+def _export_selection(request):
+    # the files an export is made of, out of those the user may download: ?id= as for the compare view,
+    # otherwise a search (?q= and its facets) or just the facets, such as ?element=Fe&edge=0. None if nothing is selected
+    files = XASFile.objects.filter(_visibility_filter(request.user))
+    ids = _selected_ids(request)
+    if ids:
+        return files.filter(id__in=ids)
+    terms = search_terms(request.GET.get('q', '').strip())
+    selected = _selected_facets(request)
+    if not terms and not selected:
+        return None
+    if terms:
+        files = search_files(files, terms)
+    return files.filter(**dict((SEARCH_FACETS[facet], value) for facet, value in selected.items()))
+
+@login_required(login_url='xasdb1:login')
+def export(request):
+    # a zip of the selected spectra with their aux files and a manifest, streamed as it is compressed
+    files = _export_selection(request)
+    if files is None:
+        messages.error(request, 'No spectra were selected for the export')
+        return redirect('xasdb1:index')
+    files = list(files.order_by('element', 'id')[:settings.XASDB_EXPORT_MAX_FILES + 1])
+    if not files:
+        messages.error(request, 'None of the selected spectra are accessible')
+        return redirect('xasdb1:index')
+    if len(files) > settings.XASDB_EXPORT_MAX_FILES:
+        messages.error(request, 'At most {} spectra can be exported at once'.format(settings.XASDB_EXPORT_MAX_FILES))
+        return redirect('xasdb1:index')
 
+    aux_files = defaultdict(list)
+    for aux in XASUploadAuxData.objects.filter(file__in=files).order_by('id'):
+        aux_files[aux.file_id].append(aux)
+    files, aux_files = stored_selection(files, aux_files)
+    if not files:
+        messages.error(request, 'None of the selected spectra are available')
+        return redirect('xasdb1:index')
+    # counted as downloads of each of the files that go into the zip, in one go
+    log_downloads([('file', file.id) for file in files] + [('aux', aux.id) for file_aux in aux_files.values() for aux in file_aux], request.user.id)
 
-    # inspired by https://stackoverflow.com/q/15246661/1253230
-    file_path = settings.MEDIA_ROOT + '/' + path_id
-    file_mimetype = mimetypes.guess_type(file_path)
-    response = FileResponse(open(file_path, 'rb'), as_attachment=True, content_type=file_mimetype)
+    response = StreamingHttpResponse(stream_zip(export_members(files, aux_files), export_manifest(files)), content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="xasdb-export.zip"'
     return response